@@ -0,0 +1,119 @@
+"""Group commit: run many callers' writes in one SQLite transaction.
+
+Callers ``submit`` an operation, a function taking a Session, and await its
+result. A single worker task collects operations until ``max_ops`` are queued
+or ``window`` seconds have passed since the first, then runs them on the
+threadpool in one ``BEGIN IMMEDIATE`` transaction and commits once, so a burst
+of N writes costs one fsync instead of N. Every operation runs in its own
+SAVEPOINT: one that raises is rolled back alone and its caller gets the
+exception, while the rest of the batch still commits. If the commit itself
+fails, every caller in the batch gets that error.
+
+Operations must return plain values (validated models, dicts): the session is
+committed and closed before results are handed back.
+"""
+import asyncio
+import contextvars
+import threading
+
+from starlette.concurrency import run_in_threadpool
+
+
+class WriteBatcher:
+    def __init__(self, session_factory, lock, window: float = 0.002, max_ops: int = 100):
+        self.session_factory = session_factory
+        self.lock = lock  # held while a batch runs, shared with the other writers
+        self.window = window
+        self.max_ops = max_ops
+        self.batches = 0
+        self.operations = 0
+        self.failures = 0
+        self._loop = None
+        self._queue = None
+        self._worker = None
+        self._stats_lock = threading.Lock()
+
+    async def submit(self, op):
+        """Run op(session) in the next batch and return its result or raise its error."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker.done():
+            self._start(loop)
+        future = loop.create_future()
+        self._queue.put_nowait((op, future))
+        return await future
+
+    def _start(self, loop):
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        # A fresh context, so the worker's SQL is not attributed to the request that started it
+        self._worker = loop.create_task(self._run(), context=contextvars.Context())
+
+    async def close(self):
+        if self._worker is not None and self._loop is asyncio.get_running_loop():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._loop = self._queue = self._worker = None
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.window
+        while len(batch) < self.max_ops:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                async with self.lock:
+                    outcomes = await run_in_threadpool(self.run_batch, [op for op, _ in batch])
+            except Exception as error:
+                outcomes = [(False, error)] * len(batch)
+            for (_, future), (ok, value) in zip(batch, outcomes):
+                if future.done():
+                    continue  # the caller went away
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def run_batch(self, ops):
+        """Run ops in one transaction; returns (ok, result or exception) per op."""
+        outcomes = []
+        with self.session_factory() as db:
+            # pysqlite only opens a transaction before DML; without an explicit
+            # BEGIN the first SAVEPOINT would start one and its RELEASE commit it
+            db.connection().exec_driver_sql("BEGIN IMMEDIATE")
+            for op in ops:
+                try:
+                    with db.begin_nested():
+                        outcomes.append((True, op(db)))
+                except Exception as error:
+                    outcomes.append((False, error))
+            db.commit()
+        with self._stats_lock:
+            self.batches += 1
+            self.operations += len(ops)
+            self.failures += sum(1 for ok, _ in outcomes if not ok)
+        return outcomes
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "operations": self.operations,
+                "failures": self.failures,
+                "mean_batch_size": self.operations / self.batches if self.batches else 0.0,
+            }
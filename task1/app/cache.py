@@ -0,0 +1,93 @@
+"""Bounded in-process LRU cache with TTL expiry and tag-based invalidation.
+
+Entries carry tags naming the rows they were built from; writers invalidate by
+tag after committing. Readers note ``generation`` before loading from the
+database and pass it to ``set``: if any invalidation happened in between, the
+possibly stale value is dropped instead of cached.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._keys_by_tag = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= self.clock():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, tags=(), generation=None) -> bool:
+        if self.maxsize <= 0:
+            return False
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            tags = frozenset(tags)
+            self._entries[key] = (self.clock() + self.ttl, value, tags)
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            return True
+
+    def invalidate_tags(self, *tags):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
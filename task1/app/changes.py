@@ -0,0 +1,146 @@
+"""Change log: every committed entity write, in commit order.
+
+Writers queue the (entity, id) pairs they change with ``record_changes``. Just
+before the transaction commits, ``ChangeLog`` re-reads the queued rows through
+its ``states`` function and appends them to the ``changes`` table with their
+new state, so the log and the data commit together. A rolled back SAVEPOINT (a
+failed write in a batch) drops only what it queued.
+
+``read_changes`` replays the log in seq order after a cursor; a reader that is
+caught up can wait on ``ChangeLog.next_commit``, which the next commit that
+logs events resolves. ``compact_changes`` deletes a prefix of old events, after
+which a cursor pointing into the compacted range raises ``CursorCompacted``.
+"""
+import asyncio
+import contextlib
+import time
+from typing import Optional
+
+from sqlalchemy import delete, event, func, insert, select, text
+from sqlalchemy.orm import Session
+
+from app.models import ChangeDB
+
+# session.info keys of the writes queued in a session
+PENDING_KEYS = ("changes", "changes_written", "change_snapshots")
+
+
+class CursorCompacted(LookupError):
+    pass
+
+
+def record_changes(db: Session, entity: str, ids, op: Optional[str] = None):
+    """Queue ids for the change log; without an op, it is "update" or "delete" by whether the row survives."""
+    pending = db.info.setdefault("changes", {})
+    for entity_id in ids:
+        if entity_id is not None and pending.get((entity, entity_id)) != "create":
+            pending[(entity, entity_id)] = op
+
+
+class ChangeLog:
+    def __init__(self, states, encode):
+        self.states = states  # (session, entity, ids) -> {id: state} for the ids that still exist
+        self.encode = encode  # state -> JSON bytes
+        self._waiters = set()  # (event loop, future) for every reader waiting on the next commit
+
+    def listen(self, session_class=Session):
+        event.listen(session_class, "before_commit", self.write)
+        event.listen(session_class, "after_commit", self.wake)
+        event.listen(session_class, "after_transaction_create", self.snapshot_pending)
+        event.listen(session_class, "after_soft_rollback", self.drop_pending)
+
+    def write(self, db: Session):
+        pending = db.info.pop("changes", None)
+        if not pending:
+            return
+        db.flush()
+        ids_by_entity = {}
+        for entity, entity_id in pending:
+            ids_by_entity.setdefault(entity, []).append(entity_id)
+        states = {entity: self.states(db, entity, ids) for entity, ids in ids_by_entity.items()}
+        now = time.time()
+        rows = []
+        for (entity, entity_id), op in pending.items():
+            state = states[entity].get(entity_id)
+            if state is None:
+                if op == "create":
+                    continue  # created and deleted in the same transaction
+                op = "delete"
+            rows.append({
+                "entity": entity,
+                "entity_id": entity_id,
+                "op": op or "update",
+                "state": None if state is None else self.encode(state).decode(),
+                "created_at": now,
+            })
+        if rows:
+            db.execute(insert(ChangeDB), rows)
+            db.info["changes_written"] = True
+
+    def wake(self, db: Session):
+        db.info.pop("change_snapshots", None)
+        if db.info.pop("changes_written", False):
+            for loop, waiter in list(self._waiters):
+                loop.call_soon_threadsafe(lambda waiter=waiter: waiter.done() or waiter.set_result(None))
+
+    def snapshot_pending(self, db: Session, transaction):
+        if transaction.nested:
+            db.info.setdefault("change_snapshots", {})[transaction] = dict(db.info.get("changes", {}))
+
+    def drop_pending(self, db: Session, previous_transaction):
+        if previous_transaction.nested:
+            db.info["changes"] = db.info.get("change_snapshots", {}).pop(previous_transaction, {})
+            return
+        for key in PENDING_KEYS:
+            db.info.pop(key, None)
+
+    @contextlib.contextmanager
+    def next_commit(self):
+        """A future resolved by the next commit that logs events, for the duration of the block."""
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        self._waiters.add(waiter)
+        try:
+            yield waiter[1]
+        finally:
+            self._waiters.discard(waiter)
+
+
+def compaction_floor(db: Session) -> int:
+    """The highest seq that has been compacted away (0 if none has)."""
+    return db.execute(text(
+        "SELECT coalesce((SELECT min(seq) - 1 FROM changes),"
+        " (SELECT seq FROM sqlite_sequence WHERE name = 'changes'), 0)"
+    )).scalar()
+
+
+def read_changes(db: Session, after_seq: Optional[int], limit: int):
+    """(up to limit events after after_seq, or after the floor if None, and the seq of the last one)."""
+    floor = compaction_floor(db)
+    if after_seq is None:
+        after_seq = floor
+    elif after_seq < floor:
+        raise CursorCompacted(after_seq)
+    rows = db.execute(
+        select(ChangeDB.seq, ChangeDB.entity, ChangeDB.entity_id, ChangeDB.op, ChangeDB.state)
+        .where(ChangeDB.seq > after_seq).order_by(ChangeDB.seq).limit(limit)
+    ).all()
+    return rows, rows[-1].seq if rows else after_seq
+
+
+def change_events_json(rows) -> bytes:
+    # The stored state is already JSON, so it is spliced in rather than re-encoded
+    return ("[" + ",".join(
+        f'{{"seq":{row.seq},"entity":"{row.entity}","id":{row.entity_id},"op":"{row.op}","state":{row.state or "null"}}}'
+        for row in rows
+    ) + "]").encode()
+
+
+def compact_changes(db: Session, max_age: float, max_rows: int = 0) -> int:
+    """Delete events older than max_age seconds and all but the newest max_rows; returns the count."""
+    cutoff = db.execute(select(func.max(ChangeDB.seq)).where(ChangeDB.created_at < time.time() - max_age)).scalar() or 0
+    if max_rows:
+        newest = db.execute(select(func.max(ChangeDB.seq))).scalar() or 0
+        cutoff = max(cutoff, newest - max_rows)
+    # Deleting a seq prefix keeps the log gapless, so min(seq) - 1 is the compaction floor
+    return db.execute(delete(ChangeDB).where(ChangeDB.seq <= cutoff)).rowcount
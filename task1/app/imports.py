@@ -0,0 +1,253 @@
+"""Catalog import jobs: streaming row parsing, validation and progress reporting.
+
+``POST /imports`` (see "Catalog import" in app/main.py) spools the upload to a
+temporary file and hands it to ``ImportRunner.start``, which returns an
+``ImportJob`` and runs it as a background task: ``iter_rows`` reads the file
+one row at a time, and every ``chunk_size`` rows are validated on the
+threadpool and passed to the runner's ``write`` function, one transaction per
+chunk. Both formats yield the same fields:
+
+* CSV: a header row naming the columns (``id``, ``title``, ``description``,
+  ``price``, ``categories``); empty cells are left out and ``categories`` holds
+  category titles separated by ``|``;
+* NDJSON: one JSON object per line, ``categories`` being a list of titles.
+
+Rows that cannot be parsed or validated fail alone, with an error in the job's
+report; so does a chunk whose write fails. Jobs live in memory, and only the
+newest ``max_jobs`` finished ones are kept.
+"""
+import asyncio
+import csv
+import io
+import itertools
+import json
+import logging
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import exc, select
+from starlette.concurrency import run_in_threadpool
+
+from app.models import ShopItemCategoryDB
+
+FORMATS = ("csv", "ndjson")
+CATEGORY_SEPARATOR = "|"
+# Content-Type -> format, for uploads without ?format=
+CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+log = logging.getLogger(__name__)
+
+
+class RowError(NamedTuple):
+    line: int
+    error: str
+
+
+class ShopItemImportRow(BaseModel):
+    id: Optional[int] = None  # updates that shop item, or creates it with this id
+    title: str
+    description: Optional[str] = None
+    price: float
+    categories: List[str] = []  # category titles
+
+
+class ImportJob:
+    def __init__(self, job_id: int, format: str, size: int, max_errors: int = 1000):
+        self.id = job_id
+        self.format = format
+        self.size = size  # bytes uploaded
+        self.max_errors = max_errors
+        self.status = "queued"  # then "running", and "done" or "failed"
+        self.message: Optional[str] = None
+        self.bytes_read = 0
+        self.rows_read = 0
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []  # the first max_errors RowErrors
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    def start(self):
+        self.status = "running"
+        self.started_at = time.time()
+
+    def finish(self, message: Optional[str] = None):
+        self.status = "failed" if message else "done"
+        self.message = message
+        self.finished_at = time.time()
+
+    def add_errors(self, errors):
+        self.failed += len(errors)
+        self.errors += errors[:max(0, self.max_errors - len(self.errors))]
+
+    def report(self) -> dict:
+        elapsed = 0.0
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "id": self.id,
+            "format": self.format,
+            "status": self.status,
+            "message": self.message,
+            "bytes": self.size,
+            "bytes_read": self.bytes_read,
+            "progress": 1.0 if self.status == "done" else (self.bytes_read / self.size if self.size else 0.0),
+            "rows_read": self.rows_read,
+            "created": self.created,
+            "updated": self.updated,
+            "failed": self.failed,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_second": round(self.rows_read / elapsed, 1) if elapsed else 0.0,
+            "errors": [error._asdict() for error in self.errors],
+        }
+
+
+def iter_rows(raw, format: str):
+    """Yield (line, fields, error) for every row of the binary file raw; one of fields and error is None."""
+    if format == "csv":
+        # utf-8-sig drops the byte order mark spreadsheet exports start with
+        text = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+        reader = csv.DictReader(text)
+        line = 1
+        try:
+            for record in reader:
+                line = reader.line_num
+                if None in record:
+                    yield line, None, f"expected {len(reader.fieldnames)} columns, got more"
+                    continue
+                fields = {key: value for key, value in record.items() if value not in ("", None)}
+                if "categories" in fields:
+                    titles = fields["categories"].split(CATEGORY_SEPARATOR)
+                    fields["categories"] = [title.strip() for title in titles if title.strip()]
+                yield line, fields, None
+        except (csv.Error, UnicodeDecodeError) as error:
+            # A broken quote or encoding leaves the rest of the file unreadable
+            yield line + 1, None, f"unreadable CSV: {error}"
+        finally:
+            text.detach()
+        return
+    for line, data in enumerate(raw, start=1):
+        if not data.strip():
+            continue
+        try:
+            fields = json.loads(data.decode("utf-8-sig" if line == 1 else "utf-8"))
+        except ValueError as error:  # UnicodeDecodeError included
+            yield line, None, f"invalid JSON: {error}"
+            continue
+        if not isinstance(fields, dict):
+            yield line, None, "expected a JSON object"
+            continue
+        yield line, fields, None
+
+
+def load_category_titles(db) -> Dict[str, int]:
+    titles = {}
+    # The lowest id wins when titles repeat
+    rows = db.execute(select(ShopItemCategoryDB.id, ShopItemCategoryDB.title).order_by(ShopItemCategoryDB.id))
+    for cid, title in rows:
+        titles.setdefault(title, cid)
+    return titles
+
+
+def validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+
+
+def read_chunk(rows, raw, category_ids, size: int):
+    """Validate the next size rows into (accepted, errors, rows read, bytes read).
+
+    Accepted rows are (line, ShopItemImportRow, category ids) tuples.
+    """
+    accepted, errors, count = [], [], 0
+    for line, fields, error in itertools.islice(rows, size):
+        count += 1
+        if error is not None:
+            errors.append(RowError(line, error))
+            continue
+        try:
+            row = ShopItemImportRow(**fields)
+        except ValidationError as error:
+            errors.append(RowError(line, validation_message(error)))
+            continue
+        unknown = [title for title in row.categories if title not in category_ids]
+        if unknown:
+            errors.append(RowError(line, f"Unknown categories: {unknown}"))
+            continue
+        accepted.append((line, row, list(dict.fromkeys(category_ids[title] for title in row.categories))))
+    # Approximate: the CSV reader reads ahead
+    return accepted, errors, count, raw.tell()
+
+
+class ImportRunner:
+    def __init__(self, load_titles, write, chunk_size: int = 500, max_errors: int = 1000, max_jobs: int = 100):
+        self.load_titles = load_titles  # () -> {category title: id}, called on the threadpool as a job starts
+        self.write = write  # async (accepted rows) -> (created ids, updated ids), one transaction per call
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors  # row errors kept per job
+        self.max_jobs = max_jobs  # finished jobs kept
+        self.jobs = {}  # id -> ImportJob, oldest first
+        self._ids = itertools.count(1)
+        self._tasks = set()
+
+    def start(self, format: str, raw, size: int) -> ImportJob:
+        """Import the binary file raw, which the job closes when it finishes, in a background task."""
+        self.forget_finished()
+        job_id = next(self._ids)
+        job = self.jobs[job_id] = ImportJob(job_id, format, size, max_errors=self.max_errors)
+        task = asyncio.create_task(self.run(job, raw))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def cancel(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def run(self, job: ImportJob, raw):
+        job.start()
+        try:
+            category_ids = await run_in_threadpool(self.load_titles)
+            rows = iter_rows(raw, job.format)
+            while True:
+                accepted, errors, count, job.bytes_read = await run_in_threadpool(
+                    read_chunk, rows, raw, category_ids, self.chunk_size
+                )
+                if not count:
+                    break
+                job.rows_read += count
+                if accepted:
+                    try:
+                        created, updated = await self.write(accepted)
+                    except exc.SQLAlchemyError as error:
+                        # The chunk's transaction rolled back; the next chunk starts a new one
+                        errors += [RowError(line, f"not written: {error.__class__.__name__}") for line, _, _ in accepted]
+                    else:
+                        job.created += len(created)
+                        job.updated += len(updated)
+                job.add_errors(sorted(errors))
+            job.finish()
+        except asyncio.CancelledError:
+            job.finish("cancelled at shutdown")
+            raise
+        except Exception as error:
+            log.exception("import %s failed", job.id)
+            job.finish(f"{error.__class__.__name__}: {error}")
+        finally:
+            raw.close()
@@ -1,58 +1,155 @@
-from fastapi import FastAPI, HTTPException, Depends
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Table, Text, exc
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base, Session
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import delete, event, insert, literal, select, text, tuple_, union_all, update, exc
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker, selectinload, Session
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter
+from typing import Dict, List, NamedTuple, Optional
+import base64
+import asyncio
+import binascii
+import anyio
+import inspect
+import json
+import os
+import re
+import secrets
+import tempfile
 
-DATABASE_URL = "sqlite:///./shop.db"
+try:
+    import orjson
+except ImportError:  # only needed for SHOP_FAST_SERIALIZATION
+    orjson = None
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-# Association table for many-to-many relationship between ShopItem and ShopItemCategory
-shopitem_category = Table(
-    "shopitem_category",
-    Base.metadata,
-    Column("shopitem_id", Integer, ForeignKey("shop_items.id")),
-    Column("category_id", Integer, ForeignKey("categories.id")),
+from app.batching import WriteBatcher
+from app.changes import (
+    ChangeLog,
+    CursorCompacted,
+    change_events_json,
+    compact_changes,
+    read_changes,
+    record_changes,
+)
+from app.cache import LRUCache
+from app.metrics import MetricsRegistry, SQLMetricsMiddleware, instrument_engine
+from app.migrations import LATEST_VERSION, migrate, schema_version
+from app.models import (
+    CustomerDB,
+    EntityVersionDB,
+    OrderDB,
+    OrderItemDB,
+    SalesByCategoryDB,
+    SalesByCustomerDB,
+    SalesByShopItemDB,
+    ShopItemCategoryDB,
+    ShopItemDB,
+    shopitem_category,
+)
+from app.profiling import Profiler, ProfilingMiddleware, run_in_context
+from app import rollups
+from app.imports import (
+    CONTENT_TYPES as IMPORT_CONTENT_TYPES,
+    FORMATS as IMPORT_FORMATS,
+    ImportRunner,
+    load_category_titles,
 )
+from app.singleflight import SingleFlight, SingleFlightMiddleware
+from app.snapshots import OrderSnapshots, mark_order_snapshots, read_order_snapshot
+from app.storage import StorageProfile, create_reader_engine, create_writer_engine
+
+DATABASE_PATH = os.getenv("SHOP_DATABASE_PATH", "shop.db")
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
+
+# "sync" runs handlers on the threadpool with SessionLocal; "async" runs them on
+# the event loop with an AsyncSession over aiosqlite
+DB_MODE = os.getenv("SHOP_DB_MODE", "sync")
+if DB_MODE not in ("sync", "async"):
+    raise RuntimeError(f"SHOP_DB_MODE must be 'sync' or 'async', not {DB_MODE!r}")
+
+# "1" serves order and order item responses from Core rows encoded with orjson,
+# skipping ORM object loading and Pydantic validation
+FAST_SERIALIZATION = os.getenv("SHOP_FAST_SERIALIZATION", "0") == "1"
+if FAST_SERIALIZATION and orjson is None:
+    raise RuntimeError("SHOP_FAST_SERIALIZATION=1 requires orjson (pip install orjson)")
+
+# Keyset pagination bounds for the list endpoints
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+# Rows fetched per round trip and encoded per flushed chunk by the export endpoints
+EXPORT_CHUNK_SIZE = 500
+
+# Largest array accepted by the bulk create endpoints
+MAX_BULK_ROWS = 5000
+
+# Catalog imports: rows validated and written per transaction, row errors kept per
+# job, and finished jobs kept for GET /imports/{id}
+IMPORT_CHUNK_SIZE = 500
+MAX_IMPORT_ERRORS = 1000
+MAX_IMPORT_JOBS = 100
+
+# Serialized shop item/category responses kept in memory (0 disables the cache)
+CATALOG_CACHE_SIZE = int(os.getenv("SHOP_CATALOG_CACHE_SIZE", "10000"))
+CATALOG_CACHE_TTL = float(os.getenv("SHOP_CATALOG_CACHE_TTL", "300"))
+
+# Statements taking at least this long are logged with their route (0 disables the log)
+SLOW_QUERY_MS = float(os.getenv("SHOP_SLOW_QUERY_MS", "0"))
+
+# Group commit for the high-rate create endpoints (customers, order items, orders):
+# writes arriving within SHOP_WRITE_BATCH_WINDOW_MS of each other, up to
+# SHOP_WRITE_BATCH_SIZE of them, share one transaction (0, the default, commits each alone)
+WRITE_BATCH_SIZE = int(os.getenv("SHOP_WRITE_BATCH_SIZE", "0"))
+WRITE_BATCH_WINDOW_MS = float(os.getenv("SHOP_WRITE_BATCH_WINDOW_MS", "2"))
+
+# Change log retention: events older than CHANGES_RETENTION seconds, and all but the
+# newest CHANGES_MAX_ROWS (0 keeps all), are compacted every CHANGES_COMPACT_INTERVAL
+# seconds (0 disables compaction)
+CHANGES_RETENTION = float(os.getenv("SHOP_CHANGES_RETENTION", str(7 * 24 * 3600)))
+CHANGES_MAX_ROWS = int(os.getenv("SHOP_CHANGES_MAX_ROWS", "0"))
+CHANGES_COMPACT_INTERVAL = float(os.getenv("SHOP_CHANGES_COMPACT_INTERVAL", "300"))
+
+# "0" stops concurrent identical GET /shop_items/{id} and /orders/{oid} requests
+# from sharing one in-flight load
+SINGLE_FLIGHT = os.getenv("SHOP_SINGLE_FLIGHT", "1") == "1"
+
+# /admin endpoints require this token in an X-Admin-Token header; unset, they answer 404
+ADMIN_TOKEN = os.getenv("SHOP_ADMIN_TOKEN", "")
+
+# Fraction of requests to every endpoint profiled from startup (0 leaves profiling off
+# until it is configured through PUT /admin/profiling) and the stack sampling interval
+PROFILE_FRACTION = float(os.getenv("SHOP_PROFILE_FRACTION", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("SHOP_PROFILE_INTERVAL_MS", "5"))
+
+# Longest a GET /changes request may wait for new events, in seconds
+MAX_CHANGES_WAIT = 60
 
-class CustomerDB(Base):
-    __tablename__ = "customers"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    surname = Column(String, nullable=False)
-    email = Column(String, unique=True, nullable=False)
-
-class ShopItemCategoryDB(Base):
-    __tablename__ = "categories"
-    id = Column(Integer, primary_key=True, index=True)
-    title = Column(String, nullable=False)
-    description = Column(Text, nullable=True)
-
-class ShopItemDB(Base):
-    __tablename__ = "shop_items"
-    id = Column(Integer, primary_key=True, index=True)
-    title = Column(String, nullable=False)
-    description = Column(Text, nullable=True)
-    price = Column(Float, nullable=False)
-    categories = relationship("ShopItemCategoryDB", secondary=shopitem_category, backref="shop_items")
-
-class OrderItemDB(Base):
-    __tablename__ = "order_items"
-    id = Column(Integer, primary_key=True, index=True)
-    shop_item_id = Column(Integer, ForeignKey("shop_items.id"))
-    quantity = Column(Integer, nullable=False)
-    shop_item = relationship("ShopItemDB")
-    order_id = Column(Integer, ForeignKey("orders.id"))  # <-- Add this line
-
-class OrderDB(Base):
-    __tablename__ = "orders"
-    id = Column(Integer, primary_key=True, index=True)
-    customer_id = Column(Integer, ForeignKey("customers.id"))
-    customer = relationship("CustomerDB")
-    items = relationship("OrderItemDB", cascade="all, delete-orphan", backref="order")  # <-- Add backref
+# SQLite pragmas and pool sizes, overridable through SHOP_SQLITE_* variables
+STORAGE_PROFILE = StorageProfile.from_env()
+
+# Mutations use the single-connection writer engine, GET requests the read-only pool
+engine = create_writer_engine(DATABASE_URL, STORAGE_PROFILE, connect_args={"check_same_thread": False})
+read_engine = create_reader_engine(DATABASE_URL, STORAGE_PROFILE, connect_args={"check_same_thread": False})
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+if DB_MODE == "async":
+    async_engine = create_writer_engine(ASYNC_DATABASE_URL, STORAGE_PROFILE, create_async_engine)
+    async_read_engine = create_reader_engine(ASYNC_DATABASE_URL, STORAGE_PROFILE, create_async_engine)
+else:
+    async_engine = async_read_engine = None
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False)
+AsyncReadSessionLocal = async_sessionmaker(async_read_engine, autoflush=False)
+
+# The sync engines every statement ultimately runs through, for event listeners
+ENGINES = [engine, read_engine]
+if async_engine is not None:
+    ENGINES += [async_engine.sync_engine, async_read_engine.sync_engine]
+for _engine in ENGINES:
+    instrument_engine(_engine, slow_query_seconds=SLOW_QUERY_MS / 1000)
 
 # Pydantic Schemas
 class CustomerBase(BaseModel):
@@ -95,12 +192,21 @@ class ShopItem(ShopItemBase):
     class Config:
         orm_mode = True
 
+class CategoryFacet(BaseModel):
+    category_id: int
+    count: int
+
+class ShopItemSearchResult(BaseModel):
+    total: int
+    items: List[ShopItem]
+    facets: List[CategoryFacet]
+
 class OrderItemBase(BaseModel):
     shop_item_id: int
     quantity: int
 
 class OrderItemCreate(OrderItemBase):
-    pass
+    quantity: int = Field(gt=0)
 
 class OrderItem(OrderItemBase):
     id: int
@@ -115,6 +221,19 @@ class OrderBase(BaseModel):
 class OrderCreate(OrderBase):
     pass
 
+class OrderPatch(BaseModel):
+    customer_id: Optional[int] = None
+    add_item_ids: List[int] = []
+    remove_item_ids: List[int] = []
+
+class OrderLine(BaseModel):
+    shop_item_id: int
+    quantity: int = Field(gt=0)
+
+class OrderPlace(BaseModel):
+    customer_id: int
+    lines: List[OrderLine]
+
 class Order(OrderBase):
     id: int
     customer: Customer
@@ -122,37 +241,918 @@ class Order(OrderBase):
     class Config:
         orm_mode = True
 
+class CategoryRevenue(BaseModel):
+    category_id: int
+    title: str
+    shop_items: int
+    units: int
+    revenue: float
+
+class ShopItemSales(BaseModel):
+    shop_item_id: int
+    title: str
+    orders: int
+    units: int
+    revenue: float
+
+class CustomerSpend(BaseModel):
+    customer_id: int
+    name: str
+    surname: str
+    orders: int
+    units: int
+    spend: float
+
+class ProfilingSettings(BaseModel):
+    fraction: Optional[float] = Field(None, ge=0, le=1)  # for endpoints without their own
+    fractions: Optional[Dict[str, float]] = None  # endpoint function name -> fraction; replaces the current map
+    interval_ms: Optional[float] = Field(None, gt=0, le=1000)
+
+class BulkRowResult(BaseModel):
+    index: int
+    id: Optional[int] = None
+    error: Optional[str] = None
+
 # FastAPI app
 app = FastAPI()
 
-def get_db():
-    db = SessionLocal()
+# --- Single flight ---
+# Concurrent GETs of the same shop item or order (same query string, no
+# If-None-Match) share one in-flight request: the first runs the handler, the
+# rest wait for it and get a copy of its response without opening a session.
+# Committed writes forget the keys they bumped (see bump_versions), so requests
+# arriving after a write never join a load that started before it. Registered
+# before the metrics middleware so it runs inside it and coalesced requests are
+# still measured.
+single_flight = SingleFlight()
+if SINGLE_FLIGHT:
+    app.add_middleware(SingleFlightMiddleware, flights=single_flight, routes={
+        r"/shop_items/(\d+)": "shop_items:{}",
+        r"/orders/(\d+)": "orders:{}",
+    })
+
+@app.get("/single_flight/stats")
+def get_single_flight_stats():
+    return single_flight.stats()
+
+# --- Profiling ---
+# A sampled fraction of requests, set per endpoint function, is profiled by a
+# stack-sampling thread (see app/profiling.py), covering the handler, the ORM and
+# response serialization whichever thread they run on. Samples are aggregated
+# per endpoint and downloaded as collapsed stacks for flame graph tools. With
+# every fraction at 0 the middleware passes requests straight through.
+profiler = Profiler(PROFILE_FRACTION, PROFILE_INTERVAL_MS / 1000)
+app.add_middleware(ProfilingMiddleware, profiler=profiler, router=app.router)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+def endpoint_names():
+    return {route.endpoint.__name__ for route in app.routes if isinstance(route, APIRoute)}
+
+@app.get("/admin/profiling", dependencies=[Depends(require_admin)])
+def get_profiling():
+    return profiler.stats()
+
+@app.put("/admin/profiling", dependencies=[Depends(require_admin)])
+def configure_profiling(settings: ProfilingSettings):
+    if settings.fractions is not None:
+        unknown = sorted(set(settings.fractions) - endpoint_names())
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown endpoints: {unknown}")
+        if any(not 0 <= f <= 1 for f in settings.fractions.values()):
+            raise HTTPException(status_code=400, detail="Fractions must be between 0 and 1")
+    profiler.configure(
+        settings.fraction,
+        settings.fractions,
+        settings.interval_ms / 1000 if settings.interval_ms is not None else None,
+    )
+    return profiler.stats()
+
+@app.get("/admin/profiling/stacks", dependencies=[Depends(require_admin)])
+def get_profile_stacks(endpoint: Optional[str] = None):
+    """Collapsed stacks (`frame;frame;frame samples` lines) for flamegraph.pl or speedscope."""
+    return Response(content=profiler.collapsed(endpoint), media_type="text/plain")
+
+@app.delete("/admin/profiling/stacks", dependencies=[Depends(require_admin)])
+def clear_profile_stacks():
+    profiler.clear()
+    return {"ok": True}
+
+# --- Metrics ---
+# Every request records its latency and the count, duration and rows of the SQL
+# it ran, per route template. The totals are returned in a Server-Timing header
+# and accumulated for /metrics in the Prometheus text format.
+metrics = MetricsRegistry()
+app.add_middleware(SQLMetricsMiddleware, registry=metrics)
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Requests that may write hold writer_lock until their session is closed, so
+# writers queue on the event loop instead of parking threadpool workers on the
+# writer engine's single connection.
+READ_METHODS = ("GET", "HEAD")
+writer_lock = anyio.Lock()
+
+async def session_role(request: Request):
+    if request.method in READ_METHODS:
+        yield "read"
+    else:
+        async with writer_lock:
+            yield "write"
+
+def get_db(role: str = Depends(session_role)):
+    db = ReadSessionLocal() if role == "read" else SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+async def get_async_db(role: str = Depends(session_role)):
+    async with (AsyncReadSessionLocal() if role == "read" else AsyncSessionLocal()) as db:
+        yield db
+
+# --- Async mode ---
+# In async mode every route that depends on get_db is registered as an async def
+# endpoint that depends on get_async_db instead. The handler body runs inside
+# AsyncSession.run_sync, so its ORM calls are awaited over aiosqlite on the event
+# loop rather than blocking a threadpool worker. The result is validated against
+# the response model before leaving run_sync, so any lazy loads the serializer
+# needs also happen there.
+def with_async_session(endpoint, response_model):
+    signature = inspect.signature(endpoint)
+    if "db" not in signature.parameters or inspect.iscoroutinefunction(endpoint):
+        return endpoint
+    adapter = TypeAdapter(response_model) if response_model is not None else None
+
+    def call(session, args, kwargs):
+        result = endpoint(*args, db=session, **kwargs)
+        if adapter is not None and not isinstance(result, Response):
+            result = adapter.validate_python(result, from_attributes=True)
+        return result
+
+    async def endpoint_async(*args, **kwargs):
+        db = kwargs.pop("db")
+        # The greenlet run_sync uses is invisible from the loop's stack; run_in_context lets the profiler attribute it
+        return await db.run_sync(lambda session: run_in_context(call, session, args, kwargs))
+
+    endpoint_async.__name__ = endpoint.__name__
+    endpoint_async.__qualname__ = endpoint.__qualname__
+    endpoint_async.__doc__ = endpoint.__doc__
+    endpoint_async.__signature__ = signature.replace(parameters=[
+        param.replace(annotation=AsyncSession, default=Depends(get_async_db)) if param.name == "db" else param
+        for param in signature.parameters.values()
+    ])
+    return endpoint_async
+
+class AsyncSessionRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        response_model = kwargs.get("response_model")
+        if isinstance(response_model, DefaultPlaceholder):
+            response_model = response_model.value
+        super().__init__(path, with_async_session(endpoint, response_model), **kwargs)
+
+if DB_MODE == "async":
+    app.router.route_class = AsyncSessionRoute
+
+# --- Write batching ---
+# The create endpoints hand their work to run_write as a function of a session
+# that returns the response body. Normally it runs in a transaction of its own
+# under writer_lock; with SHOP_WRITE_BATCH_SIZE set it is queued for the group
+# commit worker (see app/batching.py), which gives every operation its own
+# SAVEPOINT, so a duplicate email still fails only its own request.
+write_batcher = (
+    WriteBatcher(SessionLocal, writer_lock, window=WRITE_BATCH_WINDOW_MS / 1000, max_ops=WRITE_BATCH_SIZE)
+    if WRITE_BATCH_SIZE > 0 else None
+)
+
+def commit_write(db: Session, op):
+    result = op(db)
+    db.commit()
+    return result
+
+def commit_write_sync(op):
+    with SessionLocal() as db:
+        return commit_write(db, op)
+
+async def run_write(op):
+    """Run op(session) and commit, sharing the transaction with concurrent writes when batching."""
+    if write_batcher is not None:
+        return await write_batcher.submit(op)
+    async with writer_lock:
+        if DB_MODE == "async":
+            async with AsyncSessionLocal() as db:
+                return await db.run_sync(commit_write, op)
+        return await run_in_threadpool(commit_write_sync, op)
+
+@app.get("/write_batcher/stats")
+def write_batcher_stats():
+    if write_batcher is None:
+        return {"enabled": False}
+    return {"enabled": True, **write_batcher.stats()}
+
+@app.on_event("shutdown")
+async def stop_write_batcher():
+    if write_batcher is not None:
+        await write_batcher.close()
+
+# --- Keyset pagination ---
+# List endpoints page by primary key: "WHERE id > :after_id ORDER BY id LIMIT :n"
+# walks the primary-key index, so a deep page costs the same as the first one.
+# The cursor for the next page is returned in the X-Next-Cursor header, which
+# keeps the response bodies plain lists. A list filtered on a range of another
+# indexed column pages by (that column, id) instead, with the last row's value in
+# the cursor, so a page reads page-size entries of that column's index rather
+# than sorting the whole range by id.
+class Page(NamedTuple):
+    after_id: Optional[int]
+    limit: int
+    after_value: Optional[float] = None  # the after_id row's value of the column paged by first, if any
+
+def encode_cursor(last_id: int, last_value: Optional[float] = None) -> str:
+    keys = {"after_id": last_id} if last_value is None else {"after_id": last_id, "after_value": last_value}
+    raw = json.dumps(keys).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor_keys(cursor: str):
+    """(after_id, after_value or None) of a cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        keys = json.loads(raw)
+        after_id, after_value = keys["after_id"], keys.get("after_value")
+    except (binascii.Error, ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(after_id, int) or isinstance(after_value, bool) or not isinstance(after_value, (int, float, type(None))):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return after_id, after_value
+
+def decode_cursor(cursor: str) -> int:
+    return decode_cursor_keys(cursor)[0]
+
+def page_params(
+    after_id: Optional[int] = Query(None, ge=0),
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+):
+    after_value = None
+    if cursor is not None:
+        after_id, after_value = decode_cursor_keys(cursor)
+    return Page(after_id=after_id, limit=limit, after_value=after_value)
+
+def keyset(query, column, page: Page, sort_column=None):
+    """Order by column (by sort_column, then column, if given) and start after the page's row."""
+    if sort_column is None:
+        if page.after_id is not None:
+            query = query.filter(column > page.after_id)
+        # Fetch one extra row to learn whether another page exists
+        return query.order_by(column).limit(page.limit + 1)
+    if page.after_id is not None:
+        after_value = page.after_value
+        if after_value is None:
+            # A bare ?after_id= continues from that row's current value
+            after_value = select(sort_column).where(column == page.after_id).correlate(None).scalar_subquery()
+        query = query.filter(tuple_(sort_column, column) > tuple_(after_value, page.after_id))
+    return query.order_by(sort_column, column).limit(page.limit + 1)
+
+def split_page(rows, page: Page, sort_field: Optional[str] = None):
+    """(the page's rows, the next page's cursor or None); sort_field names the sort_column keyset paged by."""
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        last = rows[-1]
+        return rows, encode_cursor(last.id, getattr(last, sort_field) if sort_field else None)
+    return rows, None
+
+def page_rows(rows, page: Page, response: Response):
+    rows, cursor = split_page(rows, page)
+    if cursor is not None:
+        response.headers["X-Next-Cursor"] = cursor
+    return rows
+
+# --- Bulk loading ---
+# Bulk endpoints validate the whole array up front, check it against the
+# database with one IN-query per lookup, and insert the accepted rows with a
+# single executemany in one transaction. Rejected rows are reported by index.
+def check_bulk_size(rows):
+    if len(rows) > MAX_BULK_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_ROWS} rows per request")
+
+def bulk_insert(db: Session, model, rows):
+    if not rows:
+        return []
+    stmt = insert(model).returning(model.id, sort_by_parameter_order=True)
+    return db.execute(stmt, rows).scalars().all()
+
+def bulk_results(count, ids_by_index, errors_by_index):
+    return [
+        BulkRowResult(index=i, id=ids_by_index.get(i), error=errors_by_index.get(i))
+        for i in range(count)
+    ]
+
+# --- Sparse fieldsets ---
+# ?fields= and ?include= turn an entity response into a projection of the full
+# one. Each level of the response selects only the columns it returns (plus the
+# keys needed to attach related rows), and a relation is queried only when it is
+# included, so ?fields=id,items.quantity on orders costs two narrow SELECTs
+# instead of five wide ones. Dotted names address included relations, and
+# naming a relation in either parameter includes it; a level with no fields
+# listed returns all of its fields.
+class Relation(NamedTuple):
+    resource: "Resource"
+    parent_key: str    # parent column identifying the related rows
+    child_key: object  # column of the related rows (or link table) matched against it
+    many: bool
+    link: Optional[tuple] = None  # (table, onclause) joined in for many-to-many relations
+
+class Resource(NamedTuple):
+    name: str
+    model: type
+    fields: tuple        # response fields, in schema order
+    columns: tuple       # fields read straight from model columns
+    computed: dict       # field -> loader(db, ids) returning {id: value}, default []
+    relations: dict      # relation name -> Relation, in schema order
+
+class Fieldset(NamedTuple):
+    fields: tuple
+    includes: tuple      # (relation name, Fieldset) pairs
+
+def load_item_ids(db: Session, order_ids):
+    item_ids = {}
+    rows = db.execute(
+        select(OrderItemDB.order_id, OrderItemDB.id).where(OrderItemDB.order_id.in_(order_ids)).order_by(OrderItemDB.id)
+    )
+    for order_id, item_id in rows:
+        item_ids.setdefault(order_id, []).append(item_id)
+    return item_ids
+
+CUSTOMER_RESOURCE = Resource("customer", CustomerDB, ("name", "surname", "email", "id"),
+                             ("name", "surname", "email", "id"), {}, {})
+CATEGORY_RESOURCE = Resource("category", ShopItemCategoryDB, ("title", "description", "id"),
+                             ("title", "description", "id"), {}, {})
+SHOP_ITEM_RESOURCE = Resource(
+    "shop_item", ShopItemDB, ("title", "description", "price", "category_ids", "id"),
+    ("title", "description", "price", "id"),
+    # category_ids is input-only and always serialized empty
+    {"category_ids": lambda db, ids: {}},
+    {"categories": Relation(
+        CATEGORY_RESOURCE, "id", shopitem_category.c.shopitem_id, many=True,
+        link=(shopitem_category, shopitem_category.c.category_id == ShopItemCategoryDB.id),
+    )},
+)
+ORDER_ITEM_RESOURCE = Resource(
+    "order_item", OrderItemDB, ("shop_item_id", "quantity", "id"), ("shop_item_id", "quantity", "id", "order_id"), {},
+    {"shop_item": Relation(SHOP_ITEM_RESOURCE, "shop_item_id", ShopItemDB.id, many=False)},
+)
+ORDER_RESOURCE = Resource(
+    "order", OrderDB, ("customer_id", "item_ids", "id"), ("customer_id", "id"), {"item_ids": load_item_ids},
+    {
+        "customer": Relation(CUSTOMER_RESOURCE, "customer_id", CustomerDB.id, many=False),
+        "items": Relation(ORDER_ITEM_RESOURCE, "id", OrderItemDB.order_id, many=True),
+    },
+)
+
+def split_names(value: Optional[str]):
+    return [name.strip() for name in (value or "").split(",") if name.strip()]
+
+def parse_fieldset(resource: Resource, fields: Optional[str], include: Optional[str]) -> Optional[Fieldset]:
+    """The requested projection of resource, or None for the full response."""
+    if fields is None and include is None:
+        return None
+    tree = {}  # relation path -> requested field names at that level
+
+    def walk(path):
+        level, target = (), resource
+        for name in path:
+            if name not in target.relations:
+                raise HTTPException(status_code=400, detail=f"Unknown relation {name!r} on {target.name}")
+            level += (name,)
+            tree.setdefault(level, set())
+            target = target.relations[name].resource
+        return target
+
+    tree[()] = set()
+    for path in split_names(include):
+        walk(path.split("."))
+    for path in split_names(fields):
+        *relations, name = path.split(".")
+        target = walk(relations)
+        if name in target.relations:
+            walk(relations + [name])
+        elif name in target.fields:
+            tree[tuple(relations)].add(name)
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown field {name!r} on {target.name}")
+
+    def build(target, level):
+        requested = tree[level]
+        return Fieldset(
+            fields=tuple(f for f in target.fields if f in requested) or target.fields,
+            includes=tuple(
+                (name, build(relation.resource, level + (name,)))
+                for name, relation in target.relations.items() if level + (name,) in tree
+            ),
+        )
+    return build(resource, ())
+
+def fieldset_params(resource: Resource):
+    def dependency(fields: Optional[str] = None, include: Optional[str] = None):
+        return parse_fieldset(resource, fields, include)
+    return dependency
+
+def sparse_columns(resource: Resource, fieldset: Fieldset):
+    needed = {"id"} | set(fieldset.fields) | {resource.relations[name].parent_key for name, _ in fieldset.includes}
+    return [getattr(resource.model, column) for column in resource.columns if column in needed]
+
+def sparse_select(resource: Resource, fieldset: Fieldset):
+    return select(*sparse_columns(resource, fieldset))
+
+def sparse_objects(db: Session, resource: Resource, fieldset: Fieldset, rows):
+    """Response dicts for rows selected with sparse_select, relations included."""
+    if not rows:
+        return []
+    ids = [row.id for row in rows]
+    computed = {field: resource.computed[field](db, ids) for field in fieldset.fields if field in resource.computed}
+    related = {}
+    for name, sub in fieldset.includes:
+        relation = resource.relations[name]
+        keys = {row._mapping[relation.parent_key] for row in rows} - {None}
+        related[name] = load_related(db, relation, keys, sub)
+    objects = []
+    for row in rows:
+        values = row._mapping
+        obj = {
+            field: computed[field].get(row.id, []) if field in computed else values[field]
+            for field in fieldset.fields
+        }
+        for name, _ in fieldset.includes:
+            relation = resource.relations[name]
+            obj[name] = related[name].get(values[relation.parent_key], [] if relation.many else None)
+        objects.append(obj)
+    return objects
+
+def load_related(db: Session, relation: Relation, keys, fieldset: Fieldset):
+    if not keys:
+        return {}
+    resource = relation.resource
+    query = select(relation.child_key.label("parent_key"), *sparse_columns(resource, fieldset))
+    if relation.link is not None:
+        query = query.join_from(relation.link[0], resource.model, relation.link[1])
+    rows = db.execute(query.where(relation.child_key.in_(keys)).order_by(relation.child_key, resource.model.id)).all()
+    related = {}
+    for row, obj in zip(rows, sparse_objects(db, resource, fieldset, rows)):
+        if relation.many:
+            related.setdefault(row.parent_key, []).append(obj)
+        else:
+            related[row.parent_key] = obj
+    return related
+
+def sparse_tags(rows, fieldset: Fieldset):
+    """Catalog cache tags for sparse shop items: their rows, and categories if embedded."""
+    tags = {f"shop_item:{row.id}" for row in rows}
+    if any(name == "categories" for name, _ in fieldset.includes):
+        tags.add("categories")
+    return tags
+
+def dump_json(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+def json_response(content, response: Response) -> Response:
+    # Returning a Response bypasses the injected one, so carry its headers over
+    return Response(content=dump_json(content), media_type="application/json", headers=response.headers)
+
+# --- Catalog cache ---
+# Shop item and category reads are served from serialized JSON kept in
+# catalog_cache, so a hit touches neither the database nor Pydantic. Entries are
+# tagged with every shop_item:<id>/category:<id> they embed; mutations invalidate
+# those tags after committing, which also drops items whose categories changed.
+catalog_cache = LRUCache(maxsize=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL)
+
+SHOP_ITEM_JSON = TypeAdapter(ShopItem)
+SHOP_ITEM_LIST_JSON = TypeAdapter(List[ShopItem])
+CATEGORY_JSON = TypeAdapter(ShopItemCategory)
+CATEGORY_LIST_JSON = TypeAdapter(List[ShopItemCategory])
+ORDER_JSON = TypeAdapter(Order)
+
+class CachedBody(NamedTuple):
+    body: bytes
+    tags: frozenset
+    headers: dict
+
+def to_json(adapter: TypeAdapter, value) -> bytes:
+    return adapter.dump_json(adapter.validate_python(value, from_attributes=True))
+
+def shop_item_tags(item: ShopItemDB):
+    return {f"shop_item:{item.id}"} | {f"category:{c.id}" for c in item.categories}
+
+def category_tags(category: ShopItemCategoryDB):
+    return {f"category:{category.id}"}
+
+def catalog_response(request: Request, db: Session, key, version_key: str, build):
+    # A cached entry keeps the ETag it was built under: both are dropped by the
+    # same invalidation, so a hit needs no version lookup either.
+    entry = catalog_cache.get(key)
+    status = "HIT"
+    if entry is None:
+        status = "MISS"
+        generation = catalog_cache.generation
+        etag = entity_etag(db, version_key)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        entry = build()
+        entry = entry._replace(headers={**entry.headers, "ETag": etag})
+        catalog_cache.set(key, entry, entry.tags, generation)
+    elif etag_matches(request, entry.headers["ETag"]):
+        return not_modified(entry.headers["ETag"])
+    return Response(
+        content=entry.body,
+        media_type="application/json",
+        headers={**entry.headers, "X-Cache": status},
+    )
+
+def invalidate_shop_items(*item_ids):
+    catalog_cache.invalidate_tags("shop_items", *(f"shop_item:{i}" for i in item_ids))
+
+def invalidate_categories(*category_ids):
+    catalog_cache.invalidate_tags("categories", *(f"category:{i}" for i in category_ids))
+
+@app.get("/catalog_cache/stats")
+def catalog_cache_stats():
+    return catalog_cache.stats()
+
+# --- Entity versions ---
+# Every write bumps the version of the rows it changes, of the tables they live
+# in, and of every row whose response embeds them (a category change bumps its
+# shop items, their order items and their orders). GET endpoints derive their
+# ETag from these versions, so If-None-Match can be answered with a single
+# primary-key lookup on entity_versions before any rows are loaded. Unless
+# record=False, the rows a write changes directly (not the ones that embed them)
+# are also queued for the change log, and every touched row marks the sales
+# rollups it feeds for a refresh and, once committed, ends single-flight sharing
+# of its in-flight reads.
+# One cached single-row statement run as an executemany: a multi-row VALUES
+# list would be compiled afresh for every batch size
+BUMP_VERSION = sqlite_insert(EntityVersionDB.__table__).values(version=1).on_conflict_do_update(
+    index_elements=[EntityVersionDB.key],
+    set_={"version": EntityVersionDB.version + 1},
+)
+
+def bump_versions(db: Session, table: str, ids):
+    ids = set(ids) - {None}
+    if not ids:
+        # No row changed, so neither did the table: list ETags stay valid
+        return
+    keys = [table] + [f"{table}:{i}" for i in ids]
+    db.info.setdefault("bumped_keys", set()).update(keys)
+    db.execute(BUMP_VERSION, [{"key": key} for key in keys])
+
+# Committed versions are current, so in-flight reads of those keys stop taking followers
+@event.listens_for(Session, "after_commit")
+def forget_in_flight_reads(db: Session):
+    keys = db.info.pop("bumped_keys", None)
+    if keys:
+        single_flight.forget(*keys)
+
+# A rolled back transaction leaves nothing to refresh or forget; a rolled back
+# SAVEPOINT keeps what it marked, since refreshing more than needed is harmless
+@event.listens_for(Session, "after_soft_rollback")
+def drop_pending_refreshes(db: Session, previous_transaction):
+    if not previous_transaction.nested:
+        for key in ("rollups", "rollup_keys", "bumped_keys"):
+            db.info.pop(key, None)
+
+def touch_orders(db: Session, order_ids, record=True):
+    order_ids = set(order_ids) - {None}
+    if not order_ids:
+        return
+    bump_versions(db, "orders", order_ids)
+    mark_rollups(db, "orders", order_ids)
+    mark_order_snapshots(db, order_ids)
+    if record:
+        record_changes(db, "orders", order_ids)
+
+def touch_order_items(db: Session, order_item_ids, order_ids=(), record=True):
+    order_item_ids = set(order_item_ids) - {None}
+    if not order_item_ids:
+        touch_orders(db, order_ids, record)
+        return
+    bump_versions(db, "order_items", order_item_ids)
+    mark_rollups(db, "order_items", order_item_ids)
+    owners = db.execute(
+        select(OrderItemDB.order_id).where(OrderItemDB.id.in_(order_item_ids))
+    ).scalars()
+    # Moving an item changes the item_ids of the orders it leaves and joins
+    touch_orders(db, set(owners) | set(order_ids), record)
+    if record:
+        record_changes(db, "order_items", order_item_ids)
+
+def touch_shop_items(db: Session, item_ids, record=True):
+    item_ids = set(item_ids) - {None}
+    if not item_ids:
+        return
+    bump_versions(db, "shop_items", item_ids)
+    mark_rollups(db, "shop_items", item_ids)
+    order_item_ids = db.execute(
+        select(OrderItemDB.id).where(OrderItemDB.shop_item_id.in_(item_ids))
+    ).scalars().all()
+    touch_order_items(db, order_item_ids, record=False)
+    if record:
+        record_changes(db, "shop_items", item_ids)
+
+def touch_categories(db: Session, category_ids, record=True):
+    category_ids = set(category_ids) - {None}
+    if not category_ids:
+        return
+    bump_versions(db, "categories", category_ids)
+    mark_rollups(db, "categories", category_ids)
+    item_ids = db.execute(
+        select(shopitem_category.c.shopitem_id).where(shopitem_category.c.category_id.in_(category_ids))
+    ).scalars().all()
+    touch_shop_items(db, item_ids, record=False)
+    if record:
+        record_changes(db, "categories", category_ids)
+
+def touch_customers(db: Session, customer_ids, record=True):
+    customer_ids = set(customer_ids) - {None}
+    if not customer_ids:
+        return
+    bump_versions(db, "customers", customer_ids)
+    mark_rollups(db, "customers", customer_ids)
+    order_ids = db.execute(
+        select(OrderDB.id).where(OrderDB.customer_id.in_(customer_ids))
+    ).scalars().all()
+    touch_orders(db, order_ids, record=False)
+    if record:
+        record_changes(db, "customers", customer_ids)
+
+def entity_etag(db: Session, *keys) -> str:
+    versions = dict(db.query(EntityVersionDB.key, EntityVersionDB.version).filter(EntityVersionDB.key.in_(keys)).all())
+    return '"' + ".".join(f"{key}:{versions.get(key, 0)}" for key in keys) + '"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or etag in tags
+
+def not_modified(etag: str):
+    return Response(status_code=304, headers={"ETag": etag})
+
+def conditional_get(request: Request, response: Response, db: Session, *keys):
+    """Return a 304 response if the client's tag is current, else tag the response."""
+    etag = entity_etag(db, *keys)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    return None
+
+# --- Change log ---
+# Every write appends the rows it changes, with their new state, to the changes
+# table in the same transaction (see app/changes.py); the state is the resource's
+# full sparse projection. GET /changes replays the log in seq order from a
+# cursor, optionally waiting for the next commit when it is caught up. Old events
+# are compacted in the background; a cursor that points into the compacted range
+# gets 410 Gone.
+def load_category_ids(db: Session, item_ids):
+    category_ids = {}
+    rows = db.execute(
+        select(shopitem_category.c.shopitem_id, shopitem_category.c.category_id)
+        .where(shopitem_category.c.shopitem_id.in_(item_ids))
+        .order_by(shopitem_category.c.shopitem_id, shopitem_category.c.category_id)
+    )
+    for item_id, category_id in rows:
+        category_ids.setdefault(item_id, []).append(category_id)
+    return category_ids
+
+# Entity -> resource whose full projection is logged as the state. Shop items
+# carry their real category_ids and order items the order they belong to.
+CHANGE_RESOURCES = {
+    "customers": CUSTOMER_RESOURCE,
+    "categories": CATEGORY_RESOURCE,
+    "shop_items": SHOP_ITEM_RESOURCE._replace(computed={"category_ids": load_category_ids}),
+    "order_items": ORDER_ITEM_RESOURCE._replace(fields=("shop_item_id", "quantity", "order_id", "id")),
+    "orders": ORDER_RESOURCE,
+}
+
+def change_states(db: Session, entity: str, ids):
+    resource = CHANGE_RESOURCES[entity]
+    rows = db.execute(sparse_select(resource, Fieldset(resource.fields, ())).where(resource.model.id.in_(ids))).all()
+    return {row.id: obj for row, obj in zip(rows, sparse_objects(db, resource, Fieldset(resource.fields, ()), rows))}
+
+change_log = ChangeLog(change_states, dump_json)
+change_log.listen(Session)
+
+def load_changes(after_seq: Optional[int], limit: int):
+    with ReadSessionLocal() as db:
+        try:
+            return read_changes(db, after_seq, limit)
+        except CursorCompacted:
+            raise HTTPException(status_code=410, detail="Changes since this cursor were compacted; resync from a full read")
+
+@app.get("/changes")
+async def list_changes(
+    since: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    wait: float = Query(0, ge=0, le=MAX_CHANGES_WAIT),
+):
+    after_seq = decode_cursor(since) if since is not None else None
+    # Waiting from before the first read, so a commit in between still wakes us
+    with change_log.next_commit() as commit:
+        rows, last_seq = await run_in_threadpool(load_changes, after_seq, limit)
+        if not rows and wait:
+            with anyio.move_on_after(wait):
+                await commit
+            rows, last_seq = await run_in_threadpool(load_changes, last_seq, limit)
+    return Response(
+        content=change_events_json(rows),
+        media_type="application/json",
+        headers={"X-Next-Cursor": encode_cursor(last_seq)},
+    )
+
+def run_change_compaction():
+    with SessionLocal() as db:
+        compact_changes(db, CHANGES_RETENTION, CHANGES_MAX_ROWS)
+        db.commit()
+
+async def compact_changes_periodically():
+    while True:
+        await anyio.sleep(CHANGES_COMPACT_INTERVAL)
+        async with writer_lock:
+            await run_in_threadpool(run_change_compaction)
+
+@app.on_event("startup")
+async def start_change_compaction():
+    if CHANGES_COMPACT_INTERVAL > 0:
+        app.state.change_compaction = asyncio.create_task(compact_changes_periodically())
+
+@app.on_event("shutdown")
+async def stop_change_compaction():
+    task = getattr(app.state, "change_compaction", None)
+    if task is not None:
+        task.cancel()
+        app.state.change_compaction = None
+
+# --- Sales rollups ---
+# touch_* marks every row a write changes, and mark_rollups resolves them to the
+# rollup keys they feed (an order line feeds its shop item and its order's
+# customer) both then, before the write is flushed, and again before commit, so
+# the keys a row moves away from are refreshed along with the ones it moves to.
+# /analytics reads are then a short index scan on the rollup tables.
+def rollup_keys(db: Session, entity: str, ids):
+    """(shop item ids, category ids, customer ids) fed by the given rows."""
+    if entity == "order_items":
+        rows = db.execute(
+            select(OrderItemDB.shop_item_id, OrderDB.customer_id)
+            .outerjoin(OrderDB, OrderDB.id == OrderItemDB.order_id).where(OrderItemDB.id.in_(ids))
+        ).all()
+        return {row.shop_item_id for row in rows}, set(), {row.customer_id for row in rows}
+    if entity == "orders":
+        return set(), set(), set(db.execute(select(OrderDB.customer_id).where(OrderDB.id.in_(ids))).scalars())
+    if entity == "shop_items":
+        # The categories it is leaving; those it joins are found at refresh time
+        links = db.execute(select(shopitem_category.c.category_id).where(shopitem_category.c.shopitem_id.in_(ids)))
+        return set(ids), set(links.scalars()), set()
+    if entity == "categories":
+        return set(), set(ids), set()
+    return set(), set(), set(ids)
+
+def add_rollup_keys(db: Session, entity: str, ids):
+    keys = db.info.setdefault("rollup_keys", (set(), set(), set()))
+    for found, pending in zip(rollup_keys(db, entity, ids), keys):
+        pending.update(found - {None})
+
+def mark_rollups(db: Session, entity: str, ids):
+    ids = set(ids) - {None}
+    if ids:
+        db.info.setdefault("rollups", {}).setdefault(entity, set()).update(ids)
+        add_rollup_keys(db, entity, ids)
+
+@event.listens_for(Session, "before_commit")
+def refresh_rollups(db: Session):
+    marked = db.info.pop("rollups", None)
+    if not marked:
+        return
+    db.flush()
+    for entity, ids in marked.items():
+        add_rollup_keys(db, entity, ids)
+    shop_item_ids, category_ids, customer_ids = db.info.pop("rollup_keys")
+    rollups.refresh(db, shop_item_ids, category_ids, customer_ids)
+
+@app.get("/analytics/revenue_by_category", response_model=List[CategoryRevenue])
+def revenue_by_category(limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT), db: Session = Depends(get_db)):
+    rows = db.execute(
+        select(SalesByCategoryDB, ShopItemCategoryDB.title)
+        .join(ShopItemCategoryDB, ShopItemCategoryDB.id == SalesByCategoryDB.category_id)
+        .order_by(SalesByCategoryDB.revenue.desc()).limit(limit)
+    ).all()
+    return [
+        CategoryRevenue(category_id=sales.category_id, title=title, shop_items=sales.shop_items,
+                        units=sales.units, revenue=round(sales.revenue, 2))
+        for sales, title in rows
+    ]
+
+@app.get("/analytics/top_shop_items", response_model=List[ShopItemSales])
+def top_shop_items(
+    by: str = Query("revenue", pattern="^(revenue|units)$"),
+    limit: int = Query(10, ge=1, le=MAX_PAGE_LIMIT),
+    db: Session = Depends(get_db),
+):
+    rows = db.execute(
+        select(SalesByShopItemDB, ShopItemDB.title)
+        .join(ShopItemDB, ShopItemDB.id == SalesByShopItemDB.shop_item_id)
+        .order_by(getattr(SalesByShopItemDB, by).desc()).limit(limit)
+    ).all()
+    return [
+        ShopItemSales(shop_item_id=sales.shop_item_id, title=title, orders=sales.orders,
+                      units=sales.units, revenue=round(sales.revenue, 2))
+        for sales, title in rows
+    ]
+
+def customer_spend_query():
+    return select(SalesByCustomerDB, CustomerDB.name, CustomerDB.surname).join(
+        CustomerDB, CustomerDB.id == SalesByCustomerDB.customer_id
+    )
+
+def customer_spend(sales: SalesByCustomerDB, name: str, surname: str) -> CustomerSpend:
+    return CustomerSpend(customer_id=sales.customer_id, name=name, surname=surname, orders=sales.orders,
+                         units=sales.units, spend=round(sales.spend, 2))
+
+@app.get("/analytics/customer_spend", response_model=List[CustomerSpend])
+def top_customer_spend(limit: int = Query(10, ge=1, le=MAX_PAGE_LIMIT), db: Session = Depends(get_db)):
+    rows = db.execute(customer_spend_query().order_by(SalesByCustomerDB.spend.desc()).limit(limit)).all()
+    return [customer_spend(*row) for row in rows]
+
+@app.get("/analytics/customer_spend/{customer_id}", response_model=CustomerSpend)
+def get_customer_spend(customer_id: int, db: Session = Depends(get_db)):
+    row = db.execute(customer_spend_query().where(SalesByCustomerDB.customer_id == customer_id)).first()
+    if row is None:
+        customer = db.query(CustomerDB).get(customer_id)
+        if not customer:
+            raise HTTPException(status_code=404, detail="Customer not found")
+        return CustomerSpend(customer_id=customer_id, name=customer.name, surname=customer.surname,
+                             orders=0, units=0, spend=0.0)
+    return customer_spend(*row)
+
 # --- CRUD Endpoints ---
 
 # Customer
-@app.post("/customers/", response_model=Customer)
-def create_customer(customer: CustomerCreate, db: Session = Depends(get_db)):
+def insert_customer(db: Session, customer: CustomerCreate) -> Customer:
     db_customer = CustomerDB(**customer.dict())
+    db.add(db_customer)
+    db.flush()
+    record_changes(db, "customers", [db_customer.id], "create")
+    touch_customers(db, [db_customer.id])
+    return Customer.model_validate(db_customer, from_attributes=True)
+
+@app.post("/customers/", response_model=Customer)
+async def create_customer(customer: CustomerCreate):
+    try:
+        return await run_write(lambda db: insert_customer(db, customer))
+    except exc.IntegrityError:
+        raise HTTPException(status_code=400, detail="Email already exists")
+
+@app.post("/customers/bulk", response_model=List[BulkRowResult])
+def create_customers_bulk(customers: List[CustomerCreate], db: Session = Depends(get_db)):
+    check_bulk_size(customers)
+    emails = {c.email for c in customers}
+    taken = set(db.execute(select(CustomerDB.email).where(CustomerDB.email.in_(emails))).scalars())
+    errors, accepted = {}, []
+    for i, customer in enumerate(customers):
+        if customer.email in taken:
+            errors[i] = "Email already exists"
+            continue
+        taken.add(customer.email)
+        accepted.append(i)
     try:
-        db.add(db_customer)
+        ids = bulk_insert(db, CustomerDB, [customers[i].dict() for i in accepted])
+        record_changes(db, "customers", ids, "create")
+        touch_customers(db, ids)
         db.commit()
-        db.refresh(db_customer)
     except exc.IntegrityError:
+        # A concurrent writer claimed one of the emails after the lookup above
         db.rollback()
-        raise HTTPException(status_code=400, detail="Email already exists")
-    return db_customer
+        raise HTTPException(status_code=409, detail="Email already exists")
+    return bulk_results(len(customers), dict(zip(accepted, ids)), errors)
 
 @app.get("/customers/", response_model=List[Customer])
-def list_customers(db: Session = Depends(get_db)):
-    return db.query(CustomerDB).all()
+def list_customers(request: Request, response: Response, page: Page = Depends(page_params), db: Session = Depends(get_db)):
+    unchanged = conditional_get(request, response, db, "customers")
+    if unchanged:
+        return unchanged
+    rows = keyset(db.query(CustomerDB), CustomerDB.id, page).all()
+    return page_rows(rows, page, response)
 
 @app.get("/customers/{customer_id}", response_model=Customer)
-def get_customer(customer_id: int, db: Session = Depends(get_db)):
+def get_customer(customer_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
+    unchanged = conditional_get(request, response, db, f"customers:{customer_id}")
+    if unchanged:
+        return unchanged
     customer = db.query(CustomerDB).get(customer_id)
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
@@ -165,6 +1165,7 @@ def update_customer(customer_id: int, customer: CustomerCreate, db: Session = De
         raise HTTPException(status_code=404, detail="Customer not found")
     for k, v in customer.dict().items():
         setattr(db_customer, k, v)
+    touch_customers(db, [customer_id])
     db.commit()
     db.refresh(db_customer)
     return db_customer
@@ -174,6 +1175,7 @@ def delete_customer(customer_id: int, db: Session = Depends(get_db)):
     db_customer = db.query(CustomerDB).get(customer_id)
     if not db_customer:
         raise HTTPException(status_code=404, detail="Customer not found")
+    touch_customers(db, [customer_id])
     db.delete(db_customer)
     db.commit()
     return {"ok": True}
@@ -183,20 +1185,44 @@ def delete_customer(customer_id: int, db: Session = Depends(get_db)):
 def create_category(category: ShopItemCategoryCreate, db: Session = Depends(get_db)):
     db_category = ShopItemCategoryDB(**category.dict())
     db.add(db_category)
+    db.flush()
+    record_changes(db, "categories", [db_category.id], "create")
+    touch_categories(db, [db_category.id])
     db.commit()
+    invalidate_categories(db_category.id)
     db.refresh(db_category)
     return db_category
 
+@app.post("/categories/bulk", response_model=List[BulkRowResult])
+def create_categories_bulk(categories: List[ShopItemCategoryCreate], db: Session = Depends(get_db)):
+    check_bulk_size(categories)
+    ids = bulk_insert(db, ShopItemCategoryDB, [c.dict() for c in categories])
+    record_changes(db, "categories", ids, "create")
+    touch_categories(db, ids)
+    db.commit()
+    invalidate_categories(*ids)
+    return bulk_results(len(categories), dict(enumerate(ids)), {})
+
 @app.get("/categories/", response_model=List[ShopItemCategory])
-def list_categories(db: Session = Depends(get_db)):
-    return db.query(ShopItemCategoryDB).all()
+def list_categories(request: Request, page: Page = Depends(page_params), db: Session = Depends(get_db)):
+    def build():
+        rows = keyset(db.query(ShopItemCategoryDB), ShopItemCategoryDB.id, page).all()
+        rows, cursor = split_page(rows, page)
+        return CachedBody(
+            body=to_json(CATEGORY_LIST_JSON, rows),
+            tags=frozenset({"categories"}.union(*(category_tags(row) for row in rows))),
+            headers={"X-Next-Cursor": cursor} if cursor else {},
+        )
+    return catalog_response(request, db, ("categories", page), "categories", build)
 
 @app.get("/categories/{category_id}", response_model=ShopItemCategory)
-def get_category(category_id: int, db: Session = Depends(get_db)):
-    category = db.query(ShopItemCategoryDB).get(category_id)
-    if not category:
-        raise HTTPException(status_code=404, detail="Category not found")
-    return category
+def get_category(category_id: int, request: Request, db: Session = Depends(get_db)):
+    def build():
+        category = db.query(ShopItemCategoryDB).get(category_id)
+        if not category:
+            raise HTTPException(status_code=404, detail="Category not found")
+        return CachedBody(to_json(CATEGORY_JSON, category), frozenset(category_tags(category)), {})
+    return catalog_response(request, db, ("category", category_id), f"categories:{category_id}", build)
 
 @app.put("/categories/{category_id}", response_model=ShopItemCategory)
 def update_category(category_id: int, category: ShopItemCategoryCreate, db: Session = Depends(get_db)):
@@ -205,7 +1231,9 @@ def update_category(category_id: int, category: ShopItemCategoryCreate, db: Sess
         raise HTTPException(status_code=404, detail="Category not found")
     for k, v in category.dict().items():
         setattr(db_category, k, v)
+    touch_categories(db, [category_id])
     db.commit()
+    invalidate_categories(category_id)
     db.refresh(db_category)
     return db_category
 
@@ -214,8 +1242,15 @@ def delete_category(category_id: int, db: Session = Depends(get_db)):
     db_category = db.query(ShopItemCategoryDB).get(category_id)
     if not db_category:
         raise HTTPException(status_code=404, detail="Category not found")
+    touch_categories(db, [category_id])
+    # Deleting the category unlinks it, which changes its shop items' category_ids
+    item_ids = db.execute(
+        select(shopitem_category.c.shopitem_id).where(shopitem_category.c.category_id == category_id)
+    ).scalars().all()
+    record_changes(db, "shop_items", item_ids)
     db.delete(db_category)
     db.commit()
+    invalidate_categories(category_id)
     return {"ok": True}
 
 # ShopItem
@@ -229,20 +1264,185 @@ def create_shop_item(item: ShopItemCreate, db: Session = Depends(get_db)):
         categories=categories
     )
     db.add(db_item)
+    db.flush()
+    record_changes(db, "shop_items", [db_item.id], "create")
+    touch_shop_items(db, [db_item.id])
     db.commit()
+    invalidate_shop_items(db_item.id)
     db.refresh(db_item)
     return db_item
 
+@app.post("/shop_items/bulk", response_model=List[BulkRowResult])
+def create_shop_items_bulk(items: List[ShopItemCreate], db: Session = Depends(get_db)):
+    check_bulk_size(items)
+    wanted = {cid for item in items for cid in item.category_ids}
+    known = set(db.execute(select(ShopItemCategoryDB.id).where(ShopItemCategoryDB.id.in_(wanted))).scalars())
+    errors, accepted = {}, []
+    for i, item in enumerate(items):
+        missing = sorted(set(item.category_ids) - known)
+        if missing:
+            errors[i] = f"Unknown category ids: {missing}"
+            continue
+        accepted.append(i)
+    ids = bulk_insert(db, ShopItemDB, [
+        {"title": items[i].title, "description": items[i].description, "price": items[i].price}
+        for i in accepted
+    ])
+    links = [
+        {"shopitem_id": item_id, "category_id": cid}
+        for i, item_id in zip(accepted, ids)
+        for cid in dict.fromkeys(items[i].category_ids)
+    ]
+    if links:
+        db.execute(shopitem_category.insert(), links)
+    record_changes(db, "shop_items", ids, "create")
+    touch_shop_items(db, ids)
+    db.commit()
+    invalidate_shop_items(*ids)
+    return bulk_results(len(items), dict(zip(accepted, ids)), errors)
+
+def shop_items_page(request: Request, db: Session, page: Page, category_id=None, min_price=None, max_price=None,
+                    require_category=False, fieldset: Optional[Fieldset] = None):
+    def build():
+        if require_category and not db.query(ShopItemCategoryDB).get(category_id):
+            raise HTTPException(status_code=404, detail="Category not found")
+        if fieldset is not None:
+            query = sparse_select(SHOP_ITEM_RESOURCE, fieldset)
+        else:
+            query = db.query(ShopItemDB).options(selectinload(ShopItemDB.categories))
+        id_column = ShopItemDB.id
+        if category_id is not None:
+            # Page through the (category_id, shopitem_id) index, so a category page
+            # reads page-size index entries however large the catalog is
+            query = query.join(shopitem_category, shopitem_category.c.shopitem_id == ShopItemDB.id)
+            query = query.filter(shopitem_category.c.category_id == category_id)
+            id_column = shopitem_category.c.shopitem_id
+        if min_price is not None:
+            query = query.filter(ShopItemDB.price >= min_price)
+        if max_price is not None:
+            query = query.filter(ShopItemDB.price <= max_price)
+        sort_column = sort_field = None
+        if category_id is None and (min_price is not None or max_price is not None):
+            # Page through the price index, ordered by (price, id): in id order
+            # SQLite would sort the whole price range for every page
+            sort_column, sort_field = ShopItemDB.price, "price"
+        headers = {}
+        if fieldset is not None:
+            if sort_column is not None and "price" not in fieldset.fields:
+                query = query.add_columns(ShopItemDB.price)
+            rows = db.execute(keyset(query, id_column, page, sort_column)).all()
+            rows, cursor = split_page(rows, page, sort_field)
+            body = dump_json(sparse_objects(db, SHOP_ITEM_RESOURCE, fieldset, rows))
+            tags = {"shop_items"} | sparse_tags(rows, fieldset)
+        else:
+            rows, cursor = split_page(keyset(query, id_column, page, sort_column).all(), page, sort_field)
+            body = to_json(SHOP_ITEM_LIST_JSON, rows)
+            tags = {"shop_items"}.union(*(shop_item_tags(row) for row in rows))
+        if category_id is not None:
+            # Even a page without items goes when the category is deleted
+            tags.add(f"category:{category_id}")
+        if cursor:
+            headers["X-Next-Cursor"] = cursor
+        return CachedBody(body=body, tags=frozenset(tags), headers=headers)
+    key = ("shop_items", page, category_id, min_price, max_price, fieldset)
+    return catalog_response(request, db, key, "shop_items", build)
+
 @app.get("/shop_items/", response_model=List[ShopItem])
-def list_shop_items(db: Session = Depends(get_db)):
-    return db.query(ShopItemDB).all()
+def list_shop_items(
+    request: Request,
+    page: Page = Depends(page_params),
+    category_id: Optional[int] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    fieldset: Optional[Fieldset] = Depends(fieldset_params(SHOP_ITEM_RESOURCE)),
+    db: Session = Depends(get_db),
+):
+    return shop_items_page(request, db, page, category_id, min_price, max_price, fieldset=fieldset)
+
+@app.get("/categories/{category_id}/shop_items", response_model=List[ShopItem])
+def list_category_shop_items(
+    category_id: int,
+    request: Request,
+    page: Page = Depends(page_params),
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    fieldset: Optional[Fieldset] = Depends(fieldset_params(SHOP_ITEM_RESOURCE)),
+    db: Session = Depends(get_db),
+):
+    return shop_items_page(request, db, page, category_id, min_price, max_price, require_category=True,
+                           fieldset=fieldset)
+
+# --- Product search ---
+# Search runs entirely in SQLite: FTS5 MATCH picks the candidates, bm25() ranks
+# them, and the total and per-category facet counts are aggregated over the same
+# match set. Only the requested page of items is loaded as ORM objects.
+def fts_query(q: str) -> str:
+    # Quote every term so user input can never be parsed as FTS5 syntax; a
+    # trailing * makes each term a prefix match for search-as-you-type.
+    terms = re.findall(r"\w+", q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query has no searchable terms")
+    return " ".join(f'"{term}"*' for term in terms)
+
+SEARCH_CATEGORY_FILTER = """
+    AND (:category_id IS NULL OR EXISTS (
+        SELECT 1 FROM shopitem_category sc
+        WHERE sc.shopitem_id = shop_items_fts.rowid AND sc.category_id = :category_id
+    ))"""
+
+@app.get("/shop_items/search", response_model=ShopItemSearchResult)
+def search_shop_items(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1),
+    category_id: Optional[int] = None,
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db),
+):
+    unchanged = conditional_get(request, response, db, "shop_items")
+    if unchanged:
+        return unchanged
+    params = {"q": fts_query(q), "category_id": category_id, "limit": limit, "offset": offset}
+    ranked_ids = db.execute(text(
+        "SELECT rowid FROM shop_items_fts WHERE shop_items_fts MATCH :q" + SEARCH_CATEGORY_FILTER +
+        " ORDER BY bm25(shop_items_fts), rowid LIMIT :limit OFFSET :offset"
+    ), params).scalars().all()
+    total = db.execute(text(
+        "SELECT count(*) FROM shop_items_fts WHERE shop_items_fts MATCH :q" + SEARCH_CATEGORY_FILTER
+    ), params).scalar()
+    facets = db.execute(text(
+        "SELECT sc.category_id, count(*) FROM shop_items_fts"
+        " JOIN shopitem_category sc ON sc.shopitem_id = shop_items_fts.rowid"
+        " WHERE shop_items_fts MATCH :q GROUP BY sc.category_id ORDER BY count(*) DESC, sc.category_id"
+    ), params).all()
+    items = db.query(ShopItemDB).options(selectinload(ShopItemDB.categories)).filter(ShopItemDB.id.in_(ranked_ids)).all()
+    by_id = {item.id: item for item in items}
+    return {
+        "total": total,
+        "items": [by_id[item_id] for item_id in ranked_ids if item_id in by_id],
+        "facets": [{"category_id": cid, "count": count} for cid, count in facets],
+    }
 
 @app.get("/shop_items/{item_id}", response_model=ShopItem)
-def get_shop_item(item_id: int, db: Session = Depends(get_db)):
-    item = db.query(ShopItemDB).get(item_id)
-    if not item:
-        raise HTTPException(status_code=404, detail="ShopItem not found")
-    return item
+def get_shop_item(
+    item_id: int,
+    request: Request,
+    fieldset: Optional[Fieldset] = Depends(fieldset_params(SHOP_ITEM_RESOURCE)),
+    db: Session = Depends(get_db),
+):
+    def build():
+        if fieldset is not None:
+            rows = db.execute(sparse_select(SHOP_ITEM_RESOURCE, fieldset).where(ShopItemDB.id == item_id)).all()
+            if not rows:
+                raise HTTPException(status_code=404, detail="ShopItem not found")
+            body = dump_json(sparse_objects(db, SHOP_ITEM_RESOURCE, fieldset, rows)[0])
+            return CachedBody(body, frozenset(sparse_tags(rows, fieldset)), {})
+        item = db.query(ShopItemDB).get(item_id)
+        if not item:
+            raise HTTPException(status_code=404, detail="ShopItem not found")
+        return CachedBody(to_json(SHOP_ITEM_JSON, item), frozenset(shop_item_tags(item)), {})
+    return catalog_response(request, db, ("shop_item", item_id, fieldset), f"shop_items:{item_id}", build)
 
 @app.put("/shop_items/{item_id}", response_model=ShopItem)
 def update_shop_item(item_id: int, item: ShopItemCreate, db: Session = Depends(get_db)):
@@ -254,7 +1454,9 @@ def update_shop_item(item_id: int, item: ShopItemCreate, db: Session = Depends(g
     db_item.description = item.description
     db_item.price = item.price
     db_item.categories = categories
+    touch_shop_items(db, [item_id])
     db.commit()
+    invalidate_shop_items(item_id)
     db.refresh(db_item)
     return db_item
 
@@ -263,25 +1465,70 @@ def delete_shop_item(item_id: int, db: Session = Depends(get_db)):
     db_item = db.query(ShopItemDB).get(item_id)
     if not db_item:
         raise HTTPException(status_code=404, detail="ShopItem not found")
+    touch_shop_items(db, [item_id])
     db.delete(db_item)
     db.commit()
+    invalidate_shop_items(item_id)
     return {"ok": True}
 
 # OrderItem
-@app.post("/order_items/", response_model=OrderItem)
-def create_order_item(order_item: OrderItemCreate, db: Session = Depends(get_db)):
+def insert_order_item(db: Session, order_item: OrderItemCreate) -> OrderItem:
     db_order_item = OrderItemDB(**order_item.dict())
     db.add(db_order_item)
-    db.commit()
-    db.refresh(db_order_item)
-    return db_order_item
+    db.flush()
+    record_changes(db, "order_items", [db_order_item.id], "create")
+    touch_order_items(db, [db_order_item.id])
+    return OrderItem.model_validate(db_order_item, from_attributes=True)
+
+@app.post("/order_items/", response_model=OrderItem)
+async def create_order_item(order_item: OrderItemCreate):
+    return await run_write(lambda db: insert_order_item(db, order_item))
 
 @app.get("/order_items/", response_model=List[OrderItem])
-def list_order_items(db: Session = Depends(get_db)):
-    return db.query(OrderItemDB).all()
+def list_order_items(
+    request: Request,
+    response: Response,
+    page: Page = Depends(page_params),
+    fieldset: Optional[Fieldset] = Depends(fieldset_params(ORDER_ITEM_RESOURCE)),
+    db: Session = Depends(get_db),
+):
+    unchanged = conditional_get(request, response, db, "order_items")
+    if unchanged:
+        return unchanged
+    if fieldset is not None:
+        query = keyset(sparse_select(ORDER_ITEM_RESOURCE, fieldset), OrderItemDB.id, page)
+        rows = page_rows(db.execute(query).all(), page, response)
+        return json_response(sparse_objects(db, ORDER_ITEM_RESOURCE, fieldset, rows), response)
+    if FAST_SERIALIZATION:
+        rows = page_rows(db.execute(keyset(order_item_columns(), OrderItemDB.id, page)).all(), page, response)
+        return json_response(fast_order_items(db, rows), response)
+    query = db.query(OrderItemDB).options(
+        selectinload(OrderItemDB.shop_item).selectinload(ShopItemDB.categories)
+    )
+    rows = keyset(query, OrderItemDB.id, page).all()
+    return page_rows(rows, page, response)
 
 @app.get("/order_items/{order_item_id}", response_model=OrderItem)
-def get_order_item(order_item_id: int, db: Session = Depends(get_db)):
+def get_order_item(
+    order_item_id: int,
+    request: Request,
+    response: Response,
+    fieldset: Optional[Fieldset] = Depends(fieldset_params(ORDER_ITEM_RESOURCE)),
+    db: Session = Depends(get_db),
+):
+    unchanged = conditional_get(request, response, db, f"order_items:{order_item_id}")
+    if unchanged:
+        return unchanged
+    if fieldset is not None:
+        rows = db.execute(sparse_select(ORDER_ITEM_RESOURCE, fieldset).where(OrderItemDB.id == order_item_id)).all()
+        if not rows:
+            raise HTTPException(status_code=404, detail="OrderItem not found")
+        return json_response(sparse_objects(db, ORDER_ITEM_RESOURCE, fieldset, rows)[0], response)
+    if FAST_SERIALIZATION:
+        rows = db.execute(order_item_columns().where(OrderItemDB.id == order_item_id)).all()
+        if not rows:
+            raise HTTPException(status_code=404, detail="OrderItem not found")
+        return json_response(fast_order_items(db, rows)[0], response)
     order_item = db.query(OrderItemDB).get(order_item_id)
     if not order_item:
         raise HTTPException(status_code=404, detail="OrderItem not found")
@@ -294,6 +1541,7 @@ def update_order_item(order_item_id: int, order_item: OrderItemCreate, db: Sessi
         raise HTTPException(status_code=404, detail="OrderItem not found")
     db_order_item.shop_item_id = order_item.shop_item_id
     db_order_item.quantity = order_item.quantity
+    touch_order_items(db, [order_item_id])
     db.commit()
     db.refresh(db_order_item)
     return db_order_item
@@ -303,191 +1551,547 @@ def delete_order_item(order_item_id: int, db: Session = Depends(get_db)):
     db_order_item = db.query(OrderItemDB).get(order_item_id)
     if not db_order_item:
         raise HTTPException(status_code=404, detail="OrderItem not found")
+    touch_order_items(db, [order_item_id])
     db.delete(db_order_item)
     db.commit()
     return {"ok": True}
 
+# --- Order assembly ---
+# Orders are always loaded through these helpers so that the whole object graph
+# (customer, items, shop items, categories) arrives in a fixed number of batched
+# SELECT ... WHERE id IN (...) statements, no matter how many orders are returned.
+def order_load_options():
+    return (
+        selectinload(OrderDB.customer),
+        selectinload(OrderDB.items)
+        .selectinload(OrderItemDB.shop_item)
+        .selectinload(ShopItemDB.categories),
+    )
+
+def load_orders(db: Session, *criteria, limit: Optional[int] = None):
+    query = db.query(OrderDB).options(*order_load_options()).populate_existing()
+    if criteria:
+        query = query.filter(*criteria)
+    query = query.order_by(OrderDB.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+def load_order(db: Session, oid: int):
+    orders = load_orders(db, OrderDB.id == oid)
+    return orders[0] if orders else None
+
+def reassign_order_items(db: Session, oid: int, added, removed):
+    """Attach `added` and detach `removed` order items, writing only the rows that move."""
+    added, removed = set(added), set(removed)
+    if added or removed:
+        # Unknown ids, items already in the order and items of other orders are left alone
+        owners = db.execute(
+            select(OrderItemDB.id, OrderItemDB.order_id).where(OrderItemDB.id.in_(added | removed))
+        ).all()
+        added = [item_id for item_id, owner in owners if item_id in added and owner != oid]
+        removed = [item_id for item_id, owner in owners if item_id in removed and owner == oid]
+    touch_order_items(db, [*added, *removed], [oid])
+    if removed:
+        db.query(OrderItemDB).filter(OrderItemDB.id.in_(removed)).update({"order_id": None}, synchronize_session=False)
+    if added:
+        db.query(OrderItemDB).filter(OrderItemDB.id.in_(added)).update({"order_id": oid}, synchronize_session=False)
+
+def check_order_references(db: Session, customer_id: Optional[int], item_ids):
+    """Raise 400 unless the customer (if given) and every order item exist; one round trip."""
+    item_ids = set(item_ids)
+    checks = []
+    if customer_id is not None:
+        checks.append(select(literal("customer"), CustomerDB.id).where(CustomerDB.id == customer_id))
+    if item_ids:
+        checks.append(select(literal("order_item"), OrderItemDB.id).where(OrderItemDB.id.in_(item_ids)))
+    found = db.execute(union_all(*checks)).all() if checks else []
+    if customer_id is not None and ("customer", customer_id) not in found:
+        raise HTTPException(status_code=400, detail="Customer not found")
+    missing = sorted(item_ids - {row_id for kind, row_id in found if kind == "order_item"})
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Unknown order item ids: {missing}")
+
+def assemble_order(order: OrderDB):
+    items = sorted(order.items, key=lambda item: item.id)
+    return {
+        "id": order.id,
+        "customer_id": order.customer_id,
+        "item_ids": [item.id for item in items],
+        "customer": order.customer,
+        "items": items
+    }
+
+# --- Fast serialization ---
+# With FAST_SERIALIZATION, order and order item responses are built as plain
+# dicts straight from Core row tuples and encoded with orjson, skipping ORM
+# identity-map bookkeeping and response_model validation. Each builder emits the
+# keys in its schema's field order, so the bytes match what FastAPI produces from
+# the Pydantic models (tests/test_fast_serialization.py compares the two).
+def fast_shop_items(db: Session, item_ids) -> dict:
+    """ShopItem dicts by id, categories included, in two queries."""
+    item_ids = set(item_ids)
+    if not item_ids:
+        return {}
+    categories = {}
+    category_rows = db.execute(
+        select(shopitem_category.c.shopitem_id, ShopItemCategoryDB.id, ShopItemCategoryDB.title, ShopItemCategoryDB.description)
+        .join(ShopItemCategoryDB, ShopItemCategoryDB.id == shopitem_category.c.category_id)
+        .where(shopitem_category.c.shopitem_id.in_(item_ids))
+        .order_by(shopitem_category.c.shopitem_id, ShopItemCategoryDB.id)
+    )
+    for item_id, category_id, title, description in category_rows:
+        categories.setdefault(item_id, []).append({"title": title, "description": description, "id": category_id})
+    item_rows = db.execute(
+        select(ShopItemDB.id, ShopItemDB.title, ShopItemDB.description, ShopItemDB.price)
+        .where(ShopItemDB.id.in_(item_ids))
+    )
+    return {
+        # category_ids is input-only and always serialized empty
+        item_id: {"title": title, "description": description, "price": price, "category_ids": [],
+                  "id": item_id, "categories": categories.get(item_id, [])}
+        for item_id, title, description, price in item_rows
+    }
+
+def order_item_columns():
+    return select(OrderItemDB.id, OrderItemDB.shop_item_id, OrderItemDB.quantity, OrderItemDB.order_id)
+
+def fast_order_items(db: Session, rows):
+    """OrderItem dicts for (id, shop_item_id, quantity, ...) rows, in their order."""
+    shop_items = fast_shop_items(db, {row[1] for row in rows})
+    return [
+        {"shop_item_id": shop_item_id, "quantity": quantity, "id": item_id, "shop_item": shop_items[shop_item_id]}
+        for item_id, shop_item_id, quantity, *_ in rows
+    ]
+
+def fast_orders(db: Session, rows):
+    """Order dicts for (id, customer_id) rows, in their order."""
+    if not rows:
+        return []
+    order_ids = [row[0] for row in rows]
+    customers = {
+        customer_id: {"name": name, "surname": surname, "email": email, "id": customer_id}
+        for customer_id, name, surname, email in db.execute(
+            select(CustomerDB.id, CustomerDB.name, CustomerDB.surname, CustomerDB.email)
+            .where(CustomerDB.id.in_({row[1] for row in rows}))
+        )
+    }
+    lines = db.execute(order_item_columns().where(OrderItemDB.order_id.in_(order_ids)).order_by(OrderItemDB.id)).all()
+    items_by_order = {}
+    for line, item in zip(lines, fast_order_items(db, lines)):
+        items_by_order.setdefault(line[3], []).append(item)
+    orders = []
+    for order_id, customer_id in rows:
+        items = items_by_order.get(order_id, [])
+        orders.append({
+            "customer_id": customer_id,
+            "item_ids": [item["id"] for item in items],
+            "id": order_id,
+            "customer": customers[customer_id],
+            "items": items,
+        })
+    return orders
+
+# --- Order snapshots ---
+# Every order's GET /orders/{oid} body is stored pre-serialized (see
+# app/snapshots.py). The touch_* fan-out already reaches every order that embeds
+# a changed customer, shop item, category or order item, and touch_orders marks
+# it; just before commit the marked orders are rebuilt with the fast builders,
+# encoded through the Order response model so the bytes match the regular path
+# with or without orjson.
+def render_orders(db: Session, rows):
+    return {order["id"]: to_json(ORDER_JSON, order) for order in fast_orders(db, rows)}
+
+order_snapshots = OrderSnapshots(render_orders, EXPORT_CHUNK_SIZE)
+order_snapshots.listen(Session)
+
+def order_snapshot_response(request: Request, db: Session, oid: int) -> Optional[Response]:
+    snapshot = read_order_snapshot(db, oid)
+    if snapshot is None:
+        return None
+    # Same tag entity_etag gives for the order's key
+    etag = f'"orders:{oid}:{snapshot.version}"'
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return Response(content=snapshot.body, media_type="application/json", headers={"ETag": etag})
+
+# --- Normalized orders ---
+# GET /orders/?format=normalized sends every customer, shop item and category
+# once, in top-level maps keyed by id, instead of repeating them in each order
+# and line. Orders keep their lines (which belong to exactly one order) but
+# reference shop items by id, and shop items list their category_ids. Each map
+# is filled by one batched SELECT over the id set collected from the level above.
+def rows_by_id(db: Session, model, fields, ids):
+    """{str(id): {field: value}} for the model rows with the given ids."""
+    if not ids:
+        return {}
+    rows = db.execute(select(*(getattr(model, field) for field in fields)).where(model.id.in_(ids)).order_by(model.id))
+    return {str(row.id): dict(zip(fields, row)) for row in rows}
+
+def normalized_orders(db: Session, rows):
+    """The normalized document for (id, customer_id) order rows, in their order."""
+    order_ids = [row.id for row in rows]
+    lines = db.execute(
+        select(OrderItemDB.order_id, OrderItemDB.shop_item_id, OrderItemDB.quantity, OrderItemDB.id)
+        .where(OrderItemDB.order_id.in_(order_ids)).order_by(OrderItemDB.id)
+    ).all() if order_ids else []
+    items_by_order = {}
+    for order_id, shop_item_id, quantity, item_id in lines:
+        items_by_order.setdefault(order_id, []).append({"shop_item_id": shop_item_id, "quantity": quantity, "id": item_id})
+    customers = rows_by_id(db, CustomerDB, ("name", "surname", "email", "id"), {row.customer_id for row in rows})
+    # Built by hand: category_ids, filled from the link table below, sits before id
+    shop_items = {}
+    shop_item_ids = {line.shop_item_id for line in lines}
+    if shop_item_ids:
+        item_rows = db.execute(
+            select(ShopItemDB.id, ShopItemDB.title, ShopItemDB.description, ShopItemDB.price)
+            .where(ShopItemDB.id.in_(shop_item_ids)).order_by(ShopItemDB.id)
+        )
+        for item_id, title, description, price in item_rows:
+            shop_items[str(item_id)] = {
+                "title": title, "description": description, "price": price, "category_ids": [], "id": item_id,
+            }
+    category_ids = set()
+    if shop_items:
+        links = db.execute(
+            select(shopitem_category.c.shopitem_id, shopitem_category.c.category_id)
+            .where(shopitem_category.c.shopitem_id.in_(shop_item_ids))
+            .order_by(shopitem_category.c.shopitem_id, shopitem_category.c.category_id)
+        )
+        for shop_item_id, category_id in links:
+            shop_items[str(shop_item_id)]["category_ids"].append(category_id)
+            category_ids.add(category_id)
+    categories = rows_by_id(db, ShopItemCategoryDB, ("title", "description", "id"), category_ids)
+    orders = []
+    for order_id, customer_id in rows:
+        items = items_by_order.get(order_id, [])
+        orders.append({
+            "customer_id": customer_id,
+            "item_ids": [item["id"] for item in items],
+            "id": order_id,
+            "items": items,
+        })
+    return {"orders": orders, "customers": customers, "shop_items": shop_items, "categories": categories}
+
 # Order
-@app.post("/orders/", response_model=Order)
-def create_order(order: OrderCreate, db: Session = Depends(get_db)):
+def insert_order(db: Session, order: OrderCreate) -> Order:
     db_order = OrderDB(customer_id=order.customer_id)
     db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
-    # Add order items
+    db.flush()
+    record_changes(db, "orders", [db_order.id], "create")
+    # Add the order items that exist, bumping any orders they are taken from
     items = db.query(OrderItemDB).filter(OrderItemDB.id.in_(order.item_ids)).all()
+    touch_order_items(db, [item.id for item in items], [db_order.id])
     for item in items:
         item.order_id = db_order.id
-    db.commit()
-    db.refresh(db_order)
-    # Compose item_ids for schema compatibility
-    db_order.items = db.query(OrderItemDB).filter(OrderItemDB.order_id == db_order.id).all()
-    for item in db_order.items:
-        item.shop_item = db.query(ShopItemDB).get(item.shop_item_id)
-    item_ids = [item.id for item in db_order.items]
-    return {
-        "id": db_order.id,
-        "customer_id": db_order.customer_id,
-        "item_ids": item_ids,
-        "customer": db_order.customer,
-        "items": db_order.items
-    }
+    db.flush()
+    return Order.model_validate(assemble_order(load_order(db, db_order.id)), from_attributes=True)
+
+@app.post("/orders/", response_model=Order)
+async def create_order(order: OrderCreate):
+    return await run_write(lambda db: insert_order(db, order))
+
+def insert_placed_order(db: Session, order: OrderPlace) -> Order:
+    if not order.lines:
+        raise HTTPException(status_code=400, detail="An order needs at least one line")
+    # Check the customer and every shop item in a single round trip
+    item_ids = {line.shop_item_id for line in order.lines}
+    found = db.execute(union_all(
+        select(literal("customer"), CustomerDB.id).where(CustomerDB.id == order.customer_id),
+        select(literal("shop_item"), ShopItemDB.id).where(ShopItemDB.id.in_(item_ids)),
+    )).all()
+    if ("customer", order.customer_id) not in found:
+        raise HTTPException(status_code=400, detail="Customer not found")
+    missing = sorted(item_ids - {row_id for kind, row_id in found if kind == "shop_item"})
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Unknown shop item ids: {missing}")
+    db_order = OrderDB(customer_id=order.customer_id, items=[
+        OrderItemDB(shop_item_id=line.shop_item_id, quantity=line.quantity) for line in order.lines
+    ])
+    db.add(db_order)
+    db.flush()
+    record_changes(db, "orders", [db_order.id], "create")
+    record_changes(db, "order_items", [item.id for item in db_order.items], "create")
+    touch_order_items(db, [item.id for item in db_order.items], [db_order.id])
+    return Order.model_validate(assemble_order(load_order(db, db_order.id)), from_attributes=True)
+
+@app.post("/orders/place", response_model=Order)
+async def place_order(order: OrderPlace):
+    return await run_write(lambda db: insert_placed_order(db, order))
 
 @app.get("/orders/", response_model=List[Order])
-def list_orders(db: Session = Depends(get_db)):
-    orders = db.query(OrderDB).all()
-    result = []
-    for order in orders:
-        order.items = db.query(OrderItemDB).filter(OrderItemDB.order_id == order.id).all()
-        for item in order.items:
-            item.shop_item = db.query(ShopItemDB).get(item.shop_item_id)
-        item_ids = [item.id for item in order.items]
-        result.append({
-            "id": order.id,
-            "customer_id": order.customer_id,
-            "item_ids": item_ids,
-            "customer": order.customer,
-            "items": order.items
-        })
-    return result
+def list_orders(
+    request: Request,
+    response: Response,
+    page: Page = Depends(page_params),
+    fieldset: Optional[Fieldset] = Depends(fieldset_params(ORDER_RESOURCE)),
+    format: str = Query("nested", pattern="^(nested|normalized)$"),
+    db: Session = Depends(get_db),
+):
+    unchanged = conditional_get(request, response, db, "orders")
+    if unchanged:
+        return unchanged
+    if format == "normalized":
+        if fieldset is not None:
+            raise HTTPException(status_code=400, detail="format=normalized cannot be combined with fields or include")
+        rows = page_rows(db.execute(keyset(select(OrderDB.id, OrderDB.customer_id), OrderDB.id, page)).all(), page, response)
+        return json_response(normalized_orders(db, rows), response)
+    if fieldset is not None:
+        rows = page_rows(db.execute(keyset(sparse_select(ORDER_RESOURCE, fieldset), OrderDB.id, page)).all(), page, response)
+        return json_response(sparse_objects(db, ORDER_RESOURCE, fieldset, rows), response)
+    if FAST_SERIALIZATION:
+        rows = db.execute(keyset(select(OrderDB.id, OrderDB.customer_id), OrderDB.id, page)).all()
+        return json_response(fast_orders(db, page_rows(rows, page, response)), response)
+    criteria = [OrderDB.id > page.after_id] if page.after_id is not None else []
+    orders = page_rows(load_orders(db, *criteria, limit=page.limit + 1), page, response)
+    return [assemble_order(order) for order in orders]
 
 @app.put("/orders/{oid}", response_model=Order)
 def update_order_by_oid(oid: int, order: OrderCreate, db: Session = Depends(get_db)):
     db_order = db.query(OrderDB).get(oid)
     if not db_order:
         raise HTTPException(status_code=404, detail="Order not found")
+    current_ids = set(db.execute(select(OrderItemDB.id).where(OrderItemDB.order_id == oid)).scalars())
+    wanted_ids = set(order.item_ids)
+    # Checked before anything is written, so a bad reference leaves the order as it was
+    check_order_references(db, order.customer_id, wanted_ids - current_ids)
     db_order.customer_id = order.customer_id
-    # Unassign all current order items
-    db.query(OrderItemDB).filter(OrderItemDB.order_id == db_order.id).update({"order_id": None})
+    reassign_order_items(db, oid, wanted_ids - current_ids, current_ids - wanted_ids)
     db.commit()
-    # Assign new order items
-    items = db.query(OrderItemDB).filter(OrderItemDB.id.in_(order.item_ids)).all()
-    for item in items:
-        item.order_id = db_order.id
+    return assemble_order(load_order(db, oid))
+
+@app.patch("/orders/{oid}", response_model=Order)
+def patch_order_by_oid(oid: int, patch: OrderPatch, db: Session = Depends(get_db)):
+    db_order = db.query(OrderDB).get(oid)
+    if not db_order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    added, removed = set(patch.add_item_ids), set(patch.remove_item_ids)
+    if added & removed:
+        raise HTTPException(status_code=400, detail=f"Items both added and removed: {sorted(added & removed)}")
+    check_order_references(db, patch.customer_id, added)
+    if patch.customer_id is not None:
+        db_order.customer_id = patch.customer_id
+    reassign_order_items(db, oid, added, removed)
     db.commit()
-    db.refresh(db_order)
-    db_order.items = db.query(OrderItemDB).filter(OrderItemDB.order_id == db_order.id).all()
-    for item in db_order.items:
-        item.shop_item = db.query(ShopItemDB).get(item.shop_item_id)
-    item_ids = [item.id for item in db_order.items]
-    return {
-        "id": db_order.id,
-        "customer_id": db_order.customer_id,
-        "item_ids": item_ids,
-        "customer": db_order.customer,
-        "items": db_order.items
-    }
+    return assemble_order(load_order(db, oid))
 
 @app.delete("/orders/{oid}")
 def delete_order_by_oid(oid: int, db: Session = Depends(get_db)):
     db_order = db.query(OrderDB).get(oid)
     if not db_order:
         raise HTTPException(status_code=404, detail="Order not found")
+    current_ids = db.execute(select(OrderItemDB.id).where(OrderItemDB.order_id == oid)).scalars().all()
+    touch_order_items(db, current_ids, [oid])
     db.query(OrderItemDB).filter(OrderItemDB.order_id == db_order.id).update({"order_id": None})
-    db.commit()
     db.delete(db_order)
     db.commit()
     return {"ok": True}
 
-# --- DB Initialization with test data ---
+# --- Schema check ---
+# Startup only reads the schema version; migrations run when it is behind (see
+# app/migrations.py). Demo data is loaded explicitly with `python -m app.seed`.
 @app.on_event("startup")
-def startup_populate():
-    # --- Fix: ensure DB schema is up-to-date by dropping and recreating tables if needed ---
-    import os
-    if os.path.exists("shop.db"):
-        os.remove("shop.db")
-    Base.metadata.create_all(bind=engine)
-    db = SessionLocal()
-    if not db.query(CustomerDB).first():
-        c1 = CustomerDB(name="Alice", surname="Smith", email="alice@example.com")
-        c2 = CustomerDB(name="Bob", surname="Brown", email="bob@example.com")
-        db.add_all([c1, c2])
-        db.commit()
-    if not db.query(ShopItemCategoryDB).first():
-        cat1 = ShopItemCategoryDB(title="Books", description="All kinds of books")
-        cat2 = ShopItemCategoryDB(title="Electronics", description="Gadgets and devices")
-        db.add_all([cat1, cat2])
-        db.commit()
-    if not db.query(ShopItemDB).first():
-        cat1 = db.query(ShopItemCategoryDB).filter_by(title="Books").first()
-        cat2 = db.query(ShopItemCategoryDB).filter_by(title="Electronics").first()
-        item1 = ShopItemDB(title="Python Book", description="Learn Python", price=29.99, categories=[cat1])
-        item2 = ShopItemDB(title="Smartphone", description="Latest model", price=499.99, categories=[cat2])
-        db.add_all([item1, item2])
-        db.commit()
-    if not db.query(OrderItemDB).first():
-        item1 = db.query(ShopItemDB).filter_by(title="Python Book").first()
-        item2 = db.query(ShopItemDB).filter_by(title="Smartphone").first()
-        oi1 = OrderItemDB(shop_item_id=item1.id, quantity=2)
-        oi2 = OrderItemDB(shop_item_id=item2.id, quantity=1)
-        db.add_all([oi1, oi2])
-        db.commit()
-    if not db.query(OrderDB).first():
-        c1 = db.query(CustomerDB).filter_by(name="Alice").first()
-        oi1 = db.query(OrderItemDB).filter_by(quantity=2).first()
-        oi2 = db.query(OrderItemDB).filter_by(quantity=1).first()
-        order = OrderDB(customer_id=c1.id, items=[oi1, oi2])
-        db.add(order)
-        db.commit()
-    db.close()
+def check_schema_version():
+    if schema_version(engine) < LATEST_VERSION:
+        migrate(engine)
 
 @app.get("/orders/{oid}", response_model=Order)
-def get_order_by_oid(oid: int, db: Session = Depends(get_db)):
-    order = db.query(OrderDB).get(oid)
+def get_order_by_oid(
+    oid: int,
+    request: Request,
+    response: Response,
+    fieldset: Optional[Fieldset] = Depends(fieldset_params(ORDER_RESOURCE)),
+    db: Session = Depends(get_db),
+):
+    if fieldset is None:
+        snapshot = order_snapshot_response(request, db, oid)
+        if snapshot is not None:
+            return snapshot
+    unchanged = conditional_get(request, response, db, f"orders:{oid}")
+    if unchanged:
+        return unchanged
+    if fieldset is not None:
+        rows = db.execute(sparse_select(ORDER_RESOURCE, fieldset).where(OrderDB.id == oid)).all()
+        if not rows:
+            raise HTTPException(status_code=404, detail="Order not found")
+        return json_response(sparse_objects(db, ORDER_RESOURCE, fieldset, rows)[0], response)
+    if FAST_SERIALIZATION:
+        orders = fast_orders(db, db.execute(select(OrderDB.id, OrderDB.customer_id).where(OrderDB.id == oid)).all())
+        if not orders:
+            raise HTTPException(status_code=404, detail="Order not found")
+        return json_response(orders[0], response)
+    order = load_order(db, oid)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
-    order.items = db.query(OrderItemDB).filter(OrderItemDB.order_id == order.id).all()
-    for item in order.items:
-        item.shop_item = db.query(ShopItemDB).get(item.shop_item_id)
-    item_ids = [item.id for item in order.items]
-    return {
-        "id": order.id,
-        "customer_id": order.customer_id,
-        "item_ids": item_ids,
-        "customer": order.customer,
-        "items": order.items
-    }
+    return assemble_order(order)
 
-# --- Order by_oid(oid: int, order: OrderCreate, db: Session = Depends(get_db)):
-# Unassign all current order items
-    db.query(OrderItemDB).filter(OrderItemDB.order_id == db_order.id).update({"order_id": None})
-    db.commit()
-    # Assign new order items
-    items = db.query(OrderItemDB).filter(OrderItemDB.id.in_(order.item_ids)).all()
-    for item in items:
-        item.order_id = db_order.id
-    db.commit()
-    db.refresh(db_order)
-    db_order.items = db.query(OrderItemDB).filter(OrderItemDB.order_id == db_order.id).all()
-    for item in db_order.items:
-        item.shop_item = db.query(ShopItemDB).get(item.shop_item_id)
-    item_ids = [item.id for item in db_order.items]
-    return {
-        "id": db_order.id,
-        "customer_id": db_order.customer_id,
-        "item_ids": item_ids,
-        "customer": db_order.customer,
-        "items": db_order.items
-    }
+# --- NDJSON export ---
+# Full-table dumps stream one JSON document per line. Rows are fetched with
+# yield_per, so only one chunk of ORM objects is alive at a time, and each chunk
+# is flushed to the client before the next one is read.
+EXPORTS = {
+    "customers": (CustomerDB, Customer, ()),
+    "categories": (ShopItemCategoryDB, ShopItemCategory, ()),
+    "shop_items": (ShopItemDB, ShopItem, (selectinload(ShopItemDB.categories),)),
+    "order_items": (
+        OrderItemDB,
+        OrderItem,
+        (selectinload(OrderItemDB.shop_item).selectinload(ShopItemDB.categories),),
+    ),
+    "orders": (OrderDB, Order, order_load_options()),
+}
 
-# --- Order by_oid(oid: int, order: OrderCreate, db: Session = Depends(get_db)):
-# Unassign all current order items
-    db.query(OrderItemDB).filter(OrderItemDB.order_id == db_order.id).update({"order_id": None})
-    db.commit()
-    # Assign new order items
-    items = db.query(OrderItemDB).filter(OrderItemDB.id.in_(order.item_ids)).all()
-    for item in items:
-        item.order_id = db_order.id
-    db.commit()
-    db.refresh(db_order)
-    db_order.items = db.query(OrderItemDB).filter(OrderItemDB.order_id == db_order.id).all()
-    for item in db_order.items:
-        item.shop_item = db.query(ShopItemDB).get(item.shop_item_id)
-    item_ids = [item.id for item in db_order.items]
-    return {
-        "id": db_order.id,
-        "customer_id": db_order.customer_id,
-        "item_ids": item_ids,
-        "customer": db_order.customer,
-        "items": db_order.items
-    }
\ No newline at end of file
+# Entity -> (Core select of the row columns, id column, dict builder) for FAST_SERIALIZATION
+FAST_EXPORTS = {
+    "order_items": (order_item_columns, OrderItemDB.id, fast_order_items),
+    "orders": (lambda: select(OrderDB.id, OrderDB.customer_id), OrderDB.id, fast_orders),
+}
+
+def fast_export_chunks(db: Session, entity: str):
+    columns, id_column, build = FAST_EXPORTS[entity]
+    page = Page(None, EXPORT_CHUNK_SIZE)
+    while True:
+        rows, cursor = split_page(db.execute(keyset(columns(), id_column, page)).all(), page)
+        if rows:
+            yield b"\n".join(orjson.dumps(row) for row in build(db, rows)) + b"\n"
+        if cursor is None:
+            return
+        page = Page(rows[-1].id, EXPORT_CHUNK_SIZE)
+
+def export_chunks(entity: str):
+    model, schema, options = EXPORTS[entity]
+    db = ReadSessionLocal()
+    try:
+        if FAST_SERIALIZATION and entity in FAST_EXPORTS:
+            yield from fast_export_chunks(db, entity)
+            return
+        rows = db.query(model).options(*options).order_by(model.id).yield_per(EXPORT_CHUNK_SIZE)
+        lines = []
+        for row in rows:
+            if model is OrderDB:
+                row = assemble_order(row)
+            lines.append(schema.model_validate(row, from_attributes=True).model_dump_json())
+            if len(lines) >= EXPORT_CHUNK_SIZE:
+                yield ("\n".join(lines) + "\n").encode()
+                lines = []
+        if lines:
+            yield ("\n".join(lines) + "\n").encode()
+    finally:
+        db.close()
+
+async def stream_until_disconnect(request: Request, chunks):
+    # The database work runs on the threadpool one chunk at a time; once the
+    # client goes away the generator is closed, which releases its connection.
+    try:
+        while not await request.is_disconnected():
+            chunk = await run_in_threadpool(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        chunks.close()
+
+@app.get("/export/{entity}")
+def export_entity(entity: str, request: Request):
+    if entity not in EXPORTS:
+        raise HTTPException(status_code=404, detail="Unknown export entity")
+    return StreamingResponse(
+        stream_until_disconnect(request, export_chunks(entity)),
+        media_type="application/x-ndjson",
+    )
+
+# --- Catalog import ---
+# POST /imports streams the upload into a temporary file and returns 202 with a
+# job; a background task then parses it row by row (see app/imports.py),
+# validates IMPORT_CHUNK_SIZE rows at a time on the threadpool, resolving
+# category titles through a title -> id map loaded when the job starts, and
+# upserts each chunk in a transaction of its own through run_write. Other writers
+# queue on writer_lock between chunks only, so the API stays responsive during a
+# long import. GET /imports/{id} reports a job's progress until a restart.
+def load_import_titles():
+    with ReadSessionLocal() as db:
+        return load_category_titles(db)
+
+def upsert_shop_items(db: Session, rows):
+    """Write (line, ShopItemImportRow, category ids) rows; returns (created ids, updated ids)."""
+    by_id, new = {}, []
+    for _, row, category_ids in rows:
+        values = {"title": row.title, "description": row.description, "price": row.price}
+        if row.id is None:
+            new.append((values, category_ids))
+        else:
+            # A later row for the same id wins
+            by_id[row.id] = ({"id": row.id, **values}, category_ids)
+    existing = set(db.execute(select(ShopItemDB.id).where(ShopItemDB.id.in_(by_id))).scalars())
+    updated = [item_id for item_id in by_id if item_id in existing]
+    if updated:
+        # Before the links change, so the rollups of the categories items leave are refreshed too
+        touch_shop_items(db, updated)
+        db.execute(update(ShopItemDB), [by_id[item_id][0] for item_id in updated])
+        db.execute(delete(shopitem_category).where(shopitem_category.c.shopitem_id.in_(updated)))
+    with_id = [by_id[item_id] for item_id in by_id if item_id not in existing]
+    # Two executemany batches, as every row of one needs the same columns
+    created = bulk_insert(db, ShopItemDB, [values for values, _ in with_id])
+    created += bulk_insert(db, ShopItemDB, [values for values, _ in new])
+    category_ids = [by_id[item_id][1] for item_id in updated] + [cids for _, cids in with_id + new]
+    links = [
+        {"shopitem_id": item_id, "category_id": cid}
+        for item_id, cids in zip(updated + created, category_ids)
+        for cid in cids
+    ]
+    if links:
+        db.execute(shopitem_category.insert(), links)
+    record_changes(db, "shop_items", created, "create")
+    touch_shop_items(db, created)
+    return created, updated
+
+async def write_import_chunk(rows):
+    created, updated = await run_write(lambda db: upsert_shop_items(db, rows))
+    invalidate_shop_items(*created, *updated)
+    return created, updated
+
+import_runner = ImportRunner(
+    load_import_titles,
+    write_import_chunk,
+    chunk_size=IMPORT_CHUNK_SIZE,
+    max_errors=MAX_IMPORT_ERRORS,
+    max_jobs=MAX_IMPORT_JOBS,
+)
+
+@app.post("/imports", status_code=202)
+async def create_import(
+    request: Request,
+    response: Response,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+):
+    if format is None:
+        content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+        format = IMPORT_CONTENT_TYPES.get(content_type)
+        if format is None:
+            raise HTTPException(
+                status_code=415,
+                detail=f"Send text/csv or application/x-ndjson, or pass ?format= ({', '.join(IMPORT_FORMATS)})",
+            )
+    raw = tempfile.TemporaryFile()
+    try:
+        async for chunk in request.stream():
+            raw.write(chunk)
+        size = raw.tell()
+        raw.seek(0)
+    except BaseException:
+        raw.close()
+        raise
+    job = import_runner.start(format, raw, size)
+    response.headers["Location"] = f"/imports/{job.id}"
+    return job.report()
+
+@app.get("/imports/{job_id}")
+def get_import(job_id: int):
+    job = import_runner.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return job.report()
+
+@app.on_event("shutdown")
+async def cancel_imports():
+    import_runner.cancel()
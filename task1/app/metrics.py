@@ -0,0 +1,245 @@
+"""Per-request SQL instrumentation and Prometheus text exposition.
+
+``SQLMetricsMiddleware`` opens a ``RequestStats`` for every HTTP request and
+keeps it in a context variable; the engine listeners installed by
+``instrument_engine`` add each statement's count, duration and fetched rows to
+whichever request is current (the threadpool, the async greenlets and streamed
+response bodies all inherit the variable). When the response starts the totals
+go out as a ``Server-Timing`` header, and when it ends they are added to the
+per-route series in ``MetricsRegistry``.
+
+Statements slower than ``slow_query_seconds`` are logged with their route.
+"""
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine.cursor import CursorFetchStrategy
+
+slow_query_log = logging.getLogger("app.slow_queries")
+
+# Prometheus' default latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+
+class RequestStats:
+    __slots__ = ("route", "statements", "db_time", "rows", "coalesced")
+
+    def __init__(self, route: str = "unmatched"):
+        self.route = route
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.coalesced = False  # served from another request's in-flight load
+
+
+current_stats: ContextVar[Optional[RequestStats]] = ContextVar("current_stats", default=None)
+
+
+class CountingFetchStrategy(CursorFetchStrategy):
+    """Cursor fetch strategy that adds the rows it hands out to a RequestStats."""
+
+    __slots__ = ("stats",)
+
+    def __init__(self, stats: RequestStats):
+        self.stats = stats
+
+    def yield_per(self, result, dbapi_cursor, num):
+        # Keep counting; the caller already fetches num rows per fetchmany
+        pass
+
+    def fetchone(self, result, dbapi_cursor, hard_close=False):
+        row = super().fetchone(result, dbapi_cursor, hard_close)
+        if row is not None:
+            self.stats.rows += 1
+        return row
+
+    def fetchmany(self, result, dbapi_cursor, size=None):
+        rows = super().fetchmany(result, dbapi_cursor, size)
+        self.stats.rows += len(rows)
+        return rows
+
+    def fetchall(self, result, dbapi_cursor):
+        rows = super().fetchall(result, dbapi_cursor)
+        self.stats.rows += len(rows)
+        return rows
+
+
+def instrument_engine(engine, slow_query_seconds: Optional[float] = None):
+    """Attribute every statement run on engine to the current request."""
+    # Async engines expose their events on the wrapped sync engine
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        stats = current_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_time += elapsed
+            if cursor.description is not None:
+                # The result is built after this event, from the context's strategy
+                context.cursor_fetch_strategy = CountingFetchStrategy(stats)
+            elif cursor.rowcount > 0:
+                stats.rows += cursor.rowcount
+        if slow_query_seconds and elapsed >= slow_query_seconds:
+            slow_query_log.warning(
+                "slow query (%.1f ms) on %s: %s",
+                elapsed * 1000, stats.route if stats is not None else "-", statement,
+            )
+
+    return engine
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            yield f'{name}_bucket{{{labels},le="{bound:g}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.sum:.6f}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class RouteMetrics:
+    __slots__ = ("latency", "statements", "db_time", "rows", "coalesced", "responses")
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_time = 0.0
+        self.rows = 0
+        self.coalesced = 0
+        self.responses = {}  # status code -> count
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._routes = {}  # (method, route) -> RouteMetrics
+        self._lock = threading.Lock()
+
+    def observe(self, method: str, stats: RequestStats, status: int, duration: float):
+        with self._lock:
+            metrics = self._routes.get((method, stats.route))
+            if metrics is None:
+                metrics = self._routes[(method, stats.route)] = RouteMetrics()
+            metrics.latency.observe(duration)
+            metrics.statements.observe(stats.statements)
+            metrics.db_time += stats.db_time
+            metrics.rows += stats.rows
+            metrics.coalesced += stats.coalesced
+            metrics.responses[status] = metrics.responses.get(status, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+    def render(self) -> str:
+        """The collected series in the Prometheus text exposition format."""
+        with self._lock:
+            routes = sorted(self._routes.items())
+            sections = {
+                "shop_http_request_duration_seconds": ("histogram", "Request latency by route."),
+                "shop_http_request_sql_statements": ("histogram", "SQL statements executed per request."),
+                "shop_http_request_db_seconds_total": ("counter", "Time spent executing SQL, by route."),
+                "shop_http_request_db_rows_total": ("counter", "Rows fetched or written by SQL, by route."),
+                "shop_http_coalesced_requests_total": (
+                    "counter", "Requests answered from another request's in-flight load, by route."),
+                "shop_http_responses_total": ("counter", "Responses by route and status code."),
+            }
+            lines = {name: [] for name in sections}
+            for (method, route), m in routes:
+                labels = f'method="{method}",route="{escape_label(route)}"'
+                lines["shop_http_request_duration_seconds"] += m.latency.samples(
+                    "shop_http_request_duration_seconds", labels)
+                lines["shop_http_request_sql_statements"] += m.statements.samples(
+                    "shop_http_request_sql_statements", labels)
+                lines["shop_http_request_db_seconds_total"].append(
+                    f"shop_http_request_db_seconds_total{{{labels}}} {m.db_time:.6f}")
+                lines["shop_http_request_db_rows_total"].append(
+                    f"shop_http_request_db_rows_total{{{labels}}} {m.rows}")
+                lines["shop_http_coalesced_requests_total"].append(
+                    f"shop_http_coalesced_requests_total{{{labels}}} {m.coalesced}")
+                for status, n in sorted(m.responses.items()):
+                    lines["shop_http_responses_total"].append(
+                        f'shop_http_responses_total{{{labels},status="{status}"}} {n}')
+        out = []
+        for name, (kind, help_text) in sections.items():
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", *lines[name]]
+        return "\n".join(out) + "\n"
+
+
+def server_timing(stats: RequestStats, elapsed: float) -> str:
+    return (
+        f'db;dur={stats.db_time * 1000:.2f};desc="{stats.statements} statements, {stats.rows} rows", '
+        f"app;dur={elapsed * 1000:.2f}"
+    )
+
+
+class SQLMetricsMiddleware:
+    """ASGI middleware recording per-route latency and SQL totals into a registry."""
+
+    def __init__(self, app, registry: MetricsRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats()
+        token = current_stats.set(stats)
+        start = time.perf_counter()
+        status = 500
+
+        def resolve_route():
+            # The router stores the matched route in the scope it was given
+            route = scope.get("route")
+            if route is not None:
+                stats.route = getattr(route, "path", stats.route)
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                resolve_route()
+                headers = list(message.get("headers", ()))
+                headers.append((b"server-timing", server_timing(stats, time.perf_counter() - start).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            resolve_route()
+            self.registry.observe(scope["method"], stats, status, time.perf_counter() - start)
+            current_stats.reset(token)
@@ -0,0 +1,230 @@
+"""Versioned schema migrations for shop.db.
+
+The schema version lives in SQLite's ``PRAGMA user_version``, so checking it at
+startup is a single header read. Each migration runs in its own
+``BEGIN IMMEDIATE`` transaction: that takes the database write lock before the
+version is re-read, so when several workers start at once exactly one applies
+each step and the others wait, see the new version and skip it.
+
+Migrations are plain SQL and must never be edited once released; add a new one.
+
+    python -m app.migrations    # bring the configured database up to date
+"""
+from typing import List, NamedTuple, Sequence
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    statements: Sequence[str]
+
+
+MIGRATIONS = [
+    Migration(1, "baseline schema", [
+        # IF NOT EXISTS adopts databases created by the old create_all startup hook
+        """CREATE TABLE IF NOT EXISTS customers (
+            id INTEGER NOT NULL,
+            name VARCHAR NOT NULL,
+            surname VARCHAR NOT NULL,
+            email VARCHAR NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (email)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_customers_id ON customers (id)",
+        """CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER NOT NULL,
+            title VARCHAR NOT NULL,
+            description TEXT,
+            PRIMARY KEY (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_categories_id ON categories (id)",
+        """CREATE TABLE IF NOT EXISTS shop_items (
+            id INTEGER NOT NULL,
+            title VARCHAR NOT NULL,
+            description TEXT,
+            price FLOAT NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_shop_items_id ON shop_items (id)",
+        """CREATE TABLE IF NOT EXISTS shopitem_category (
+            shopitem_id INTEGER,
+            category_id INTEGER,
+            FOREIGN KEY(shopitem_id) REFERENCES shop_items (id),
+            FOREIGN KEY(category_id) REFERENCES categories (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER NOT NULL,
+            customer_id INTEGER,
+            PRIMARY KEY (id),
+            FOREIGN KEY(customer_id) REFERENCES customers (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_orders_id ON orders (id)",
+        """CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER NOT NULL,
+            shop_item_id INTEGER,
+            quantity INTEGER NOT NULL,
+            order_id INTEGER,
+            PRIMARY KEY (id),
+            FOREIGN KEY(shop_item_id) REFERENCES shop_items (id),
+            FOREIGN KEY(order_id) REFERENCES orders (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_order_items_id ON order_items (id)",
+    ]),
+    Migration(2, "entity versions for ETags", [
+        """CREATE TABLE entity_versions (
+            key VARCHAR NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (key)
+        )""",
+    ]),
+    Migration(3, "full-text index over shop items", [
+        # External-content FTS5 table (no copy of the text) kept in sync by
+        # triggers, so every write path, bulk inserts included, updates it
+        """CREATE VIRTUAL TABLE shop_items_fts USING fts5(
+            title, description, content='shop_items', content_rowid='id', tokenize='porter unicode61'
+        )""",
+        """CREATE TRIGGER shop_items_fts_insert AFTER INSERT ON shop_items BEGIN
+            INSERT INTO shop_items_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+        END""",
+        """CREATE TRIGGER shop_items_fts_delete AFTER DELETE ON shop_items BEGIN
+            INSERT INTO shop_items_fts(shop_items_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+        END""",
+        """CREATE TRIGGER shop_items_fts_update AFTER UPDATE ON shop_items BEGIN
+            INSERT INTO shop_items_fts(shop_items_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+            INSERT INTO shop_items_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+        END""",
+        "INSERT INTO shop_items_fts(shop_items_fts) VALUES ('rebuild')",
+    ]),
+    Migration(4, "shopitem_category primary key and browse indexes", [
+        """CREATE TABLE shopitem_category_new (
+            shopitem_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            PRIMARY KEY (shopitem_id, category_id),
+            FOREIGN KEY(shopitem_id) REFERENCES shop_items (id),
+            FOREIGN KEY(category_id) REFERENCES categories (id)
+        )""",
+        """INSERT OR IGNORE INTO shopitem_category_new (shopitem_id, category_id)
+            SELECT shopitem_id, category_id FROM shopitem_category
+            WHERE shopitem_id IS NOT NULL AND category_id IS NOT NULL""",
+        "DROP TABLE shopitem_category",
+        "ALTER TABLE shopitem_category_new RENAME TO shopitem_category",
+        "CREATE INDEX ix_shopitem_category_category_id ON shopitem_category (category_id, shopitem_id)",
+        "CREATE INDEX ix_shop_items_price ON shop_items (price)",
+    ]),
+    Migration(5, "change log", [
+        """CREATE TABLE changes (
+            seq INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            entity VARCHAR NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op VARCHAR NOT NULL,
+            state TEXT,
+            created_at FLOAT NOT NULL
+        )""",
+        "CREATE INDEX ix_changes_created_at ON changes (created_at)",
+    ]),
+    Migration(6, "foreign key indexes and sales rollups", [
+        "CREATE INDEX ix_order_items_order_id ON order_items (order_id)",
+        "CREATE INDEX ix_order_items_shop_item_id ON order_items (shop_item_id)",
+        "CREATE INDEX ix_orders_customer_id ON orders (customer_id)",
+        """CREATE TABLE sales_by_shop_item (
+            shop_item_id INTEGER NOT NULL PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            units INTEGER NOT NULL,
+            revenue FLOAT NOT NULL
+        )""",
+        "CREATE INDEX ix_sales_by_shop_item_units ON sales_by_shop_item (units)",
+        "CREATE INDEX ix_sales_by_shop_item_revenue ON sales_by_shop_item (revenue)",
+        """CREATE TABLE sales_by_category (
+            category_id INTEGER NOT NULL PRIMARY KEY,
+            shop_items INTEGER NOT NULL,
+            units INTEGER NOT NULL,
+            revenue FLOAT NOT NULL
+        )""",
+        "CREATE INDEX ix_sales_by_category_revenue ON sales_by_category (revenue)",
+        """CREATE TABLE sales_by_customer (
+            customer_id INTEGER NOT NULL PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            units INTEGER NOT NULL,
+            spend FLOAT NOT NULL
+        )""",
+        "CREATE INDEX ix_sales_by_customer_spend ON sales_by_customer (spend)",
+        # Backfill; `python -m app.rollups` does the same for data loaded behind the app's back
+        """INSERT INTO sales_by_shop_item (shop_item_id, orders, units, revenue)
+            SELECT oi.shop_item_id, count(DISTINCT oi.order_id), sum(oi.quantity), sum(oi.quantity * si.price)
+            FROM order_items oi
+            JOIN orders o ON o.id = oi.order_id
+            JOIN shop_items si ON si.id = oi.shop_item_id
+            GROUP BY oi.shop_item_id""",
+        """INSERT INTO sales_by_category (category_id, shop_items, units, revenue)
+            SELECT sc.category_id, count(*), sum(s.units), sum(s.revenue)
+            FROM sales_by_shop_item s
+            JOIN shopitem_category sc ON sc.shopitem_id = s.shop_item_id
+            JOIN categories c ON c.id = sc.category_id
+            GROUP BY sc.category_id""",
+        """INSERT INTO sales_by_customer (customer_id, orders, units, spend)
+            SELECT o.customer_id, count(DISTINCT o.id), sum(oi.quantity), sum(oi.quantity * si.price)
+            FROM orders o
+            JOIN customers c ON c.id = o.customer_id
+            JOIN order_items oi ON oi.order_id = o.id
+            JOIN shop_items si ON si.id = oi.shop_item_id
+            GROUP BY o.customer_id""",
+    ]),
+    Migration(7, "order snapshots", [
+        # Filled by the app as orders are written; backfill with `python -m app.snapshots rebuild`
+        """CREATE TABLE order_snapshots (
+            order_id INTEGER NOT NULL PRIMARY KEY,
+            version INTEGER NOT NULL,
+            body BLOB NOT NULL
+        )""",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def schema_version(engine) -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine, migrations: Sequence[Migration] = MIGRATIONS) -> List[int]:
+    """Apply pending migrations and return the versions this call applied."""
+    applied = []
+    raw = engine.raw_connection()
+    try:
+        dbapi = raw.driver_connection
+        isolation_level = dbapi.isolation_level
+        # Manage transactions by hand so BEGIN IMMEDIATE and DDL are not reordered
+        dbapi.isolation_level = None
+        try:
+            for migration in migrations:
+                dbapi.execute("BEGIN IMMEDIATE")
+                try:
+                    if dbapi.execute("PRAGMA user_version").fetchone()[0] >= migration.version:
+                        dbapi.execute("ROLLBACK")
+                        continue
+                    for statement in migration.statements:
+                        dbapi.execute(statement)
+                    dbapi.execute(f"PRAGMA user_version = {int(migration.version)}")
+                    dbapi.execute("COMMIT")
+                except BaseException:
+                    dbapi.execute("ROLLBACK")
+                    raise
+                applied.append(migration.version)
+        finally:
+            dbapi.isolation_level = isolation_level
+    finally:
+        raw.close()
+    return applied
+
+
+if __name__ == "__main__":
+    from app.main import engine
+
+    versions = migrate(engine)
+    if versions:
+        print(f"Applied migrations {versions}; schema is at version {LATEST_VERSION}")
+    else:
+        print(f"Schema already at version {schema_version(engine)}")
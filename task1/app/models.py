@@ -0,0 +1,117 @@
+"""SQLAlchemy models of the shop's tables.
+
+The schema is created and upgraded by app/migrations.py; tests/test_migrations.py
+checks that the two agree. The models live apart from app/main.py so the feature
+modules (app/changes.py, ...) can query their tables without importing the app.
+"""
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, LargeBinary, String, Table, Text
+from sqlalchemy.orm import declarative_base, relationship
+
+Base = declarative_base()
+
+
+# Association table for many-to-many relationship between ShopItem and ShopItemCategory
+shopitem_category = Table(
+    "shopitem_category",
+    Base.metadata,
+    Column("shopitem_id", Integer, ForeignKey("shop_items.id"), primary_key=True),
+    Column("category_id", Integer, ForeignKey("categories.id"), primary_key=True),
+    # The primary key serves item -> categories; this serves category -> items in id order
+    Index("ix_shopitem_category_category_id", "category_id", "shopitem_id"),
+)
+
+
+class CustomerDB(Base):
+    __tablename__ = "customers"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)
+    surname = Column(String, nullable=False)
+    email = Column(String, unique=True, nullable=False)
+
+
+class ShopItemCategoryDB(Base):
+    __tablename__ = "categories"
+    id = Column(Integer, primary_key=True, index=True)
+    title = Column(String, nullable=False)
+    description = Column(Text, nullable=True)
+
+
+class ShopItemDB(Base):
+    __tablename__ = "shop_items"
+    id = Column(Integer, primary_key=True, index=True)
+    title = Column(String, nullable=False)
+    description = Column(Text, nullable=True)
+    price = Column(Float, nullable=False, index=True)
+    # Ordered so responses list categories the same way on every load path
+    categories = relationship(
+        "ShopItemCategoryDB", secondary=shopitem_category, backref="shop_items", order_by=ShopItemCategoryDB.id
+    )
+
+
+class OrderItemDB(Base):
+    __tablename__ = "order_items"
+    id = Column(Integer, primary_key=True, index=True)
+    shop_item_id = Column(Integer, ForeignKey("shop_items.id"), index=True)
+    quantity = Column(Integer, nullable=False)
+    shop_item = relationship("ShopItemDB")
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)  # <-- Add this line
+
+
+class OrderDB(Base):
+    __tablename__ = "orders"
+    id = Column(Integer, primary_key=True, index=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), index=True)
+    customer = relationship("CustomerDB")
+    items = relationship("OrderItemDB", cascade="all, delete-orphan", backref="order")  # <-- Add backref
+
+
+class EntityVersionDB(Base):
+    # One row per table ("orders") and per entity ("orders:7"), bumped on every write
+    __tablename__ = "entity_versions"
+    key = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+class ChangeDB(Base):
+    # Append-only log of entity writes, read by GET /changes in seq order
+    __tablename__ = "changes"
+    __table_args__ = {"sqlite_autoincrement": True}
+    seq = Column(Integer, primary_key=True)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)
+    state = Column(Text, nullable=True)  # JSON of the row after the write, null for deletes
+    created_at = Column(Float, nullable=False, index=True)
+
+
+# Sales rollups, kept current by every order write (see app/rollups.py)
+class SalesByShopItemDB(Base):
+    __tablename__ = "sales_by_shop_item"
+    shop_item_id = Column(Integer, primary_key=True)
+    orders = Column(Integer, nullable=False)
+    units = Column(Integer, nullable=False, index=True)
+    revenue = Column(Float, nullable=False, index=True)
+
+
+class SalesByCategoryDB(Base):
+    __tablename__ = "sales_by_category"
+    category_id = Column(Integer, primary_key=True)
+    shop_items = Column(Integer, nullable=False)
+    units = Column(Integer, nullable=False)
+    revenue = Column(Float, nullable=False, index=True)
+
+
+class SalesByCustomerDB(Base):
+    __tablename__ = "sales_by_customer"
+    customer_id = Column(Integer, primary_key=True)
+    orders = Column(Integer, nullable=False)
+    units = Column(Integer, nullable=False)
+    spend = Column(Float, nullable=False, index=True)
+
+
+class OrderSnapshotDB(Base):
+    # The serialized GET /orders/{oid} body, rebuilt in every transaction that touches the order
+    __tablename__ = "order_snapshots"
+    order_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)  # the order's entity version the body was built at
+    body = Column(LargeBinary, nullable=False)
@@ -0,0 +1,245 @@
+"""On-demand sampling profiler with per-endpoint collapsed stacks.
+
+``ProfilingMiddleware`` resolves which endpoint function a request will run and
+profiles it with the probability configured for that endpoint (the default
+fraction is 0, which costs one dict lookup per request). A profiled request is
+marked in a context variable. While any profiled request is in flight, a
+sampler thread snapshots the stack of every thread every ``interval`` seconds.
+A stack belongs to a profiled request when the context it runs in holds the
+mark, which covers the event loop (the context of the running asyncio handle),
+the threadpool (the context anyio runs the call in) and functions called
+through ``run_in_context``. Its frames are then counted under the request's
+endpoint.
+
+``Profiler.collapsed`` renders the counts in the collapsed-stack format read
+by flamegraph.pl, speedscope and similar tools: one ``root;caller;callee
+count`` line per distinct stack.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from starlette.routing import Match
+
+# Distinct stacks kept per endpoint; further new stacks are counted as "[other]"
+MAX_STACKS = 5000
+
+
+# The endpoint function name of the profiled request being handled
+current_profile: ContextVar[Optional[str]] = ContextVar("current_profile", default=None)
+
+
+def code_of(fn):
+    while isinstance(fn, functools.partial):
+        fn = fn.func
+    return getattr(getattr(fn, "__func__", fn), "__code__", None)
+
+
+def run_in_context(fn, *args, **kwargs):
+    """Call fn; its stack is attributed through this frame.
+
+    For code whose stack does not reach the event loop or the threadpool, such
+    as the greenlets AsyncSession.run_sync runs functions in.
+    """
+    context = contextvars.copy_context()  # noqa: F841 (read by the sampler)
+    return fn(*args, **kwargs)
+
+
+def _context_runners():
+    """code object -> function of a frame's locals returning (Context, code of the callee or None).
+
+    Both frames run one callable in a Context; the callee's code, when known,
+    tells the call apart from the runner's own bookkeeping around it.
+    """
+    runners = {
+        asyncio.events.Handle._run.__code__: lambda f_locals: (f_locals["self"]._context, None),
+        run_in_context.__code__: lambda f_locals: (f_locals["context"], code_of(f_locals["fn"])),
+    }
+    try:
+        from anyio._backends._asyncio import WorkerThread
+    except ImportError:  # threadpool calls are not attributed without it
+        return runners
+    runners[WorkerThread.run.__code__] = lambda f_locals: (f_locals.get("context"), code_of(f_locals.get("func")))
+    return runners
+
+
+CONTEXT_RUNNERS = _context_runners()
+
+
+def frame_label(code) -> str:
+    path = code.co_filename
+    marker = f"site-packages{os.sep}"
+    if marker in path:
+        path = path.split(marker, 1)[1]
+    else:
+        path = os.path.join(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+def attribute(frame):
+    """(endpoint, labels outermost first) for a stack of a profiled request, else None."""
+    labels, outermost = [], None
+    while frame is not None:
+        runner = CONTEXT_RUNNERS.get(frame.f_code)
+        if runner is not None:
+            try:
+                context, callee = runner(frame.f_locals)
+            except (AttributeError, KeyError):
+                return None
+            endpoint = context.get(current_profile) if context is not None else None
+            if endpoint is None or outermost is None or callee not in (None, outermost):
+                return None
+            labels.reverse()
+            return endpoint, labels
+        labels.append(frame_label(frame.f_code))
+        outermost = frame.f_code
+        frame = frame.f_back
+    return None
+
+
+class EndpointProfile:
+    __slots__ = ("requests", "samples", "stacks")
+
+    def __init__(self):
+        self.requests = 0
+        self.samples = 0
+        self.stacks = Counter()  # "frame;frame;..." -> samples
+
+
+class Profiler:
+    def __init__(self, fraction: float = 0.0, interval: float = 0.005):
+        self.fraction = fraction  # default probability of profiling a request
+        self.fractions: Dict[str, float] = {}  # per endpoint function name, overriding fraction
+        self.interval = interval
+        self._profiles: Dict[str, EndpointProfile] = {}
+        self._active = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.fraction > 0 or any(f > 0 for f in self.fractions.values())
+
+    def configure(self, fraction: Optional[float] = None, fractions: Optional[Dict[str, float]] = None,
+                  interval: Optional[float] = None):
+        with self._lock:
+            if fraction is not None:
+                self.fraction = fraction
+            if fractions is not None:
+                self.fractions = dict(fractions)
+            if interval is not None:
+                self.interval = interval
+
+    def should_profile(self, endpoint: str) -> bool:
+        fraction = self.fractions.get(endpoint, self.fraction)
+        return fraction > 0 and (fraction >= 1 or random.random() < fraction)
+
+    def begin(self, endpoint: str):
+        with self._lock:
+            self._profiles.setdefault(endpoint, EndpointProfile()).requests += 1
+            self._active += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+            self._wake.notify()
+
+    def end(self):
+        with self._lock:
+            self._active -= 1
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._active:
+                    self._wake.wait()
+                interval = self.interval
+            self.sample()
+            time.sleep(interval)
+
+    def sample(self):
+        own = threading.get_ident()
+        found = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            attributed = attribute(frame)
+            if attributed is not None:
+                found.append(attributed)
+        with self._lock:
+            for endpoint, labels in found:
+                profile = self._profiles.setdefault(endpoint, EndpointProfile())
+                stack = ";".join([endpoint] + labels)
+                if stack not in profile.stacks and len(profile.stacks) >= MAX_STACKS:
+                    stack = f"{endpoint};[other]"
+                profile.stacks[stack] += 1
+                profile.samples += 1
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "fraction": self.fraction,
+                "fractions": dict(self.fractions),
+                "interval_ms": self.interval * 1000,
+                "endpoints": {
+                    name: {"requests": p.requests, "samples": p.samples, "stacks": len(p.stacks)}
+                    for name, p in sorted(self._profiles.items())
+                },
+            }
+
+    def collapsed(self, endpoint: Optional[str] = None) -> str:
+        """The samples of endpoint (every endpoint if None) as collapsed stacks, most frequent first."""
+        with self._lock:
+            if endpoint is None:
+                profiles = list(self._profiles.values())
+            else:
+                profiles = [self._profiles[endpoint]] if endpoint in self._profiles else []
+            stacks = Counter()
+            for profile in profiles:
+                stacks.update(profile.stacks)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class ProfilingMiddleware:
+    """ASGI middleware marking the requests picked for profiling by their endpoint function."""
+
+    def __init__(self, app, profiler: Profiler, router):
+        self.app = app
+        self.profiler = profiler
+        self.router = router
+
+    def endpoint_for(self, scope) -> Optional[str]:
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                endpoint = getattr(route, "endpoint", None)
+                return getattr(endpoint, "__name__", None)
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.enabled:
+            await self.app(scope, receive, send)
+            return
+        endpoint = self.endpoint_for(scope)
+        if endpoint is None or not self.profiler.should_profile(endpoint):
+            await self.app(scope, receive, send)
+            return
+        token = current_profile.set(endpoint)
+        self.profiler.begin(endpoint)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.end()
+            current_profile.reset(token)
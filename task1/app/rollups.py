@@ -0,0 +1,96 @@
+"""Sales rollups: units and revenue per shop item, category and customer.
+
+Three small tables hold the totals the analytics endpoints serve, so a
+dashboard read is an index scan over a few hundred rows instead of a join over
+every order line:
+
+* ``sales_by_shop_item``: orders, units and revenue per shop item;
+* ``sales_by_category``: the sums of its shop items' rows (a shop item in two
+  categories counts towards both);
+* ``sales_by_customer``: orders, units and spend per customer.
+
+Only lines that belong to an order count, at the shop item's current price.
+Writers call ``refresh`` with the keys their transaction touched, before it
+commits; each key's row is recomputed from the source tables, so the totals
+never drift. ``rebuild`` recomputes every row, for backfills:
+
+    python -m app.rollups
+"""
+from sqlalchemy import bindparam, text
+
+ITEM_SALES = """
+    SELECT oi.shop_item_id, count(DISTINCT oi.order_id), sum(oi.quantity), sum(oi.quantity * si.price)
+    FROM order_items oi
+    JOIN orders o ON o.id = oi.order_id
+    JOIN shop_items si ON si.id = oi.shop_item_id
+    {where} GROUP BY oi.shop_item_id"""
+
+CATEGORY_SALES = """
+    SELECT sc.category_id, count(*), sum(s.units), sum(s.revenue)
+    FROM sales_by_shop_item s
+    JOIN shopitem_category sc ON sc.shopitem_id = s.shop_item_id
+    JOIN categories c ON c.id = sc.category_id
+    {where} GROUP BY sc.category_id"""
+
+CUSTOMER_SALES = """
+    SELECT o.customer_id, count(DISTINCT o.id), sum(oi.quantity), sum(oi.quantity * si.price)
+    FROM orders o
+    JOIN customers c ON c.id = o.customer_id
+    JOIN order_items oi ON oi.order_id = o.id
+    JOIN shop_items si ON si.id = oi.shop_item_id
+    {where} GROUP BY o.customer_id"""
+
+# (table, key column, value columns, source query, key column in the source query)
+ROLLUPS = (
+    ("sales_by_shop_item", "shop_item_id", "orders, units, revenue", ITEM_SALES, "oi.shop_item_id"),
+    ("sales_by_category", "category_id", "shop_items, units, revenue", CATEGORY_SALES, "sc.category_id"),
+    ("sales_by_customer", "customer_id", "orders, units, spend", CUSTOMER_SALES, "o.customer_id"),
+)
+
+
+def recompute(conn, rollup, ids=None):
+    """Replace the rows for ids (every row if None) with fresh totals."""
+    table, key, values, source, source_key = rollup
+    if ids is None:
+        conn.execute(text(f"DELETE FROM {table}"))
+        conn.execute(text(f"INSERT INTO {table} ({key}, {values}) {source.format(where='')}"))
+        return
+    if not ids:
+        return
+    params = {"ids": list(ids)}
+    conn.execute(text(f"DELETE FROM {table} WHERE {key} IN :ids").bindparams(bindparam("ids", expanding=True)), params)
+    conn.execute(
+        text(f"INSERT INTO {table} ({key}, {values}) {source.format(where=f'WHERE {source_key} IN :ids')}")
+        .bindparams(bindparam("ids", expanding=True)),
+        params,
+    )
+
+
+def refresh(conn, shop_item_ids=(), category_ids=(), customer_ids=()):
+    """Recompute the rows of the given keys; categories of the shop items are included."""
+    shop_item_ids, category_ids = set(shop_item_ids), set(category_ids)
+    if shop_item_ids:
+        category_ids.update(conn.execute(
+            text("SELECT category_id FROM shopitem_category WHERE shopitem_id IN :ids")
+            .bindparams(bindparam("ids", expanding=True)),
+            {"ids": list(shop_item_ids)},
+        ).scalars())
+    items, categories, customers = ROLLUPS
+    recompute(conn, items, shop_item_ids)
+    # After the shop items, whose rows the category totals are summed from
+    recompute(conn, categories, category_ids)
+    recompute(conn, customers, set(customer_ids))
+
+
+def rebuild(conn):
+    for rollup in ROLLUPS:
+        recompute(conn, rollup)
+
+
+if __name__ == "__main__":
+    from app.main import engine
+
+    with engine.begin() as conn:
+        rebuild(conn)
+        counts = {table: conn.execute(text(f"SELECT count(*) FROM {table}")).scalar() for table, *_ in ROLLUPS}
+    print("Rebuilt " + ", ".join(f"{table} ({n} rows)" for table, n in counts.items()))
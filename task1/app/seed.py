@@ -0,0 +1,49 @@
+"""Demo data for local development and the test suite.
+
+Seeding is opt-in and never runs at startup:
+
+    python -m app.seed
+"""
+from app.main import (
+    CustomerDB,
+    OrderDB,
+    OrderItemDB,
+    SessionLocal,
+    ShopItemCategoryDB,
+    ShopItemDB,
+    engine,
+    order_snapshots,
+)
+from app.migrations import migrate
+from app import rollups
+
+
+def seed_demo_data() -> bool:
+    """Load the demo data into an empty database; returns False if it already has data."""
+    db = SessionLocal()
+    try:
+        if db.query(CustomerDB).first() or db.query(ShopItemDB).first():
+            return False
+        alice = CustomerDB(name="Alice", surname="Smith", email="alice@example.com")
+        bob = CustomerDB(name="Bob", surname="Brown", email="bob@example.com")
+        books = ShopItemCategoryDB(title="Books", description="All kinds of books")
+        electronics = ShopItemCategoryDB(title="Electronics", description="Gadgets and devices")
+        book = ShopItemDB(title="Python Book", description="Learn Python", price=29.99, categories=[books])
+        phone = ShopItemDB(title="Smartphone", description="Latest model", price=499.99, categories=[electronics])
+        book_line = OrderItemDB(shop_item=book, quantity=2)
+        phone_line = OrderItemDB(shop_item=phone, quantity=1)
+        order = OrderDB(customer=alice, items=[book_line, phone_line])
+        # Added in id order, and written with a single commit
+        db.add_all([alice, bob, books, electronics, book, phone, book_line, phone_line, order])
+        db.flush()
+        rollups.rebuild(db)
+        order_snapshots.rebuild(db)
+        db.commit()
+        return True
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    migrate(engine)
+    print("Demo data loaded" if seed_demo_data() else "Database already has data; nothing seeded")
@@ -0,0 +1,138 @@
+"""Single-flight coalescing of identical concurrent GET requests.
+
+``SingleFlightMiddleware`` maps a request path to a key (e.g. ``/orders/7`` to
+``orders:7``). The first request for a key and query string becomes the
+leader: it runs through the app as usual while the response is buffered.
+Requests for the same key that arrive while it is in flight wait for it and
+receive a copy of the same status, headers and body, without touching the
+database. Requests carrying If-None-Match, and every other method, bypass the
+layer.
+
+Writers call ``SingleFlight.forget`` with the keys they changed once they have
+committed: the in-flight load no longer takes new followers, so every request
+that starts after the commit sees the new data.
+"""
+import asyncio
+import re
+import threading
+
+from app.metrics import current_stats
+
+
+class Flight:
+    __slots__ = ("key", "future")
+
+    def __init__(self, key, future):
+        self.key = key
+        self.future = future  # resolves to (route, start message, body)
+
+
+class SingleFlight:
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self.forgotten = 0
+        self._flights = {}  # (key, query string) -> Flight
+        self._lock = threading.Lock()
+
+    def join(self, key, query):
+        """(flight, is_leader): the running flight for key and query, or a new one."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flight = self._flights.get((key, query))
+            if flight is not None and flight.future.get_loop() is loop:
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[(key, query)] = Flight(key, loop.create_future())
+            self.leaders += 1
+            return flight, True
+
+    def finish(self, flight, query):
+        with self._lock:
+            # A forgotten flight may already have been replaced by a newer one
+            if self._flights.get((flight.key, query)) is flight:
+                del self._flights[(flight.key, query)]
+
+    def forget(self, *keys):
+        """Stop in-flight loads of keys from taking new followers; safe from any thread."""
+        keys = set(keys)
+        with self._lock:
+            for flight_key in [k for k in self._flights if k[0] in keys]:
+                del self._flights[flight_key]
+                self.forgotten += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "forgotten": self.forgotten,
+                "in_flight": len(self._flights),
+            }
+
+
+class SingleFlightMiddleware:
+    """ASGI middleware coalescing GETs whose path matches one of routes.
+
+    routes maps a regex (matched against the whole path) to a key format, filled
+    with the regex groups, e.g. {r"/orders/(\\d+)": "orders:{}"}.
+    """
+
+    def __init__(self, app, flights: SingleFlight, routes: dict):
+        self.app = app
+        self.flights = flights
+        self.routes = [(re.compile(pattern), key) for pattern, key in routes.items()]
+
+    def key_for(self, scope):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return None
+        if any(name == b"if-none-match" for name, _ in scope["headers"]):
+            return None
+        for pattern, key in self.routes:
+            match = pattern.fullmatch(scope["path"])
+            if match:
+                return key.format(*match.groups())
+        return None
+
+    async def __call__(self, scope, receive, send):
+        key = self.key_for(scope)
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        query = scope.get("query_string", b"")
+        flight, leader = self.flights.join(key, query)
+        if leader:
+            try:
+                result = await self.lead(scope, receive)
+            except BaseException as error:
+                flight.future.set_exception(error)
+                # Followers re-raise it; retrieving it here keeps asyncio from reporting it unobserved
+                flight.future.exception()
+                raise
+            else:
+                flight.future.set_result(result)
+            finally:
+                self.flights.finish(flight, query)
+        else:
+            result = await asyncio.shield(flight.future)
+            stats = current_stats.get()
+            if stats is not None:
+                stats.coalesced = True
+        route, start, body = result
+        if route is not None:
+            scope["route"] = route
+        await send(start)
+        await send({"type": "http.response.body", "body": body, "more_body": False})
+
+    async def lead(self, scope, receive):
+        start, chunks = None, []
+
+        async def buffer(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, buffer)
+        return scope.get("route"), start, b"".join(chunks)
@@ -0,0 +1,165 @@
+"""Order snapshots: every order's GET /orders/{oid} body, stored pre-serialized.
+
+Writers mark the orders a transaction changes with ``mark_order_snapshots``;
+just before it commits, ``OrderSnapshots`` re-renders the marked orders with
+its ``render`` function and stores each body with the order's entity version,
+which the ETag is built from. Orders that cannot be rendered (a deleted
+customer or shop item) get no snapshot. ``read_order_snapshot`` is then one
+primary-key lookup.
+
+Data loaded behind the app's back needs a rebuild, and ``check`` rebuilds every
+body in memory and compares it with the stored one:
+
+    python -m app.snapshots rebuild
+    python -m app.snapshots check     # exits 1 if any snapshot is missing or stale
+"""
+import sys
+from typing import List, NamedTuple
+
+from sqlalchemy import delete, event, exists, insert, select
+from sqlalchemy.orm import Session
+
+from app.models import CustomerDB, EntityVersionDB, OrderDB, OrderItemDB, OrderSnapshotDB, ShopItemDB
+
+
+class SnapshotProblem(NamedTuple):
+    order_id: int
+    problem: str  # "missing", "stale version", "stale body", "unrenderable" or "orphaned"
+
+
+def mark_order_snapshots(db: Session, order_ids):
+    db.info.setdefault("order_snapshots", set()).update(set(order_ids) - {None})
+
+
+def read_order_snapshot(db: Session, order_id: int):
+    """The stored (version, body) row of the order, or None."""
+    return db.execute(
+        select(OrderSnapshotDB.version, OrderSnapshotDB.body).where(OrderSnapshotDB.order_id == order_id)
+    ).first()
+
+
+class OrderSnapshots:
+    def __init__(self, render, chunk_size: int = 500):
+        self.render = render  # (session, (id, customer_id) rows) -> {order_id: body}
+        self.chunk_size = chunk_size
+
+    def listen(self, session_class=Session):
+        event.listen(session_class, "before_commit", self.write)
+        event.listen(session_class, "after_soft_rollback", self.drop_pending)
+
+    def build(self, db: Session, order_ids):
+        """{order_id: (version, body)} for the renderable orders among order_ids."""
+        missing_shop_item = (
+            select(OrderItemDB.id)
+            .outerjoin(ShopItemDB, ShopItemDB.id == OrderItemDB.shop_item_id)
+            .where(OrderItemDB.order_id == OrderDB.id, ShopItemDB.id.is_(None))
+        )
+        rows = db.execute(
+            select(OrderDB.id, OrderDB.customer_id)
+            .join(CustomerDB, CustomerDB.id == OrderDB.customer_id)
+            .where(OrderDB.id.in_(order_ids), ~exists(missing_shop_item))
+            .order_by(OrderDB.id)
+        ).all()
+        if not rows:
+            return {}
+        versions = dict(db.execute(
+            select(EntityVersionDB.key, EntityVersionDB.version)
+            .where(EntityVersionDB.key.in_([f"orders:{row.id}" for row in rows]))
+        ).all())
+        return {
+            order_id: (versions.get(f"orders:{order_id}", 0), body)
+            for order_id, body in self.render(db, rows).items()
+        }
+
+    def refresh(self, db: Session, order_ids):
+        order_ids = sorted(order_ids)
+        for start in range(0, len(order_ids), self.chunk_size):
+            chunk = order_ids[start:start + self.chunk_size]
+            db.execute(delete(OrderSnapshotDB).where(OrderSnapshotDB.order_id.in_(chunk)))
+            snapshots = self.build(db, chunk)
+            if snapshots:
+                db.execute(insert(OrderSnapshotDB), [
+                    {"order_id": order_id, "version": version, "body": body}
+                    for order_id, (version, body) in snapshots.items()
+                ])
+
+    def write(self, db: Session):
+        order_ids = db.info.pop("order_snapshots", None)
+        if order_ids:
+            db.flush()
+            self.refresh(db, order_ids)
+
+    def drop_pending(self, db: Session, previous_transaction):
+        # A rolled back SAVEPOINT keeps its marks; rebuilding an unchanged order is harmless
+        if not previous_transaction.nested:
+            db.info.pop("order_snapshots", None)
+
+    def order_id_chunks(self, db: Session):
+        after_id = 0
+        while True:
+            ids = db.execute(
+                select(OrderDB.id).where(OrderDB.id > after_id).order_by(OrderDB.id).limit(self.chunk_size)
+            ).scalars().all()
+            if not ids:
+                return
+            yield ids
+            after_id = ids[-1]
+
+    def check(self, db: Session) -> List[SnapshotProblem]:
+        problems = []
+        for ids in self.order_id_chunks(db):
+            expected = self.build(db, ids)
+            stored = {
+                row.order_id: (row.version, row.body)
+                for row in db.execute(select(OrderSnapshotDB).where(OrderSnapshotDB.order_id.in_(ids))).scalars()
+            }
+            for order_id in ids:
+                if order_id not in expected:
+                    if order_id in stored:
+                        problems.append(SnapshotProblem(order_id, "unrenderable"))
+                elif order_id not in stored:
+                    problems.append(SnapshotProblem(order_id, "missing"))
+                elif stored[order_id][0] != expected[order_id][0]:
+                    problems.append(SnapshotProblem(order_id, "stale version"))
+                elif bytes(stored[order_id][1]) != expected[order_id][1]:
+                    problems.append(SnapshotProblem(order_id, "stale body"))
+        orphans = db.execute(
+            select(OrderSnapshotDB.order_id)
+            .outerjoin(OrderDB, OrderDB.id == OrderSnapshotDB.order_id)
+            .where(OrderDB.id.is_(None))
+        ).scalars()
+        problems += [SnapshotProblem(order_id, "orphaned") for order_id in orphans]
+        return problems
+
+    def rebuild(self, db: Session) -> int:
+        db.execute(delete(OrderSnapshotDB))
+        count = 0
+        for ids in self.order_id_chunks(db):
+            self.refresh(db, ids)
+            count += len(ids)
+        return count
+
+
+def main(argv):
+    if argv not in (["rebuild"], ["check"]):
+        sys.exit(__doc__)
+    # The bodies are rendered by the app's own serializers
+    from app.main import ReadSessionLocal, SessionLocal, order_snapshots
+
+    if argv == ["rebuild"]:
+        with SessionLocal() as db:
+            count = order_snapshots.rebuild(db)
+            db.commit()
+        print(f"Rebuilt snapshots for {count} orders")
+        return
+    with ReadSessionLocal() as db:
+        problems = order_snapshots.check(db)
+    for problem in problems:
+        print(f"order {problem.order_id}: {problem.problem}")
+    if problems:
+        sys.exit(f"{len(problems)} order snapshots are inconsistent; run `python -m app.snapshots rebuild`")
+    print("All order snapshots match the normalized tables")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
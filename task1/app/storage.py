@@ -0,0 +1,67 @@
+"""SQLite storage profile: connection pragmas and the reader/writer engine split.
+
+Every connection gets the profile's pragmas on connect. Writes go through an
+engine with a single pooled connection, so SQLite's one-writer rule is enforced
+by the pool rather than discovered as SQLITE_BUSY. Reads go through a separate
+pool of query_only connections which, with WAL, never wait for the writer.
+"""
+import os
+from typing import NamedTuple
+
+from sqlalchemy import create_engine, event
+
+
+class StorageProfile(NamedTuple):
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    mmap_size: int = 256 * 1024 * 1024
+    # Negative values are KiB, positive values are pages
+    cache_size: int = -64000
+    busy_timeout: int = 5000
+    # Matches the default threadpool size, so a request thread never waits on the pool
+    read_pool_size: int = 40
+
+    @classmethod
+    def from_env(cls, environ=os.environ, prefix="SHOP_SQLITE_"):
+        """Build a profile, overriding defaults with e.g. SHOP_SQLITE_CACHE_SIZE."""
+        values = {}
+        for field, default in cls._field_defaults.items():
+            raw = environ.get(prefix + field.upper())
+            if raw is not None:
+                values[field] = type(default)(raw)
+        return cls(**values)
+
+
+def apply_pragmas(dbapi_connection, profile: StorageProfile, read_only: bool = False):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout = {int(profile.busy_timeout)}")
+        cursor.execute(f"PRAGMA journal_mode = {profile.journal_mode}")
+        cursor.execute(f"PRAGMA synchronous = {profile.synchronous}")
+        cursor.execute(f"PRAGMA mmap_size = {int(profile.mmap_size)}")
+        cursor.execute(f"PRAGMA cache_size = {int(profile.cache_size)}")
+        if read_only:
+            cursor.execute("PRAGMA query_only = ON")
+    finally:
+        cursor.close()
+
+
+def install_pragmas(engine, profile: StorageProfile, read_only: bool = False):
+    # Async engines expose their events on the wrapped sync engine
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, profile, read_only=read_only)
+
+    return engine
+
+
+def create_writer_engine(url, profile: StorageProfile, engine_factory=create_engine, **kwargs):
+    engine = engine_factory(url, pool_size=1, max_overflow=0, **kwargs)
+    return install_pragmas(engine, profile)
+
+
+def create_reader_engine(url, profile: StorageProfile, engine_factory=create_engine, **kwargs):
+    engine = engine_factory(url, pool_size=profile.read_pool_size, max_overflow=0, **kwargs)
+    return install_pragmas(engine, profile, read_only=True)
@@ -0,0 +1,121 @@
+"""Generate a synthetic shop database of configurable size.
+
+The file is created from scratch, migrated to the current schema, and filled
+with executemany inserts in a single transaction, so millions of rows load in
+seconds; the sales rollups and order snapshots are then rebuilt from them.
+Generation is deterministic for a given --seed.
+
+    python benchmarks/datagen.py /tmp/shop.db --customers 10000 --shop-items 50000 --orders 20000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+from typing import NamedTuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import rollups  # noqa: E402
+from app.migrations import migrate  # noqa: E402
+
+WORDS = (
+    "alpha amber arctic atlas bamboo basic bold bright canvas carbon classic cloud compact copper "
+    "cosmic crystal daily deluxe digital eco electric elite essential express flex fresh garden "
+    "glass golden grand green heavy indigo iron jade kitchen leather light linen lunar magnetic "
+    "maple marine matte metro micro mini modern natural neon nova ocean office orbit organic "
+    "outdoor pearl pixel plus polar portable premium pro pure quantum quick rapid retro river "
+    "royal rugged silver slim smart solar sonic sport steel stone studio swift titan travel "
+    "turbo ultra urban velvet vintage vivid wave wild wireless wood zen"
+).split()
+
+class DatasetSize(NamedTuple):
+    customers: int
+    categories: int
+    shop_items: int
+    orders: int
+    order_items: int
+
+    def scaled(self, factor: float) -> "DatasetSize":
+        return DatasetSize(*(max(1, int(n * factor)) for n in self))
+
+# Base proportions; benchmark sizes are multiples of this
+UNIT = DatasetSize(customers=1000, categories=20, shop_items=2000, orders=2000, order_items=6000)
+
+def phrase(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+def generate(path: str, size: DatasetSize, seed: int = 0) -> DatasetSize:
+    from sqlalchemy import create_engine
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    engine = create_engine(f"sqlite:///{path}")
+    migrate(engine)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")
+        with conn:
+            conn.executemany(
+                "INSERT INTO customers (id, name, surname, email) VALUES (?, ?, ?, ?)",
+                ((i, f"Name{i}", f"Surname{i}", f"customer{i}@example.com") for i in range(1, size.customers + 1)),
+            )
+            conn.executemany(
+                "INSERT INTO categories (id, title, description) VALUES (?, ?, ?)",
+                ((i, f"Category {i}", phrase(rng, 6)) for i in range(1, size.categories + 1)),
+            )
+            conn.executemany(
+                "INSERT INTO shop_items (id, title, description, price) VALUES (?, ?, ?, ?)",
+                ((i, phrase(rng, 3).title(), phrase(rng, 20), round(rng.uniform(1, 1000), 2))
+                 for i in range(1, size.shop_items + 1)),
+            )
+            conn.executemany(
+                "INSERT INTO shopitem_category (shopitem_id, category_id) VALUES (?, ?)",
+                ((i, c) for i in range(1, size.shop_items + 1)
+                 for c in rng.sample(range(1, size.categories + 1), min(size.categories, rng.randint(1, 3)))),
+            )
+            conn.executemany(
+                "INSERT INTO orders (id, customer_id) VALUES (?, ?)",
+                ((i, rng.randint(1, size.customers)) for i in range(1, size.orders + 1)),
+            )
+            conn.executemany(
+                "INSERT INTO order_items (id, shop_item_id, quantity, order_id) VALUES (?, ?, ?, ?)",
+                ((i, rng.randint(1, size.shop_items), rng.randint(1, 5), rng.randint(1, size.orders))
+                 for i in range(1, size.order_items + 1)),
+            )
+        # The rollups are derived from the rows above
+        with engine.begin() as sa_conn:
+            rollups.rebuild(sa_conn)
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+        engine.dispose()
+    # Order snapshots are built by the app's own serializers, which read the database path at import
+    subprocess.run(
+        [sys.executable, "-m", "app.snapshots", "rebuild"],
+        cwd=ROOT, env=dict(os.environ, SHOP_DATABASE_PATH=os.path.abspath(path), PYTHONWARNINGS="ignore"),
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    return size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiple of the base proportions")
+    for field in DatasetSize._fields:
+        parser.add_argument("--" + field.replace("_", "-"), type=int, help=f"override the number of {field}")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    size = UNIT.scaled(args.scale)._replace(**{
+        field: getattr(args, field) for field in DatasetSize._fields if getattr(args, field) is not None
+    })
+    generate(args.path, size, seed=args.seed)
+    print(f"Wrote {args.path}: " + ", ".join(f"{n} {field}" for field, n in size._asdict().items()))
+
+if __name__ == "__main__":
+    main()
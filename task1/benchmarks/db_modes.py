@@ -0,0 +1,63 @@
+"""Compare concurrent request throughput of the sync and async database modes.
+
+Each mode runs in its own interpreter (SHOP_DB_MODE is read at import time) and
+in a scratch directory, so the benchmark never touches the project's shop.db.
+
+    python benchmarks/db_modes.py --requests 2000 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATHS = ["/customers/1", "/shop_items/", "/orders/", "/orders/1"]
+
+async def run_requests(total, concurrency):
+    import httpx
+    from app import main
+    from app.seed import seed_demo_data
+
+    main.check_schema_version()
+    seed_demo_data()
+    transport = httpx.ASGITransport(app=main.app)
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i):
+            async with semaphore:
+                r = await client.get(PATHS[i % len(PATHS)])
+                r.raise_for_status()
+        # Warm up connections and code paths before timing
+        await asyncio.gather(*(one(i) for i in range(len(PATHS) * 4)))
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        return time.perf_counter() - start
+
+def child(args):
+    elapsed = asyncio.run(run_requests(args.requests, args.concurrency))
+    print(f"{os.environ['SHOP_DB_MODE']:>5}: {args.requests} requests in {elapsed:.2f}s "
+          f"= {args.requests / elapsed:,.0f} req/s at concurrency {args.concurrency}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+    for mode in ("sync", "async"):
+        env = dict(os.environ, SHOP_DB_MODE=mode, PYTHONPATH=ROOT, PYTHONWARNINGS="ignore")
+        with tempfile.TemporaryDirectory() as workdir:
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child",
+                 "--requests", str(args.requests), "--concurrency", str(args.concurrency)],
+                cwd=workdir, env=env, check=True,
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Benchmark the read endpoints against generated databases of several sizes.
+
+For every size a fresh database is generated with datagen.py and served by its
+own interpreter (the database path is read at import time). Each route gets
+the same number of requests at the given concurrency through the ASGI app;
+throughput and p50/p95/p99 latency are printed and saved as JSON. Pass an
+earlier results file as --baseline to flag routes that got slower.
+
+    python benchmarks/endpoints.py --sizes small medium --requests 500
+    python benchmarks/endpoints.py --baseline benchmarks/results/before.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.datagen import UNIT, WORDS, DatasetSize, generate  # noqa: E402
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+SIZES = {"small": 1, "medium": 10, "large": 50}
+
+# Route template -> builder for a concrete path, given a random source and the dataset size
+ROUTES = {
+    "GET /customers/{customer_id}": lambda rng, size: f"/customers/{rng.randint(1, size.customers)}",
+    "GET /shop_items/": lambda rng, size: "/shop_items/?limit=100",
+    "GET /shop_items/?min_price&max_price": lambda rng, size: (
+        "/shop_items/?limit=100&min_price={0}&max_price={1}".format(*sorted(rng.sample(range(1, 1000), 2)))
+    ),
+    "GET /shop_items/{item_id}": lambda rng, size: f"/shop_items/{rng.randint(1, size.shop_items)}",
+    "GET /shop_items/search": lambda rng, size: f"/shop_items/search?q={rng.choice(WORDS)}&limit=20",
+    "GET /categories/{category_id}/shop_items": lambda rng, size: (
+        f"/categories/{rng.randint(1, size.categories)}/shop_items?limit=100"
+    ),
+    "GET /orders/": lambda rng, size: "/orders/?limit=100",
+    "GET /orders/?format=normalized": lambda rng, size: "/orders/?limit=100&format=normalized",
+    "GET /orders/{oid}": lambda rng, size: f"/orders/{rng.randint(1, size.orders)}",
+    "GET /analytics/revenue_by_category": lambda rng, size: "/analytics/revenue_by_category",
+    "GET /analytics/top_shop_items": lambda rng, size: "/analytics/top_shop_items?limit=20",
+    "GET /analytics/customer_spend": lambda rng, size: "/analytics/customer_spend?limit=20",
+}
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list."""
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+async def bench_route(client, paths, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(path):
+        async with semaphore:
+            start = time.perf_counter()
+            r = await client.get(path)
+            latencies.append(time.perf_counter() - start)
+            r.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(path) for path in paths))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(paths),
+        "rps": len(paths) / elapsed,
+        **{f"p{p}_ms": percentile(latencies, p) * 1000 for p in (50, 95, 99)},
+    }
+
+async def run_routes(size, requests, concurrency, seed):
+    import httpx
+    from app import main
+
+    main.check_schema_version()
+    rng = random.Random(seed)
+    transport = httpx.ASGITransport(app=main.app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for route, build in ROUTES.items():
+            # Warm up code paths and connections before timing
+            await bench_route(client, [build(rng, size) for _ in range(concurrency)], concurrency)
+            results[route] = await bench_route(client, [build(rng, size) for _ in range(requests)], concurrency)
+    return results
+
+def child(args):
+    size = DatasetSize(*json.loads(args.size_json))
+    results = asyncio.run(run_routes(size, args.requests, args.concurrency, args.seed))
+    with open(args.child_output, "w") as f:
+        json.dump(results, f)
+
+def run_size(name, args):
+    size = UNIT.scaled(SIZES[name])
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, "shop.db")
+        start = time.perf_counter()
+        generate(db_path, size, seed=args.seed)
+        print(f"\n[{name}] generated {', '.join(f'{n} {f}' for f, n in size._asdict().items())} "
+              f"in {time.perf_counter() - start:.1f}s")
+        output = os.path.join(workdir, "results.json")
+        env = dict(os.environ, SHOP_DATABASE_PATH=db_path, PYTHONPATH=ROOT, PYTHONWARNINGS="ignore")
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--size-json", json.dumps(size),
+             "--child-output", output, "--requests", str(args.requests),
+             "--concurrency", str(args.concurrency), "--seed", str(args.seed)],
+            cwd=workdir, env=env, check=True,
+        )
+        with open(output) as f:
+            routes = json.load(f)
+    print(f"{'route':<44}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, r in routes.items():
+        print(f"{route:<44}{r['rps']:>10,.0f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+    return {"dataset": size._asdict(), "routes": routes}
+
+def compare(results, baseline, tolerance):
+    """Print routes whose p95 rose or throughput fell by more than tolerance; return their count."""
+    regressions = 0
+    for name, current in results["sizes"].items():
+        before = baseline["sizes"].get(name, {}).get("routes", {})
+        for route, r in current["routes"].items():
+            old = before.get(route)
+            if old is None:
+                continue
+            slower = r["p95_ms"] > old["p95_ms"] * (1 + tolerance)
+            fewer = r["rps"] < old["rps"] * (1 - tolerance)
+            if slower or fewer:
+                regressions += 1
+                print(f"REGRESSION [{name}] {route}: p95 {old['p95_ms']:.2f} -> {r['p95_ms']:.2f} ms, "
+                      f"{old['rps']:,.0f} -> {r['rps']:,.0f} req/s")
+    if not regressions:
+        print(f"No regressions beyond {tolerance:.0%} against the baseline")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", choices=SIZES, default=["small", "medium"])
+    parser.add_argument("--requests", type=int, default=500, help="timed requests per route")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative p95/throughput change before a route counts as regressed")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size-json", help=argparse.SUPPRESS)
+    parser.add_argument("--child-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+    now = datetime.now(timezone.utc)
+    results = {
+        "created": now.isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "sizes": {name: run_size(name, args) for name in args.sizes},
+    }
+    output = args.output or os.path.join(RESULTS_DIR, now.strftime("%Y%m%dT%H%M%SZ") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved results to {output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
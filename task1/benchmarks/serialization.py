@@ -0,0 +1,76 @@
+"""Measure CPU spent loading and encoding orders on the Pydantic and fast paths.
+
+Both paths read the same pages of 1000 orders from a generated database: the
+default one loads ORM objects and validates them into List[Order] as FastAPI's
+response_model does, the fast one builds dicts from Core rows and encodes them
+with orjson. The bodies are checked to be identical before timing.
+
+    python benchmarks/serialization.py --scale 5 --repeat 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.datagen import UNIT, generate  # noqa: E402
+
+ORDERS_PER_PAGE = 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=float, default=5.0, help="dataset size as a multiple of datagen's base")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        size = UNIT.scaled(args.scale)
+        os.environ["SHOP_DATABASE_PATH"] = os.path.join(workdir, "shop.db")
+        generate(os.environ["SHOP_DATABASE_PATH"], size)
+        # Imported only now: the database path is read at import time
+        import orjson
+        from pydantic import TypeAdapter
+        from sqlalchemy import select
+        from typing import List
+        from app.main import Order, OrderDB, ReadSessionLocal, assemble_order, fast_orders, load_orders
+
+        order_list = TypeAdapter(List[Order])
+
+        def pydantic_page(db, after_id):
+            orders = load_orders(db, OrderDB.id > after_id, limit=ORDERS_PER_PAGE)
+            return order_list.dump_json(order_list.validate_python(
+                [assemble_order(order) for order in orders], from_attributes=True
+            ))
+
+        def fast_page(db, after_id):
+            rows = db.execute(
+                select(OrderDB.id, OrderDB.customer_id).where(OrderDB.id > after_id).order_by(OrderDB.id).limit(ORDERS_PER_PAGE)
+            ).all()
+            return orjson.dumps(fast_orders(db, rows))
+
+        starts = range(0, size.orders, ORDERS_PER_PAGE)
+        with ReadSessionLocal() as db:
+            for after_id in starts:
+                if pydantic_page(db, after_id) != fast_page(db, after_id):
+                    sys.exit(f"Bodies differ for the page after order {after_id}")
+
+        print(f"{size.orders} orders, {size.order_items} order items, {size.shop_items} shop items; "
+              f"CPU ms per {ORDERS_PER_PAGE} orders (load + encode), best/median of {args.repeat}")
+        results = {}
+        for name, page in (("pydantic", pydantic_page), ("fast", fast_page)):
+            timings = []
+            for _ in range(args.repeat):
+                with ReadSessionLocal() as db:
+                    start = time.process_time()
+                    for after_id in starts:
+                        page(db, after_id)
+                    timings.append((time.process_time() - start) * 1000 / len(starts))
+            results[name] = min(timings)
+            print(f"{name:>9}: {min(timings):8.1f} / {statistics.median(timings):8.1f}")
+        print(f"  speedup: {results['pydantic'] / results['fast']:.1f}x")
+
+if __name__ == "__main__":
+    main()
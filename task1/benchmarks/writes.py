@@ -0,0 +1,98 @@
+"""Measure sustained create throughput with and without group commit.
+
+Each configuration gets a freshly generated database and its own interpreter
+(the batching settings are read at import time). Concurrent clients create
+customers and place orders through the ASGI app; the write rate, latency and
+mean batch size are printed.
+
+    python benchmarks/writes.py --requests 2000 --concurrency 64 --batch-sizes 0 16 64
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.datagen import UNIT, generate  # noqa: E402
+from benchmarks.endpoints import percentile  # noqa: E402
+
+async def run_writes(requests, concurrency):
+    import httpx
+    from app import main
+
+    main.check_schema_version()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(client, i):
+        async with semaphore:
+            start = time.perf_counter()
+            if i % 2:
+                r = await client.post("/orders/place", json={
+                    "customer_id": 1 + i % UNIT.customers,
+                    "lines": [{"shop_item_id": 1 + i % UNIT.shop_items, "quantity": 1}],
+                })
+            else:
+                r = await client.post("/customers/", json={
+                    "name": "Bench", "surname": str(i), "email": f"bench{i}@example.com",
+                })
+            latencies.append(time.perf_counter() - start)
+            r.raise_for_status()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(client, i) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+        stats = (await client.get("/write_batcher/stats")).json()
+    latencies.sort()
+    return {
+        "rps": requests / elapsed,
+        **{f"p{p}_ms": percentile(latencies, p) * 1000 for p in (50, 95, 99)},
+        "mean_batch_size": stats.get("mean_batch_size", 1.0),
+    }
+
+def run_config(batch_size, args):
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = os.path.join(workdir, "shop.db")
+        generate(db_path, UNIT)
+        output = os.path.join(workdir, "results.json")
+        env = dict(os.environ, SHOP_DATABASE_PATH=db_path, SHOP_WRITE_BATCH_SIZE=str(batch_size),
+                   SHOP_WRITE_BATCH_WINDOW_MS=str(args.window_ms), PYTHONPATH=ROOT, PYTHONWARNINGS="ignore")
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--child-output", output,
+             "--requests", str(args.requests), "--concurrency", str(args.concurrency)],
+            cwd=workdir, env=env, check=True,
+        )
+        with open(output) as f:
+            return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[0, 16, 64],
+                        help="SHOP_WRITE_BATCH_SIZE values to compare (0 commits every write alone)")
+    parser.add_argument("--window-ms", type=float, default=2.0)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--child-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        with open(args.child_output, "w") as f:
+            json.dump(asyncio.run(run_writes(args.requests, args.concurrency)), f)
+        return
+    print(f"{args.requests} writes at concurrency {args.concurrency}")
+    print(f"{'batch size':<12}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean batch':>12}")
+    for batch_size in args.batch_sizes:
+        r = run_config(batch_size, args)
+        print(f"{batch_size or 'off':<12}{r['rps']:>10,.0f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+              f"{r['p99_ms']:>10.2f}{r['mean_batch_size']:>12.1f}")
+
+if __name__ == "__main__":
+    main()
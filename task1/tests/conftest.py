@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# Point the app at a throwaway database before app.main is imported. Every
+# interpreter gets its own, including the one tests/test_async_mode.py starts.
+os.environ["SHOP_DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="shop-tests-"), "shop.db")
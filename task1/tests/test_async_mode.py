@@ -0,0 +1,17 @@
+import os
+import subprocess
+import sys
+import pytest
+
+pytest.importorskip("aiosqlite")
+
+def test_endpoint_suite_passes_in_async_mode():
+    # The database mode is fixed at import time, so run the suite in a fresh interpreter
+    env = dict(os.environ, SHOP_DB_MODE="async")
+    result = subprocess.run(
+        [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider", os.path.join(os.path.dirname(__file__), "test_endpoints.py")],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.orm import sessionmaker
+from app.batching import WriteBatcher
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'batch.db'}")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE t (id INTEGER PRIMARY KEY, v INTEGER UNIQUE)")
+    return engine
+
+def insert(v):
+    def op(db):
+        return db.execute(text("INSERT INTO t (v) VALUES (:v) RETURNING id"), {"v": v}).scalar()
+    return op
+
+def run_batched(batcher, ops):
+    async def main():
+        try:
+            return await asyncio.gather(*(batcher.submit(op) for op in ops), return_exceptions=True)
+        finally:
+            await batcher.close()
+    return asyncio.run(main())
+
+def test_one_commit_per_batch_with_per_operation_errors(engine):
+    commits = []
+    event.listen(engine, "commit", lambda conn: commits.append(conn))
+    batcher = WriteBatcher(sessionmaker(engine), asyncio.Lock(), window=0.05, max_ops=10)
+    results = run_batched(batcher, [insert(1), insert(2), insert(1), insert(3)])
+    assert isinstance(results[2], exc.IntegrityError)
+    assert all(isinstance(r, int) for i, r in enumerate(results) if i != 2)
+    assert len(commits) == 1
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT v FROM t ORDER BY v").scalars().all() == [1, 2, 3]
+    assert batcher.stats() == {"batches": 1, "operations": 4, "failures": 1, "mean_batch_size": 4.0}
+
+def test_batches_are_capped_at_max_ops(engine):
+    batcher = WriteBatcher(sessionmaker(engine), asyncio.Lock(), window=0.05, max_ops=2)
+    results = run_batched(batcher, [insert(v) for v in range(5)])
+    assert sorted(results) == [1, 2, 3, 4, 5]
+    assert batcher.stats()["batches"] == 3
+
+def test_failed_commit_fails_the_whole_batch(engine):
+    def fail_commit(db):
+        raise RuntimeError("disk full")
+    factory = sessionmaker(engine)
+    event.listen(factory, "before_commit", fail_commit)
+    batcher = WriteBatcher(factory, asyncio.Lock(), window=0.05, max_ops=10)
+    results = run_batched(batcher, [insert(1), insert(2)])
+    assert all(isinstance(r, RuntimeError) for r in results)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT count(*) FROM t").scalar() == 0
@@ -0,0 +1,32 @@
+from app.cache import LRUCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def test_lru_eviction_and_ttl():
+    clock = FakeClock()
+    cache = LRUCache(maxsize=2, ttl=10, clock=clock)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    assert cache.evictions == 1
+    clock.now = 11
+    assert cache.get("a") is None
+    assert cache.expirations == 1
+
+def test_tag_invalidation_and_stale_generation():
+    cache = LRUCache(maxsize=10, ttl=10)
+    cache.set("item:1", "x", tags={"item:1", "cat:1"})
+    cache.set("item:2", "y", tags={"item:2"})
+    generation = cache.generation
+    cache.invalidate_tags("cat:1")
+    assert cache.get("item:1") is None
+    assert cache.get("item:2") == "y"
+    # A value loaded before the invalidation must not be cached
+    assert not cache.set("item:1", "stale", tags={"item:1"}, generation=generation)
+    assert cache.get("item:1") is None
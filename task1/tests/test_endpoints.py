@@ -1,9 +1,38 @@
+import json
+import threading
+import time
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+from app import main, models, rollups, snapshots
 from app.main import app
+from app.seed import seed_demo_data
 
 client = TestClient(app)
 
+@pytest.fixture(scope="module", autouse=True)
+def seeded_db():
+    # Entering the client runs the startup schema check, which migrates the empty test database
+    with client:
+        seed_demo_data()
+        yield
+
+def capture_statements(fn):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    for engine in main.ENGINES:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        fn()
+    finally:
+        for engine in main.ENGINES:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+def count_statements(fn):
+    return len(capture_statements(fn))
+
 def test_list_customers():
     r = client.get("/customers/")
     assert r.status_code == 200
@@ -191,3 +220,772 @@ def test_delete_order():
     assert r.status_code == 200
     r = client.get(f"/orders/{oid}")
     assert r.status_code == 404
+
+def test_list_orders_statement_count_is_constant():
+    baseline = count_statements(lambda: client.get("/orders/"))
+    for _ in range(5):
+        item_ids = []
+        for shop_item_id in (1, 2):
+            r = client.post("/order_items/", json={"shop_item_id": shop_item_id, "quantity": 1})
+            item_ids.append(r.json()["id"])
+        r = client.post("/orders/", json={"customer_id": 2, "item_ids": item_ids})
+        assert r.status_code == 200
+    r = client.get("/orders/")
+    assert len(r.json()) >= 5
+    assert count_statements(lambda: client.get("/orders/")) == baseline
+
+def test_keyset_pagination_walks_every_row_once():
+    for i in range(5):
+        data = {"name": "Page", "surname": str(i), "email": f"page{i}@example.com"}
+        client.post("/customers/", json=data)
+    expected = [c["id"] for c in client.get("/customers/").json()]
+    seen = []
+    r = client.get("/customers/", params={"limit": 2})
+    while True:
+        assert r.status_code == 200
+        assert len(r.json()) <= 2
+        seen.extend(c["id"] for c in r.json())
+        cursor = r.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        r = client.get("/customers/", params={"limit": 2, "cursor": cursor})
+    assert seen == expected
+    r = client.get("/customers/", params={"after_id": expected[0], "limit": 1})
+    assert [c["id"] for c in r.json()] == expected[1:2]
+
+def test_pagination_rejects_bad_limits_and_cursors():
+    assert client.get("/orders/", params={"limit": 0}).status_code == 422
+    assert client.get("/orders/", params={"limit": 100000}).status_code == 422
+    assert client.get("/shop_items/", params={"cursor": "not-a-cursor"}).status_code == 400
+
+def test_export_streams_ndjson(monkeypatch):
+    # Small chunks so every export spans several flushes
+    monkeypatch.setattr(main, "EXPORT_CHUNK_SIZE", 2)
+    for entity, path in [("customers", "/customers/"), ("shop_items", "/shop_items/"), ("orders", "/orders/")]:
+        r = client.get(f"/export/{entity}")
+        assert r.status_code == 200
+        assert r.headers["content-type"].startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in r.text.splitlines()]
+        assert rows == client.get(path, params={"limit": 1000}).json()
+    assert client.get("/export/nothing").status_code == 404
+
+def test_bulk_create_customers_reports_duplicates_per_row():
+    rows = [
+        {"name": "Bulk", "surname": "One", "email": "bulk1@example.com"},
+        {"name": "Bulk", "surname": "Dup", "email": "bob@example.com"},
+        {"name": "Bulk", "surname": "Two", "email": "bulk2@example.com"},
+        {"name": "Bulk", "surname": "Again", "email": "bulk1@example.com"},
+    ]
+    r = client.post("/customers/bulk", json=rows)
+    assert r.status_code == 200
+    results = r.json()
+    assert [res["error"] is None for res in results] == [True, False, True, False]
+    assert client.get(f"/customers/{results[2]['id']}").json()["email"] == "bulk2@example.com"
+
+def test_bulk_create_categories_and_shop_items():
+    r = client.post("/categories/bulk", json=[{"title": "BulkCat1"}, {"title": "BulkCat2", "description": "d"}])
+    assert r.status_code == 200
+    cat_ids = [res["id"] for res in r.json()]
+    items = [
+        {"title": "BulkItem1", "price": 1.0, "category_ids": cat_ids},
+        {"title": "BulkItem2", "price": 2.0, "category_ids": [999999]},
+        {"title": "BulkItem3", "price": 3.0},
+    ]
+    r = client.post("/shop_items/bulk", json=items)
+    assert r.status_code == 200
+    results = r.json()
+    assert results[1]["id"] is None and "999999" in results[1]["error"]
+    item = client.get(f"/shop_items/{results[0]['id']}").json()
+    assert item["title"] == "BulkItem1"
+    assert sorted(c["id"] for c in item["categories"]) == sorted(cat_ids)
+    assert client.get(f"/shop_items/{results[2]['id']}").json()["categories"] == []
+
+def test_storage_profile_pragmas():
+    with main.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == main.STORAGE_PROFILE.busy_timeout
+        assert conn.exec_driver_sql("PRAGMA query_only").scalar() == 0
+    with main.read_engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA query_only").scalar() == 1
+        with pytest.raises(Exception):
+            conn.exec_driver_sql("DELETE FROM customers")
+
+def test_storage_profile_from_env():
+    profile = main.StorageProfile.from_env({"SHOP_SQLITE_CACHE_SIZE": "-2000", "SHOP_SQLITE_SYNCHRONOUS": "FULL"})
+    assert profile.cache_size == -2000
+    assert profile.synchronous == "FULL"
+    assert profile.journal_mode == "WAL"
+
+def test_catalog_cache_hits_and_invalidation():
+    r = client.post("/categories/", json={"title": "CacheCat"})
+    cat_id = r.json()["id"]
+    r = client.post("/shop_items/", json={"title": "CacheItem", "price": 1.5, "category_ids": [cat_id]})
+    item_id = r.json()["id"]
+    assert client.get(f"/shop_items/{item_id}").headers["X-Cache"] == "MISS"
+    hits = client.get("/catalog_cache/stats").json()["hits"]
+    r = client.get(f"/shop_items/{item_id}")
+    assert r.headers["X-Cache"] == "HIT"
+    assert r.json()["title"] == "CacheItem"
+    assert client.get("/catalog_cache/stats").json()["hits"] == hits + 1
+    # Renaming a category must drop every cached item that embeds it
+    client.put(f"/categories/{cat_id}", json={"title": "RenamedCacheCat"})
+    r = client.get(f"/shop_items/{item_id}")
+    assert r.headers["X-Cache"] == "MISS"
+    assert r.json()["categories"][0]["title"] == "RenamedCacheCat"
+    client.put(f"/shop_items/{item_id}", json={"title": "CacheItem2", "price": 2.0, "category_ids": []})
+    assert client.get(f"/shop_items/{item_id}").json()["title"] == "CacheItem2"
+    client.delete(f"/shop_items/{item_id}")
+    assert client.get(f"/shop_items/{item_id}").status_code == 404
+
+def test_conditional_get_with_etags():
+    r = client.get("/shop_items/1")
+    etag = r.headers["ETag"]
+    r = client.get("/shop_items/1", headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.content == b""
+    # Changing an embedded category changes the item's tag
+    client.put("/categories/1", json={"title": "EtagCat", "description": "d"})
+    r = client.get("/shop_items/1", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+
+def test_order_etag_follows_embedded_entities():
+    item_id = client.post("/order_items/", json={"shop_item_id": 2, "quantity": 1}).json()["id"]
+    oid = client.post("/orders/", json={"customer_id": 2, "item_ids": [item_id]}).json()["id"]
+    etag = client.get(f"/orders/{oid}").headers["ETag"]
+    statements = count_statements(
+        lambda: client.get(f"/orders/{oid}", headers={"If-None-Match": etag})
+    )
+    assert statements == 1
+    assert client.get(f"/orders/{oid}", headers={"If-None-Match": etag}).status_code == 304
+    client.put("/shop_items/2", json={"title": "Phone", "price": 399.0, "category_ids": [2]})
+    r = client.get(f"/orders/{oid}", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.json()["items"][0]["shop_item"]["title"] == "Phone"
+    etag = r.headers["ETag"]
+    client.put("/customers/2", json={"name": "Robert", "surname": "Brown", "email": "bob@example.com"})
+    assert client.get(f"/orders/{oid}", headers={"If-None-Match": etag}).status_code == 200
+    list_etag = client.get("/orders/").headers["ETag"]
+    assert client.get("/orders/", headers={"If-None-Match": list_etag}).status_code == 304
+    client.delete(f"/orders/{oid}")
+    assert client.get("/orders/", headers={"If-None-Match": list_etag}).status_code == 200
+
+def test_writes_that_touch_no_order_keep_the_order_list_etag():
+    list_etag = client.get("/orders/", params={"limit": 5}).headers["ETag"]
+    client.post("/customers/", json={"name": "Una", "surname": "Related", "email": "una@example.com"})
+    client.post("/order_items/", json={"shop_item_id": 1, "quantity": 1})
+    cat_id = client.post("/categories/", json={"title": "Unordered"}).json()["id"]
+    client.post("/shop_items/", json={"title": "Unordered", "price": 1.0, "category_ids": [cat_id]})
+    r = client.get("/orders/", params={"limit": 5}, headers={"If-None-Match": list_etag})
+    assert r.status_code == 304 and r.headers["ETag"] == list_etag
+
+def test_search_shop_items_ranks_and_facets():
+    cats = client.post("/categories/bulk", json=[{"title": "Garden"}, {"title": "Kitchen"}]).json()
+    garden, kitchen = cats[0]["id"], cats[1]["id"]
+    client.post("/shop_items/bulk", json=[
+        {"title": "Watering can", "description": "Steel can for watering the garden", "price": 9.0, "category_ids": [garden]},
+        {"title": "Teapot", "description": "Watering your tea needs", "price": 19.0, "category_ids": [kitchen]},
+        {"title": "Garden hose", "description": "Long hose", "price": 29.0, "category_ids": [garden]},
+    ])
+    r = client.get("/shop_items/search", params={"q": "watering"})
+    assert r.status_code == 200
+    body = r.json()
+    assert body["total"] == 2
+    assert body["items"][0]["title"] == "Watering can"
+    assert {f["category_id"]: f["count"] for f in body["facets"]} == {garden: 1, kitchen: 1}
+    r = client.get("/shop_items/search", params={"q": "water", "category_id": kitchen})
+    assert [item["title"] for item in r.json()["items"]] == ["Teapot"]
+    # The index follows updates and deletes
+    hose = client.get("/shop_items/search", params={"q": "hose"}).json()["items"][0]
+    client.put(f"/shop_items/{hose['id']}", json={"title": "Garden sprinkler", "price": 29.0, "category_ids": [garden]})
+    assert client.get("/shop_items/search", params={"q": "hose"}).json()["total"] == 0
+    assert client.get("/shop_items/search", params={"q": "sprinkler"}).json()["total"] == 1
+    client.delete(f"/shop_items/{hose['id']}")
+    assert client.get("/shop_items/search", params={"q": "sprinkler"}).json()["total"] == 0
+    assert client.get("/shop_items/search", params={"q": "\"*"}).status_code == 400
+
+def test_browse_category_with_price_filter_and_pagination():
+    cat_id = client.post("/categories/", json={"title": "Browse"}).json()["id"]
+    client.post("/shop_items/bulk", json=[
+        {"title": f"Browse{i}", "price": float(i), "category_ids": [cat_id]} for i in range(1, 8)
+    ])
+    client.post("/shop_items/", json={"title": "Elsewhere", "price": 3.0, "category_ids": [1]})
+    titles, params = [], {"limit": 3}
+    while True:
+        r = client.get(f"/categories/{cat_id}/shop_items", params=params)
+        assert r.status_code == 200
+        titles.extend(item["title"] for item in r.json())
+        if "X-Next-Cursor" not in r.headers:
+            break
+        params["cursor"] = r.headers["X-Next-Cursor"]
+    assert titles == [f"Browse{i}" for i in range(1, 8)]
+    r = client.get("/shop_items/", params={"category_id": cat_id, "min_price": 2, "max_price": 4})
+    assert [item["price"] for item in r.json()] == [2.0, 3.0, 4.0]
+    assert client.get("/categories/999999/shop_items").status_code == 404
+
+def test_cached_category_pages_go_with_the_category():
+    cat_id = client.post("/categories/", json={"title": "Short-lived"}).json()["id"]
+    for params in ({}, {"fields": "title"}):
+        assert client.get(f"/categories/{cat_id}/shop_items", params=params).json() == []
+        assert client.get("/shop_items/", params={"category_id": cat_id, **params}).json() == []
+    client.delete(f"/categories/{cat_id}")
+    for params in ({}, {"fields": "title"}):
+        assert client.get(f"/categories/{cat_id}/shop_items", params=params).status_code == 404
+
+def test_price_filtered_list_pages_by_price():
+    prices = [80005.5, 80005.25, 80005.75, 80005.25, 80005.0, 80006.5]
+    ids = [client.post("/shop_items/", json={"title": f"Priced{i}", "price": p}).json()["id"] for i, p in enumerate(prices)]
+    expected = sorted((p, i) for p, i in zip(prices, ids) if p <= 80006)
+    for extra in ({}, {"fields": "title"}):
+        seen, params = [], {"min_price": 80005, "max_price": 80006, "limit": 2, **extra}
+        while True:
+            r = client.get("/shop_items/", params=params)
+            assert r.status_code == 200
+            seen.extend(item["title"] for item in r.json())
+            if "X-Next-Cursor" not in r.headers:
+                break
+            params["cursor"] = r.headers["X-Next-Cursor"]
+        assert seen == [f"Priced{ids.index(i)}" for _, i in expected]
+    # A bare after_id continues after that item's price
+    r = client.get("/shop_items/", params={"min_price": 80005, "max_price": 80006, "after_id": expected[2][1]})
+    assert [item["id"] for item in r.json()] == [i for _, i in expected[3:]]
+    with main.engine.connect() as conn:
+        plan = conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT id FROM shop_items WHERE price >= 5 AND price <= 6"
+            " AND (price, id) > (5.25, 3) ORDER BY price, id LIMIT 10"
+        ).all()
+    assert any("ix_shop_items_price" in row[-1] for row in plan)
+    assert not any("TEMP B-TREE" in row[-1] for row in plan)
+
+def test_category_browse_uses_reverse_index():
+    with main.engine.connect() as conn:
+        plan = conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN SELECT shopitem_id FROM shopitem_category"
+            " WHERE category_id = 1 AND shopitem_id > 0 ORDER BY shopitem_id LIMIT 10"
+        ).all()
+    assert any("ix_shopitem_category_category_id" in row[-1] for row in plan)
+
+def test_place_order_in_one_transaction():
+    writer = main.async_engine.sync_engine if main.async_engine is not None else main.engine
+    commits = []
+    def on_commit(conn):
+        commits.append(conn)
+    event.listen(writer, "commit", on_commit)
+    try:
+        r = client.post("/orders/place", json={
+            "customer_id": 2,
+            "lines": [{"shop_item_id": 1, "quantity": 2}, {"shop_item_id": 2, "quantity": 1}],
+        })
+    finally:
+        event.remove(writer, "commit", on_commit)
+    assert r.status_code == 200
+    assert len(commits) == 1
+    order = r.json()
+    assert order["customer"]["id"] == 2
+    assert [(i["shop_item"]["id"], i["quantity"]) for i in order["items"]] == [(1, 2), (2, 1)]
+    assert client.get(f"/orders/{order['id']}").json() == order
+    r = client.post("/orders/place", json={"customer_id": 2, "lines": [{"shop_item_id": 999999, "quantity": 1}]})
+    assert r.status_code == 400
+    assert "999999" in r.json()["detail"]
+    r = client.post("/orders/place", json={"customer_id": 999999, "lines": [{"shop_item_id": 1, "quantity": 1}]})
+    assert r.status_code == 400
+    for quantity in (0, -5):
+        r = client.post("/orders/place", json={"customer_id": 2, "lines": [{"shop_item_id": 1, "quantity": quantity}]})
+        assert r.status_code == 422
+        assert client.post("/order_items/", json={"shop_item_id": 1, "quantity": quantity}).status_code == 422
+
+def test_update_order_touches_only_changed_items():
+    item_ids = [client.post("/order_items/", json={"shop_item_id": 1, "quantity": q}).json()["id"] for q in (1, 2, 3)]
+    oid = client.post("/orders/", json={"customer_id": 1, "item_ids": item_ids[:2]}).json()["id"]
+    responses = []
+    statements = capture_statements(
+        lambda: responses.append(client.put(f"/orders/{oid}", json={"customer_id": 1, "item_ids": item_ids[:2]}))
+    )
+    assert responses[0].json()["item_ids"] == item_ids[:2]
+    assert not [s for s in statements if s.startswith("UPDATE order_items")]
+    r = client.put(f"/orders/{oid}", json={"customer_id": 1, "item_ids": item_ids[1:]})
+    assert r.json()["item_ids"] == item_ids[1:]
+    assert client.get(f"/order_items/{item_ids[0]}").status_code == 200
+    since = changes_head()
+    r = client.put(f"/orders/{oid}", json={"customer_id": 999999, "item_ids": item_ids[1:]})
+    assert r.status_code == 400 and r.json()["detail"] == "Customer not found"
+    r = client.put(f"/orders/{oid}", json={"customer_id": 2, "item_ids": [item_ids[0], 999999]})
+    assert r.status_code == 400 and r.json()["detail"] == "Unknown order item ids: [999999]"
+    assert client.get("/changes", params={"since": since}).json() == []
+    r = client.get(f"/orders/{oid}")
+    assert r.status_code == 200 and r.json()["customer"]["id"] == 1 and r.json()["item_ids"] == item_ids[1:]
+    assert client.get("/orders/", params={"limit": 5}).status_code == 200
+
+def test_patch_order_adds_and_removes_items():
+    item_ids = [client.post("/order_items/", json={"shop_item_id": 2, "quantity": q}).json()["id"] for q in (1, 2, 3)]
+    oid = client.post("/orders/", json={"customer_id": 1, "item_ids": item_ids[:2]}).json()["id"]
+    r = client.patch(f"/orders/{oid}", json={"add_item_ids": [item_ids[2]], "remove_item_ids": [item_ids[0]]})
+    assert r.status_code == 200
+    assert r.json()["item_ids"] == item_ids[1:]
+    r = client.patch(f"/orders/{oid}", json={"customer_id": 2})
+    assert r.json()["customer"]["id"] == 2
+    assert r.json()["item_ids"] == item_ids[1:]
+    r = client.patch(f"/orders/{oid}", json={"add_item_ids": [item_ids[0]], "remove_item_ids": [item_ids[0]]})
+    assert r.status_code == 400
+    since = changes_head()
+    r = client.patch(f"/orders/{oid}", json={"customer_id": 999999, "remove_item_ids": [item_ids[1]]})
+    assert r.status_code == 400 and r.json()["detail"] == "Customer not found"
+    r = client.patch(f"/orders/{oid}", json={"add_item_ids": [item_ids[0], 999999]})
+    assert r.status_code == 400 and r.json()["detail"] == "Unknown order item ids: [999999]"
+    assert client.get("/changes", params={"since": since}).json() == []
+    r = client.get(f"/orders/{oid}")
+    assert r.status_code == 200 and r.json()["customer"]["id"] == 2 and r.json()["item_ids"] == item_ids[1:]
+    assert client.patch("/orders/999999", json={}).status_code == 404
+
+def test_server_timing_and_metrics_per_route():
+    cid = client.post("/customers/", json={"name": "Tim", "surname": "Ing", "email": "timing@example.com"}).json()["id"]
+    main.metrics.clear()
+    r = client.get(f"/customers/{cid}")
+    # One row each from the version lookup and the customer query
+    assert r.headers["Server-Timing"].startswith("db;dur=")
+    assert 'desc="2 statements, 2 rows", app;dur=' in r.headers["Server-Timing"]
+    client.get(f"/customers/{cid}")
+    client.get("/customers/999999")
+    lines = client.get("/metrics").text.splitlines()
+    labels = 'method="GET",route="/customers/{customer_id}"'
+    assert f"shop_http_request_duration_seconds_count{{{labels}}} 3" in lines
+    assert f'shop_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 3' in lines
+    assert f"shop_http_request_sql_statements_sum{{{labels}}} 6.000000" in lines
+    assert f"shop_http_request_db_rows_total{{{labels}}} 4" in lines
+    assert f'shop_http_responses_total{{{labels},status="404"}} 1' in lines
+
+def is_projection(sparse, full):
+    if isinstance(sparse, dict):
+        return isinstance(full, dict) and all(k in full and is_projection(v, full[k]) for k, v in sparse.items())
+    if isinstance(sparse, list):
+        return isinstance(full, list) and len(sparse) == len(full) and all(map(is_projection, sparse, full))
+    return sparse == full
+
+@pytest.mark.parametrize("path, params, keys", [
+    ("/orders/", {"fields": "id,items.quantity"}, ["id", "items"]),
+    ("/orders/1", {"fields": "id,item_ids"}, ["item_ids", "id"]),
+    ("/orders/1", {"include": "customer", "fields": "items.shop_item.categories.title"}, None),
+    ("/order_items/", {"fields": "quantity,shop_item.price"}, ["quantity", "shop_item"]),
+    ("/order_items/1", {"include": "shop_item"}, ["shop_item_id", "quantity", "id", "shop_item"]),
+    ("/shop_items/", {"fields": "id,price"}, ["price", "id"]),
+    ("/shop_items/1", {"include": "categories", "fields": "title,categories.id"}, ["title", "categories"]),
+    ("/categories/1/shop_items", {"fields": "title"}, ["title"]),
+])
+def test_sparse_fieldsets_project_the_full_response(path, params, keys):
+    full = client.get(path).json()
+    r = client.get(path, params=params)
+    assert r.status_code == 200
+    sparse = r.json()
+    assert is_projection(sparse, full)
+    if keys is not None:
+        assert list((sparse[0] if isinstance(sparse, list) else sparse).keys()) == keys
+
+def test_sparse_fieldsets_skip_unrequested_columns_and_relations():
+    statements = capture_statements(lambda: client.get("/orders/", params={"fields": "id,items.quantity"}))
+    assert len(statements) == 3  # version lookup, orders, order items
+    assert not [s for s in statements if "customers" in s or "shop_items" in s]
+    assert "order_items.shop_item_id" not in statements[2]
+    statements = capture_statements(lambda: client.get("/orders/1", params={"fields": "id"}))
+    assert "orders.customer_id" not in statements[-1] and "order_items" not in statements[-1]
+    assert client.get("/orders/", params={"fields": "bogus"}).status_code == 400
+    assert client.get("/orders/", params={"include": "items.nope"}).status_code == 400
+    assert client.get("/orders/999999", params={"fields": "id"}).status_code == 404
+
+def test_normalized_orders_rebuild_the_nested_response():
+    client.post("/orders/place", json={"customer_id": 1, "lines": [{"shop_item_id": 1, "quantity": 5}]})
+    full = client.get("/orders/").json()
+    r = client.get("/orders/", params={"format": "normalized"})
+    assert r.status_code == 200
+    doc = r.json()
+    rebuilt = []
+    for order in doc["orders"]:
+        items = []
+        for line in order["items"]:
+            item = dict(doc["shop_items"][str(line["shop_item_id"])])
+            item["categories"] = [doc["categories"][str(c)] for c in item["category_ids"]]
+            item["category_ids"] = []
+            items.append({**line, "shop_item": item})
+        rebuilt.append({**order, "customer": doc["customers"][str(order["customer_id"])], "items": items})
+    assert rebuilt == full
+    # Shared entities are sent once
+    assert len(doc["customers"]) == len({o["customer_id"] for o in full})
+    assert len(r.content) < len(client.get("/orders/").content)
+    assert client.get("/orders/", params={"format": "normalized", "fields": "id"}).status_code == 400
+    assert client.get("/orders/", params={"format": "xml"}).status_code == 422
+
+def changes_head():
+    r = client.get("/changes", params={"limit": 1000})
+    while r.json():
+        r = client.get("/changes", params={"since": r.headers["X-Next-Cursor"], "limit": 1000})
+    return r.headers["X-Next-Cursor"]
+
+def test_change_log_records_every_write_in_commit_order():
+    since = changes_head()
+    cid = client.post("/customers/", json={"name": "Cha", "surname": "Nge", "email": "changes@example.com"}).json()["id"]
+    client.put(f"/customers/{cid}", json={"name": "Chad", "surname": "Nge", "email": "changes@example.com"})
+    client.delete(f"/customers/{cid}")
+    category_id = client.post("/categories/", json={"title": "Logged"}).json()["id"]
+    item_id = client.post("/shop_items/", json={"title": "Log", "price": 1.5, "category_ids": [category_id]}).json()["id"]
+    client.delete(f"/categories/{category_id}")
+    r = client.get("/changes", params={"since": since})
+    assert r.status_code == 200
+    events = r.json()
+    assert [e["seq"] for e in events] == sorted(e["seq"] for e in events)
+    assert [(e["entity"], e["id"], e["op"]) for e in events] == [
+        ("customers", cid, "create"),
+        ("customers", cid, "update"),
+        ("customers", cid, "delete"),
+        ("categories", category_id, "create"),
+        ("shop_items", item_id, "create"),
+        ("categories", category_id, "delete"),
+        ("shop_items", item_id, "update"),
+    ]
+    assert events[1]["state"] == {"name": "Chad", "surname": "Nge", "email": "changes@example.com", "id": cid}
+    assert events[2]["state"] is None
+    assert events[4]["state"]["category_ids"] == [category_id]
+    assert events[6]["state"]["category_ids"] == []
+    # Paging by cursor returns the same events
+    paged, cursor = [], since
+    while True:
+        r = client.get("/changes", params={"since": cursor, "limit": 2})
+        if not r.json():
+            break
+        paged += r.json()
+        cursor = r.headers["X-Next-Cursor"]
+    assert paged == events
+    assert client.get("/changes", params={"since": "bogus"}).status_code == 400
+
+def test_change_log_records_order_lines():
+    since = changes_head()
+    order = client.post("/orders/place", json={"customer_id": 1, "lines": [{"shop_item_id": 2, "quantity": 3}]}).json()
+    line_id = order["item_ids"][0]
+    client.delete(f"/orders/{order['id']}")
+    events = [(e["entity"], e["id"], e["op"], e["state"]) for e in client.get("/changes", params={"since": since}).json()]
+    assert events == [
+        ("orders", order["id"], "create", {"customer_id": 1, "item_ids": [line_id], "id": order["id"]}),
+        ("order_items", line_id, "create", {"shop_item_id": 2, "quantity": 3, "order_id": order["id"], "id": line_id}),
+        ("orders", order["id"], "delete", None),
+        ("order_items", line_id, "update", {"shop_item_id": 2, "quantity": 3, "order_id": None, "id": line_id}),
+    ]
+
+def test_change_log_skips_order_items_that_do_not_move():
+    other = client.post("/orders/place", json={"customer_id": 1, "lines": [{"shop_item_id": 2, "quantity": 1}]}).json()
+    since = changes_head()
+    order = client.post("/orders/", json={"customer_id": 1, "item_ids": [424242]}).json()
+    assert order["item_ids"] == []
+    r = client.patch(f"/orders/{order['id']}", json={"remove_item_ids": [424243, other["item_ids"][0]]})
+    assert r.status_code == 200 and r.json()["item_ids"] == []
+    events = [(e["entity"], e["id"], e["op"]) for e in client.get("/changes", params={"since": since}).json()]
+    assert events == [("orders", order["id"], "create"), ("orders", order["id"], "update")]
+    assert client.get(f"/orders/{other['id']}").json()["item_ids"] == other["item_ids"]
+
+def test_changes_long_poll_wakes_on_commit():
+    since = changes_head()
+    r = client.get("/changes", params={"since": since, "wait": 0.05})
+    assert r.json() == [] and r.headers["X-Next-Cursor"] == since
+    responses = []
+    poller = threading.Thread(target=lambda: responses.append(client.get("/changes", params={"since": since, "wait": 10})))
+    start = time.perf_counter()
+    poller.start()
+    time.sleep(0.2)
+    cid = client.post("/customers/", json={"name": "Long", "surname": "Poll", "email": "poll@example.com"}).json()["id"]
+    poller.join()
+    assert time.perf_counter() - start < 5
+    assert [(e["entity"], e["id"]) for e in responses[0].json()] == [("customers", cid)]
+
+def test_change_log_compaction():
+    since = changes_head()
+    client.post("/categories/", json={"title": "Compacted"})
+    with main.SessionLocal() as db:
+        assert main.compact_changes(db, max_age=3600, max_rows=1) > 0
+        db.commit()
+    assert client.get("/changes", params={"since": since}).status_code == 200
+    with main.SessionLocal() as db:
+        main.compact_changes(db, max_age=0)
+        db.commit()
+    assert client.get("/changes", params={"since": since}).status_code == 410
+    r = client.get("/changes")
+    assert r.status_code == 200 and r.json() == []
+    client.post("/categories/", json={"title": "After compaction"})
+    assert [e["op"] for e in client.get("/changes", params={"since": r.headers["X-Next-Cursor"]}).json()] == ["create"]
+
+def test_group_commit_batches_creates_and_isolates_errors(monkeypatch):
+    batcher = main.WriteBatcher(main.SessionLocal, main.writer_lock, window=0.2, max_ops=50)
+    monkeypatch.setattr(main, "write_batcher", batcher)
+    since = changes_head()
+    emails = [f"batch{i}@example.com" for i in range(8)] + ["batch0@example.com"]
+    responses = [None] * len(emails)
+    def post(i):
+        responses[i] = client.post("/customers/", json={"name": "Batch", "surname": str(i), "email": emails[i]})
+    threads = [threading.Thread(target=post, args=(i,)) for i in range(len(emails))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        assert sorted(r.status_code for r in responses) == [200] * 8 + [400]
+        assert batcher.stats()["batches"] < len(emails)
+        created = {r.json()["id"] for r in responses if r.status_code == 200}
+        assert {e["id"] for e in client.get("/changes", params={"since": since}).json()} == created
+        for cid in created:
+            assert client.get(f"/customers/{cid}").json()["email"].startswith("batch")
+        r = client.post("/orders/place", json={"customer_id": min(created), "lines": [{"shop_item_id": 1, "quantity": 1}]})
+        assert r.status_code == 200 and r.json()["customer"]["id"] == min(created)
+        assert client.get("/write_batcher/stats").json()["enabled"] is True
+    finally:
+        client.portal.call(batcher.close)
+
+def rollup_rows():
+    with main.SessionLocal() as db:
+        return {
+            table: [tuple(round(v, 6) for v in row) for row in db.execute(text(f"SELECT * FROM {table} ORDER BY 1"))]
+            for table, *_ in rollups.ROLLUPS
+        }
+
+def rebuilt_rollup_rows():
+    with main.SessionLocal() as db:
+        rollups.rebuild(db)
+        db.flush()
+        rows = {
+            table: [tuple(round(v, 6) for v in row) for row in db.execute(text(f"SELECT * FROM {table} ORDER BY 1"))]
+            for table, *_ in rollups.ROLLUPS
+        }
+        db.rollback()
+    return rows
+
+def test_sales_rollups_follow_order_writes():
+    cid = client.post("/customers/", json={"name": "Roll", "surname": "Up", "email": "rollup@example.com"}).json()["id"]
+    other = client.post("/customers/", json={"name": "Roll", "surname": "Over", "email": "rollover@example.com"}).json()["id"]
+    category_id = client.post("/categories/", json={"title": "Rollup category"}).json()["id"]
+    cheap, dear = (
+        client.post("/shop_items/", json={"title": title, "price": price, "category_ids": [category_id]}).json()["id"]
+        for title, price in (("Cheap", 2.5), ("Dear", 100.0))
+    )
+    order = client.post("/orders/place", json={"customer_id": cid, "lines": [
+        {"shop_item_id": cheap, "quantity": 4}, {"shop_item_id": dear, "quantity": 1},
+    ]}).json()
+    spend = client.get(f"/analytics/customer_spend/{cid}").json()
+    assert (spend["orders"], spend["units"], spend["spend"]) == (1, 5, 110.0)
+    categories = {c["category_id"]: c for c in client.get("/analytics/revenue_by_category").json()}
+    assert (categories[category_id]["shop_items"], categories[category_id]["revenue"]) == (2, 110.0)
+    # A price change reprices every line of the item
+    client.put(f"/shop_items/{cheap}", json={"title": "Cheap", "price": 5.0, "category_ids": [category_id]})
+    assert client.get(f"/analytics/customer_spend/{cid}").json()["spend"] == 120.0
+    # Moving a line to another item, and the order to another customer, refreshes both sides
+    line_id = order["item_ids"][0]
+    client.put(f"/order_items/{line_id}", json={"shop_item_id": dear, "quantity": 1})
+    client.patch(f"/orders/{order['id']}", json={"customer_id": other})
+    assert client.get(f"/analytics/customer_spend/{cid}").json()["spend"] == 0.0
+    assert client.get(f"/analytics/customer_spend/{other}").json()["spend"] == 200.0
+    top = client.get("/analytics/top_shop_items", params={"by": "units", "limit": 1000}).json()
+    assert [t["units"] for t in top] == sorted((t["units"] for t in top), reverse=True)
+    assert cheap not in {t["shop_item_id"] for t in top}
+    assert {t["shop_item_id"]: t["revenue"] for t in top}[dear] == 200.0
+    client.delete(f"/orders/{order['id']}")
+    assert client.get(f"/analytics/customer_spend/{other}").json()["orders"] == 0
+    assert client.get("/analytics/customer_spend/999999").status_code == 404
+    assert rollup_rows() == rebuilt_rollup_rows()
+
+def test_sales_rollups_match_a_full_rebuild():
+    temp = client.post("/categories/", json={"title": "Temporary"}).json()["id"]
+    item = client.post("/shop_items/", json={"title": "Gadget", "price": 20.0, "category_ids": [1, temp]}).json()["id"]
+    client.post("/orders/place", json={"customer_id": 2, "lines": [{"shop_item_id": item, "quantity": 3}]})
+    client.delete(f"/categories/{temp}")
+    client.put(f"/shop_items/{item}", json={"title": "Gadget", "price": 25.0, "category_ids": [2]})
+    assert rollup_rows() == rebuilt_rollup_rows()
+    top = client.get("/analytics/customer_spend").json()
+    assert [c["spend"] for c in top] == sorted((c["spend"] for c in top), reverse=True)
+
+def test_order_reads_come_from_snapshots():
+    category_id = client.post("/categories/", json={"title": "Snap"}).json()["id"]
+    item_id = client.post("/shop_items/", json={"title": "Snapshot", "price": 3.0, "category_ids": [category_id]}).json()["id"]
+    oid = client.post("/orders/place", json={"customer_id": 1, "lines": [{"shop_item_id": item_id, "quantity": 2}]}).json()["id"]
+    responses = []
+    statements = capture_statements(lambda: responses.append(client.get(f"/orders/{oid}")))
+    assert len(statements) == 1 and "order_snapshots" in statements[0]
+    nested = client.get("/orders/", params={"after_id": oid - 1, "limit": 1})
+    assert responses[0].json() == nested.json()[0]
+    # A change to an embedded category rebuilds the snapshot and moves its ETag
+    etag = responses[0].headers["ETag"]
+    assert client.get(f"/orders/{oid}", headers={"If-None-Match": etag}).status_code == 304
+    client.put(f"/categories/{category_id}", json={"title": "Snapped"})
+    r = client.get(f"/orders/{oid}", headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.headers["ETag"] != etag
+    assert r.json()["items"][0]["shop_item"]["categories"][0]["title"] == "Snapped"
+    with main.ReadSessionLocal() as db:
+        assert main.order_snapshots.check(db) == []
+
+def test_order_snapshot_consistency_check():
+    cid = client.post("/customers/", json={"name": "Snap", "surname": "Shot", "email": "snapshot@example.com"}).json()["id"]
+    oid = client.post("/orders/place", json={"customer_id": cid, "lines": [{"shop_item_id": 1, "quantity": 1}]}).json()["id"]
+    with main.SessionLocal() as db:
+        db.execute(models.OrderSnapshotDB.__table__.update().where(models.OrderSnapshotDB.order_id == oid).values(body=b"{}"))
+        db.commit()
+    with main.ReadSessionLocal() as db:
+        assert main.order_snapshots.check(db) == [snapshots.SnapshotProblem(oid, "stale body")]
+    with main.SessionLocal() as db:
+        main.order_snapshots.rebuild(db)
+        db.commit()
+        assert main.order_snapshots.check(db) == []
+    # An order whose customer is gone cannot be rendered, so it loses its snapshot
+    client.delete(f"/customers/{cid}")
+    with main.ReadSessionLocal() as db:
+        assert db.get(models.OrderSnapshotDB, oid) is None
+        assert main.order_snapshots.check(db) == []
+
+def get_concurrently(requests):
+    """Issue (delay, path) GETs from threads; returns the responses in order."""
+    responses = [None] * len(requests)
+    def get(i, delay, path):
+        time.sleep(delay)
+        responses[i] = client.get(path)
+    threads = [threading.Thread(target=get, args=(i, *r)) for i, r in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+def slow_reads(seconds):
+    # Sleeps on the connection's thread: in async mode that is the event loop, which would stall every request
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        time.sleep(seconds)
+    event.listen(main.read_engine, "after_cursor_execute", after_cursor_execute)
+    return lambda: event.remove(main.read_engine, "after_cursor_execute", after_cursor_execute)
+
+@pytest.mark.skipif(main.DB_MODE == "async", reason="slow_reads blocks the event loop in async mode")
+def test_concurrent_reads_share_one_load():
+    item_id = client.post("/shop_items/", json={"title": "Viral", "price": 9.0, "category_ids": [1]}).json()["id"]
+    main.metrics.clear()
+    before = main.single_flight.stats()
+    responses = []
+    restore = slow_reads(0.1)
+    try:
+        statements = capture_statements(lambda: responses.extend(get_concurrently([(0, f"/shop_items/{item_id}")] * 8)))
+    finally:
+        restore()
+    assert all(r.status_code == 200 and r.json() == responses[0].json() for r in responses)
+    after = main.single_flight.stats()
+    coalesced = after["coalesced"] - before["coalesced"]
+    assert coalesced > 0 and after["leaders"] - before["leaders"] + coalesced == 8
+    # Only the leaders touched the database
+    assert len(statements) <= 3 * (8 - coalesced)
+    labels = 'method="GET",route="/shop_items/{item_id}"'
+    assert f"shop_http_coalesced_requests_total{{{labels}}} {coalesced}" in client.get("/metrics").text.splitlines()
+
+@pytest.mark.skipif(main.DB_MODE == "async", reason="slow_reads blocks the event loop in async mode")
+def test_writes_stop_in_flight_reads_from_taking_followers():
+    oid = client.post("/orders/place", json={"customer_id": 1, "lines": [{"shop_item_id": 1, "quantity": 1}]}).json()["id"]
+    client.get(f"/orders/{oid}")
+    before = main.single_flight.stats()
+    responses = []
+    restore = slow_reads(0.5)
+    try:
+        # The first read loads the order, then the write commits while it is still in flight
+        reader = threading.Thread(target=lambda: responses.extend(get_concurrently([
+            (0, f"/orders/{oid}"), (0.1, f"/orders/{oid}"), (0.4, f"/orders/{oid}"),
+        ])))
+        reader.start()
+        time.sleep(0.25)
+        assert client.patch(f"/orders/{oid}", json={"customer_id": 2}).status_code == 200
+        reader.join()
+    finally:
+        restore()
+    first, joined, after_write = responses
+    assert first.json() == joined.json() and first.json()["customer"]["id"] == 1
+    assert after_write.json()["customer"]["id"] == 2
+    after = main.single_flight.stats()
+    assert after["coalesced"] - before["coalesced"] == 1
+    assert after["forgotten"] > before["forgotten"]
+
+def wait_for_import(job_id):
+    deadline = time.monotonic() + 10
+    while True:
+        report = client.get(f"/imports/{job_id}").json()
+        if report["status"] in ("done", "failed") or time.monotonic() > deadline:
+            return report
+        time.sleep(0.02)
+
+def test_csv_import_upserts_in_chunks(monkeypatch):
+    monkeypatch.setattr(main.import_runner, "chunk_size", 2)
+    home = client.post("/categories/", json={"title": "Import Home"}).json()["id"]
+    garden = client.post("/categories/", json={"title": "Import Garden"}).json()["id"]
+    existing = client.post("/shop_items/", json={"title": "Old rake", "price": 5.0, "category_ids": [home]}).json()["id"]
+    client.post("/orders/place", json={"customer_id": 1, "lines": [{"shop_item_id": existing, "quantity": 2}]})
+    since = changes_head()
+    csv_body = "\n".join([
+        "id,title,description,price,categories",
+        ",Lantern,Solar powered,19.5,Import Home|Import Garden",
+        f"{existing},Rake,Steel,7.25,Import Garden",
+        ",Broken,,not a price,",
+        ",Mystery,,1,Import Nowhere",
+        "999999,Numbered,,3,",
+    ]).encode()
+    r = client.post("/imports", content=csv_body, headers={"Content-Type": "text/csv"})
+    assert r.status_code == 202 and r.headers["Location"] == f"/imports/{r.json()['id']}"
+    report = wait_for_import(r.json()["id"])
+    assert report["status"] == "done", report
+    assert (report["rows_read"], report["created"], report["updated"], report["failed"]) == (5, 2, 1, 2)
+    assert [e["line"] for e in report["errors"]] == [4, 5]
+    assert report["errors"][0]["error"].startswith("price:")
+    assert report["errors"][1]["error"] == "Unknown categories: ['Import Nowhere']"
+    rake = client.get(f"/shop_items/{existing}").json()
+    assert (rake["title"], rake["price"], [c["id"] for c in rake["categories"]]) == ("Rake", 7.25, [garden])
+    assert client.get("/shop_items/999999").json()["title"] == "Numbered"
+    lantern = client.get("/shop_items/search", params={"q": "lantern"}).json()["items"][0]
+    assert [c["id"] for c in lantern["categories"]] == [home, garden]
+    ops = {(e["id"], e["op"]) for e in client.get("/changes", params={"since": since}).json() if e["entity"] == "shop_items"}
+    assert ops == {(lantern["id"], "create"), (999999, "create"), (existing, "update")}
+    assert rollup_rows() == rebuilt_rollup_rows()
+    with main.ReadSessionLocal() as db:
+        assert main.order_snapshots.check(db) == []
+    # A chunk that only moves a sold item to another category empties the old category's rollup
+    revenue = lambda: {c["category_id"]: c["revenue"] for c in client.get("/analytics/revenue_by_category").json()}
+    assert revenue()[garden] == 14.5
+    move = f"id,title,price,categories\n{existing},Rake,7.25,Import Home\n".encode()
+    job = client.post("/imports", content=move, headers={"Content-Type": "text/csv"}).json()["id"]
+    assert wait_for_import(job)["updated"] == 1
+    assert garden not in revenue() and revenue()[home] == 14.5
+    assert rollup_rows() == rebuilt_rollup_rows()
+
+def test_ndjson_import_and_bad_requests():
+    client.post("/categories/", json={"title": "Import Outdoor"})
+    body = b'{"title": "Hammock", "price": 60, "categories": ["Import Outdoor"]}\n{"title": \n[]\n'
+    r = client.post("/imports", params={"format": "ndjson"}, content=body)
+    report = wait_for_import(r.json()["id"])
+    assert (report["status"], report["created"], report["failed"]) == ("done", 1, 2)
+    assert [e["line"] for e in report["errors"]] == [2, 3]
+    assert report["progress"] == 1.0 and report["bytes"] == len(body)
+    assert client.post("/imports", content=b"x", headers={"Content-Type": "application/pdf"}).status_code == 415
+    assert client.get("/imports/999999").status_code == 404
+
+def test_profiling_is_admin_only_and_reports_collapsed_stacks(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "")
+    assert client.get("/admin/profiling").status_code == 404
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "s3cret")
+    assert client.get("/admin/profiling").status_code == 403
+    assert client.get("/admin/profiling", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    admin = {"X-Admin-Token": "s3cret"}
+    r = client.put("/admin/profiling", json={"fractions": {"no_such_endpoint": 1.0}}, headers=admin)
+    assert r.status_code == 400
+    try:
+        r = client.put("/admin/profiling", json={"fractions": {"list_orders": 1.0}, "interval_ms": 1}, headers=admin)
+        assert r.json()["fractions"] == {"list_orders": 1.0}
+        # A fast request may finish between two samples
+        for _ in range(200):
+            client.get("/orders/", params={"limit": 10})
+            client.get("/customers/")
+            if main.profiler.stats()["endpoints"]["list_orders"]["samples"]:
+                break
+    finally:
+        client.put("/admin/profiling", json={"fraction": 0, "fractions": {}}, headers=admin)
+    endpoints = client.get("/admin/profiling", headers=admin).json()["endpoints"]
+    assert set(endpoints) == {"list_orders"} and endpoints["list_orders"]["samples"] > 0
+    r = client.get("/admin/profiling/stacks", params={"endpoint": "list_orders"}, headers=admin)
+    assert r.headers["content-type"].startswith("text/plain")
+    stacks = [line.rsplit(" ", 1) for line in r.text.splitlines()]
+    assert stacks and all(stack.startswith("list_orders;") and int(n) > 0 for stack, n in stacks)
+    assert any("(app/main.py:" in stack for stack, _ in stacks)
+    assert client.delete("/admin/profiling/stacks", headers=admin).json() == {"ok": True}
+    assert client.get("/admin/profiling/stacks", headers=admin).text == ""
@@ -0,0 +1,82 @@
+import pytest
+from fastapi.testclient import TestClient
+from app import main
+from app.main import app
+from app.seed import seed_demo_data
+
+client = TestClient(app)
+
+@pytest.fixture(scope="module", autouse=True)
+def varied_orders():
+    with client:
+        seed_demo_data()
+        categories = [
+            client.post("/categories/", json={"title": title, "description": description}).json()["id"]
+            for title, description in [("Zubehör", None), ("Cafés ☕", "Ünïcode \"quoted\" \\ text"), ("Misc", "")]
+        ]
+        items = [
+            client.post("/shop_items/", json={
+                "title": f"Item {price}", "description": description, "price": price, "category_ids": cats,
+            }).json()["id"]
+            for price, description, cats in [
+                (0.1, None, categories[::-1]), (1e-7, "tiny", []), (1234567.5, "big", categories[:1]),
+                (100.0, "round", categories), (19.99, "日本語", categories[1:]),
+            ]
+        ]
+        customer = client.post("/customers/", json={"name": "Ève", "surname": "O'Neil", "email": "eve@example.com"}).json()["id"]
+        for chunk in (items[:3], items[3:], []):
+            lines = [{"shop_item_id": item, "quantity": q} for q, item in enumerate(chunk, 1)]
+            if lines:
+                client.post("/orders/place", json={"customer_id": customer, "lines": lines})
+            else:
+                client.post("/orders/", json={"customer_id": customer, "item_ids": []})
+        client.post("/order_items/", json={"shop_item_id": items[4], "quantity": 7})
+        yield
+
+def fetch_both(monkeypatch, path):
+    # Stored order snapshots would answer both requests; compare the builders behind them
+    monkeypatch.setattr(main, "order_snapshot_response", lambda request, db, oid: None)
+    responses = []
+    for fast in (False, True):
+        monkeypatch.setattr(main, "FAST_SERIALIZATION", fast)
+        responses.append(client.get(path))
+    return responses
+
+@pytest.mark.parametrize("path", [
+    "/orders/", "/orders/?limit=2", "/orders/1", "/orders/3", "/orders/999999",
+    "/order_items/", "/order_items/?limit=3", "/order_items/2", "/order_items/999999",
+    "/export/orders", "/export/order_items",
+])
+def test_fast_path_is_byte_identical(monkeypatch, path):
+    monkeypatch.setattr(main, "EXPORT_CHUNK_SIZE", 2)
+    slow, fast = fetch_both(monkeypatch, path)
+    assert fast.status_code == slow.status_code
+    assert fast.content == slow.content
+    for header in ("content-type", "etag", "x-next-cursor"):
+        assert fast.headers.get(header) == slow.headers.get(header)
+
+def test_fast_path_follows_cursors(monkeypatch):
+    monkeypatch.setattr(main, "FAST_SERIALIZATION", True)
+    ids, cursor = [], None
+    while True:
+        r = client.get("/orders/", params={"limit": 2, **({"cursor": cursor} if cursor else {})})
+        ids += [order["id"] for order in r.json()]
+        cursor = r.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    monkeypatch.setattr(main, "FAST_SERIALIZATION", False)
+    assert ids == [order["id"] for order in client.get("/orders/").json()]
+
+@pytest.mark.parametrize("encoder", ["orjson", "json"])
+def test_order_snapshots_match_the_regular_path(monkeypatch, encoder):
+    if encoder == "json":
+        monkeypatch.setattr(main, "orjson", None)
+    with main.SessionLocal() as db:
+        main.order_snapshots.refresh(db, [1, 2, 3])
+        db.commit()
+    snapshots = [client.get(f"/orders/{oid}") for oid in (1, 2, 3)]
+    monkeypatch.setattr(main, "order_snapshot_response", lambda request, db, oid: None)
+    for oid, snapshot in zip((1, 2, 3), snapshots):
+        regular = client.get(f"/orders/{oid}")
+        assert snapshot.content == regular.content
+        assert snapshot.headers["etag"] == regular.headers["etag"]
@@ -0,0 +1,54 @@
+import io
+from app.imports import ImportJob, RowError, iter_rows, read_chunk
+
+def rows(data: bytes, format: str):
+    return list(iter_rows(io.BytesIO(data), format))
+
+def test_csv_rows():
+    data = (
+        "﻿id,title,description,price,categories\n"
+        ',Lamp,,12.5,"Home | Lighting|"\n'
+        '7,"Desk, oak","Two\nlines",80,\n'
+        "8,Chair,,40,Home,extra\n"
+    ).encode()
+    assert rows(data, "csv") == [
+        (2, {"title": "Lamp", "price": "12.5", "categories": ["Home", "Lighting"]}, None),
+        (4, {"id": "7", "title": "Desk, oak", "description": "Two\nlines", "price": "80"}, None),
+        (5, None, "expected 5 columns, got more"),
+    ]
+
+def test_csv_stops_at_undecodable_bytes():
+    # The reader decodes ahead of the rows it returns, so the error ends the file
+    [(line, fields, error)] = rows(b"title,price\nLamp,1\n\xff\xfe,2\n", "csv")
+    assert fields is None and error.startswith("unreadable CSV: 'utf-8' codec can't decode")
+
+def test_ndjson_rows():
+    data = b'{"title": "Lamp", "price": 1}\n\n{"title": \n[1, 2]\n{"title": "Desk", "categories": ["Home"]}'
+    assert [(line, fields, error and error.split(":")[0]) for line, fields, error in rows(data, "ndjson")] == [
+        (1, {"title": "Lamp", "price": 1}, None),
+        (3, None, "invalid JSON"),
+        (4, None, "expected a JSON object"),
+        (5, {"title": "Desk", "categories": ["Home"]}, None),
+    ]
+
+def test_job_report_keeps_the_first_errors():
+    job = ImportJob(1, "csv", size=100, max_errors=2)
+    assert job.report()["status"] == "queued"
+    job.start()
+    job.bytes_read, job.rows_read = 50, 3
+    job.add_errors([RowError(2, "a"), RowError(3, "b"), RowError(4, "c")])
+    report = job.report()
+    assert report["progress"] == 0.5 and report["failed"] == 3
+    assert report["errors"] == [{"line": 2, "error": "a"}, {"line": 3, "error": "b"}]
+    job.finish()
+    assert job.finished and job.report()["progress"] == 1.0
+
+def test_read_chunk_validates_rows_and_resolves_categories():
+    raw = io.BytesIO(b"title,price,categories\nLamp,12.5,Home|Home\nDesk,cheap,\nChair,40,Garden\nStool,9,\n")
+    rows = iter_rows(raw, "csv")
+    accepted, errors, count, _ = read_chunk(rows, raw, {"Home": 3}, size=3)
+    assert count == 3 and [(line, row.title, cids) for line, row, cids in accepted] == [(2, "Lamp", [3])]
+    assert [e.line for e in errors] == [3, 4] and errors[1].error == "Unknown categories: ['Garden']"
+    accepted, errors, count, _ = read_chunk(rows, raw, {"Home": 3}, size=3)
+    assert (count, [row.title for _, row, _ in accepted], errors) == (1, ["Stool"], [])
+    assert read_chunk(rows, raw, {}, size=3)[2] == 0
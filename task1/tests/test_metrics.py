@@ -0,0 +1,49 @@
+import logging
+from sqlalchemy import create_engine, text
+from app.metrics import MetricsRegistry, RequestStats, current_stats, instrument_engine
+
+def run_with_stats(fn):
+    stats = RequestStats("/things/{id}")
+    token = current_stats.set(stats)
+    try:
+        fn()
+    finally:
+        current_stats.reset(token)
+    return stats
+
+def test_statements_rows_and_slow_query_log(caplog):
+    engine = instrument_engine(create_engine("sqlite://"), slow_query_seconds=1e-9)
+    def work():
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE t (x INTEGER)"))
+            conn.execute(text("INSERT INTO t VALUES (1), (2), (3)"))
+            assert conn.execute(text("SELECT x FROM t")).scalars().all() == [1, 2, 3]
+            assert conn.execute(text("SELECT x FROM t WHERE x = 2")).scalar() == 2
+    with caplog.at_level(logging.WARNING, logger="app.slow_queries"):
+        stats = run_with_stats(work)
+    assert stats.statements == 4
+    assert stats.rows == 3 + 3 + 1
+    assert stats.db_time > 0
+    assert any("/things/{id}" in m and "SELECT x FROM t" in m for m in caplog.messages)
+
+def test_statements_outside_requests_are_not_attributed():
+    engine = instrument_engine(create_engine("sqlite://"))
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT 1")).scalar() == 1
+    assert current_stats.get() is None
+
+def test_registry_renders_cumulative_histograms():
+    registry = MetricsRegistry()
+    stats = RequestStats('/a/"b"')
+    stats.statements, stats.rows, stats.db_time = 4, 10, 0.002
+    registry.observe("GET", stats, 200, 0.02)
+    registry.observe("GET", stats, 500, 3.0)
+    lines = registry.render().splitlines()
+    labels = 'method="GET",route="/a/\\"b\\""'
+    assert "# TYPE shop_http_request_duration_seconds histogram" in lines
+    assert f'shop_http_request_duration_seconds_bucket{{{labels},le="0.025"}} 1' in lines
+    assert f'shop_http_request_duration_seconds_bucket{{{labels},le="5"}} 2' in lines
+    assert f'shop_http_request_sql_statements_bucket{{{labels},le="3"}} 0' in lines
+    assert f'shop_http_request_sql_statements_bucket{{{labels},le="5"}} 2' in lines
+    assert f"shop_http_request_db_rows_total{{{labels}}} 20" in lines
+    assert f'shop_http_responses_total{{{labels},status="500"}} 1' in lines
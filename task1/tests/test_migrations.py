@@ -0,0 +1,52 @@
+import sqlite3
+import threading
+from sqlalchemy import create_engine, inspect
+from app.models import Base
+from app.migrations import LATEST_VERSION, MIGRATIONS, migrate, schema_version
+
+def test_migrations_build_the_model_schema(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'shop.db'}")
+    assert migrate(engine) == [m.version for m in MIGRATIONS]
+    assert schema_version(engine) == LATEST_VERSION
+    assert migrate(engine) == []
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        columns = {c["name"] for c in inspector.get_columns(table.name)}
+        assert columns == {c.name for c in table.columns}, table.name
+        indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        assert {i.name for i in table.indexes} <= indexes, table.name
+    assert inspector.get_pk_constraint("shopitem_category")["constrained_columns"] == ["shopitem_id", "category_id"]
+
+def test_migrations_upgrade_a_baseline_database(tmp_path):
+    path = tmp_path / "shop.db"
+    conn = sqlite3.connect(path)
+    for statement in MIGRATIONS[0].statements:
+        conn.execute(statement)
+    conn.execute("INSERT INTO categories (id, title) VALUES (1, 'Books')")
+    conn.execute("INSERT INTO shop_items (id, title, price) VALUES (1, 'Python Book', 29.99)")
+    # The old association table allowed duplicate links
+    conn.executemany("INSERT INTO shopitem_category VALUES (?, ?)", [(1, 1), (1, 1)])
+    conn.commit()
+    conn.close()
+    engine = create_engine(f"sqlite:///{path}")
+    assert migrate(engine) == [m.version for m in MIGRATIONS]
+    with engine.connect() as c:
+        assert c.exec_driver_sql("SELECT * FROM shopitem_category").all() == [(1, 1)]
+        assert c.exec_driver_sql("SELECT rowid FROM shop_items_fts WHERE shop_items_fts MATCH 'python'").all() == [(1,)]
+
+def test_concurrent_workers_apply_each_migration_once(tmp_path):
+    url = f"sqlite:///{tmp_path / 'shop.db'}"
+    applied, errors = [], []
+    def worker():
+        try:
+            engine = create_engine(url, connect_args={"timeout": 30})
+            applied.extend(migrate(engine))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert sorted(applied) == [m.version for m in MIGRATIONS]
@@ -0,0 +1,62 @@
+import time
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.profiling import Profiler, ProfilingMiddleware
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def make_app(profiler):
+    app = FastAPI()
+    app.add_middleware(ProfilingMiddleware, profiler=profiler, router=app.router)
+
+    @app.get("/sync")
+    def sync_work():
+        spin(0.05)
+        return {"ok": True}
+
+    @app.get("/async")
+    async def async_work():
+        spin(0.05)
+        return {"ok": True}
+
+    return app
+
+def parse(collapsed):
+    return [(stack.split(";"), int(count)) for stack, count in (line.rsplit(" ", 1) for line in collapsed.splitlines())]
+
+def test_profiled_requests_are_sampled_per_endpoint():
+    profiler = Profiler(interval=0.001)
+    profiler.configure(fractions={"sync_work": 1.0, "async_work": 1.0})
+    with TestClient(make_app(profiler)) as client:
+        for _ in range(3):
+            client.get("/sync")
+            client.get("/async")
+    time.sleep(0.05)  # let a sample taken as the last request ended be counted
+    stats = profiler.stats()["endpoints"]
+    assert stats["sync_work"]["requests"] == stats["async_work"]["requests"] == 3
+    for endpoint in ("sync_work", "async_work"):
+        stacks = parse(profiler.collapsed(endpoint))
+        assert stacks and all(frames[0] == endpoint for frames, _ in stacks)
+        assert sum(count for _, count in stacks) == stats[endpoint]["samples"]
+        # Most samples land in the endpoint's own loop, below the endpoint function
+        spinning = [(frames, n) for frames, n in stacks if frames[-1].startswith("spin (tests/test_profiling.py")]
+        assert sum(n for _, n in spinning) > stats[endpoint]["samples"] / 2
+        assert all(any(f.startswith(f"{endpoint} (") for f in frames) for frames, _ in spinning)
+    assert len(parse(profiler.collapsed())) == len(parse(profiler.collapsed("sync_work"))) + len(
+        parse(profiler.collapsed("async_work")))
+
+def test_disabled_and_unselected_endpoints_are_not_profiled():
+    profiler = Profiler(interval=0.001)
+    app = make_app(profiler)
+    with TestClient(app) as client:
+        client.get("/sync")
+        assert not profiler.enabled and profiler.stats()["endpoints"] == {}
+        profiler.configure(fractions={"async_work": 1.0})
+        client.get("/sync")
+        client.get("/async")
+    assert set(profiler.stats()["endpoints"]) == {"async_work"}
+    profiler.clear()
+    assert profiler.collapsed() == ""
@@ -0,0 +1,70 @@
+import asyncio
+import httpx
+from app.singleflight import SingleFlight, SingleFlightMiddleware
+
+def counting_app(delay=0.1):
+    calls = []
+    async def app(scope, receive, send):
+        calls.append(scope["path"])
+        n = len(calls)
+        await asyncio.sleep(delay)
+        if scope["path"] == "/things/0":
+            raise RuntimeError("boom")
+        body = f"{scope['path']} #{n}".encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-length", str(len(body)).encode()), (b"etag", b'"t"')]})
+        await send({"type": "http.response.body", "body": body})
+    return app, calls
+
+def run_requests(app, requests):
+    async def main():
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            async def one(delay, path, headers):
+                await asyncio.sleep(delay)
+                return await client.get(path, headers=headers)
+            return await asyncio.gather(*(one(*r) for r in requests))
+    return asyncio.run(main())
+
+def test_concurrent_identical_gets_share_one_load():
+    inner, calls = counting_app()
+    flights = SingleFlight()
+    app = SingleFlightMiddleware(inner, flights, {r"/things/(\d+)": "things:{}"})
+    responses = run_requests(app, [
+        *[(0, "/things/1", {}) for _ in range(5)],
+        (0, "/things/1?fields=a", {}),   # another query string
+        (0, "/things/2", {}),
+        (0, "/things/1", {"If-None-Match": '"t"'}),  # conditional: bypasses
+        (0, "/other/1", {}),  # not a coalesced route
+        (0.3, "/things/1", {}),  # after the first load finished
+    ])
+    assert [r.status_code for r in responses] == [200] * 10
+    assert {r.text for r in responses[:5]} == {responses[0].text}
+    assert responses[9].text != responses[0].text
+    assert len(calls) == 6
+    assert flights.stats() == {"leaders": 4, "coalesced": 4, "forgotten": 0, "in_flight": 0}
+
+def test_forget_and_errors():
+    inner, calls = counting_app()
+    flights = SingleFlight()
+    app = SingleFlightMiddleware(inner, flights, {r"/things/(\d+)": "things:{}"})
+
+    async def forget_later():
+        await asyncio.sleep(0.03)
+        flights.forget("things:1")
+    async def main():
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            async def get(delay, path):
+                await asyncio.sleep(delay)
+                return await client.get(path)
+            results = await asyncio.gather(
+                get(0, "/things/1"), get(0.01, "/things/1"), forget_later(), get(0.06, "/things/1"),
+                get(0, "/things/0"), get(0.01, "/things/0"),
+            )
+            return [r for r in results if r is not None]
+    first, joined, after_forget, failed, failed_follower = asyncio.run(main())
+    # The request made after forget started its own load instead of joining
+    assert first.text == joined.text != after_forget.text
+    assert failed.status_code == failed_follower.status_code == 500
+    assert flights.stats() == {"leaders": 3, "coalesced": 2, "forgotten": 1, "in_flight": 0}